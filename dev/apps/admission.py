@@ -0,0 +1,272 @@
+# dev/admission.py
+import fcntl
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager, nullcontext
+
+import psutil
+
+# Controle de admissão das etapas pela carga real do nó. Em vez de um número fixo
+# de amostras em paralelo, cada etapa que lê alinhamentos pede uma vaga em um de
+# dois grupos: "cpu" (decodificação de CRAM com a referência, leitura do BAM em
+# NumPy) ou "io" (indexação, bedcov, samtools depth sobre o BAM). As vagas são
+# arquivos travados com fcntl em um diretório local do nó, compartilhado por todos
+# os processos (e execuções) do pipeline; a trava some se o processo morre.
+# Além da vaga, a etapa só começa se houver folga medida com psutil: CPU abaixo
+# de max_cpu_percent (grupo cpu), disco ocupado abaixo de max_disk_busy (grupo io)
+# e memória disponível acima de min_free_memory (ambos). A primeira vaga de cada
+# grupo não exige folga, para o lote nunca parar; entre duas admissões do mesmo
+# grupo há um intervalo (settle_seconds) para a carga da anterior aparecer (uma
+# etapa que falha antes disso não conta). A carga é medida uma vez por ciclo de
+# espera (poll_seconds) e vale para os dois grupos.
+
+CPU = "cpu"
+IO = "io"
+MAX_CPU_PERCENT = 90.0
+MAX_DISK_BUSY_PERCENT = 90.0
+MIN_FREE_MEMORY = 2 * 1024 ** 3
+SETTLE_SECONDS = 2.0
+POLL_SECONDS = 1.0
+SAMPLE_SECONDS = 0.5  # janela mínima entre leituras dos contadores do sistema
+
+# Etapas que leem os alinhamentos e o grupo de cada uma
+STAGE_KINDS = {
+    "conversion": CPU,
+    "index": IO,
+    "coverage": IO,
+    "per_base": IO,
+    "bins": CPU,
+    "contamination": CPU,
+}
+
+
+def stage_kind(stage, no_bam=False, coverage_engine="samtools"):
+    """Grupo de vagas da etapa. Lendo CRAM direto (no_bam) tudo é decodificação (cpu);
+    a cobertura com o motor NumPy descomprime o BAM em processo (cpu)."""
+    if no_bam or (stage == "coverage" and coverage_engine == "numpy"):
+        return CPU
+    return STAGE_KINDS.get(stage, IO)
+
+
+def default_directory():
+    """Diretório local do nó para os arquivos de vaga (compartilhado pelas execuções do pipeline)."""
+    return os.path.join(tempfile.gettempdir(), "bioinf_pipeline_qc_admission")
+
+
+class LoadSampler:
+    """Carga do nó a partir de diferenças dos contadores do sistema (psutil)."""
+
+    def __init__(self):
+        self._last = None
+
+    def _read(self):
+        disk = psutil.disk_io_counters()
+        return (time.monotonic(), psutil.cpu_times(),
+                getattr(disk, "busy_time", None) if disk else None,
+                disk.read_bytes + disk.write_bytes if disk else 0)
+
+    def sample(self):
+        """Dicionário com cpu_percent, disk_busy_percent (None se indisponível),
+        disk_bytes_per_second e available_memory, medidos desde a leitura anterior."""
+        if self._last is None or time.monotonic() - self._last[0] < SAMPLE_SECONDS:
+            self._last = self._read()
+            time.sleep(SAMPLE_SECONDS)
+        current = self._read()
+        (wall0, cpu0, busy0, bytes0), (wall1, cpu1, busy1, bytes1) = self._last, current
+        self._last = current
+        elapsed = max(wall1 - wall0, 1e-6)
+        total = sum(cpu1) - sum(cpu0)
+        idle = (cpu1.idle + getattr(cpu1, "iowait", 0)) - (cpu0.idle + getattr(cpu0, "iowait", 0))
+        return {
+            "cpu_percent": 100.0 * (1 - idle / total) if total > 0 else 0.0,
+            # busy_time (ms) somado de todos os discos: acima de 100% com vários discos ocupados
+            "disk_busy_percent": (busy1 - busy0) / (elapsed * 1000) * 100 if busy0 is not None else None,
+            "disk_bytes_per_second": (bytes1 - bytes0) / elapsed,
+            "available_memory": psutil.virtual_memory().available,
+        }
+
+
+class AdmissionController:
+    """Vagas por grupo (cpu/io) com admissão condicionada à folga do nó."""
+
+    def __init__(self, cpu_slots, io_slots, directory=None, min_free_memory=MIN_FREE_MEMORY,
+                 max_cpu_percent=MAX_CPU_PERCENT, max_disk_busy=MAX_DISK_BUSY_PERCENT,
+                 settle_seconds=SETTLE_SECONDS, poll_seconds=POLL_SECONDS):
+        if cpu_slots < 1 or io_slots < 1:
+            raise ValueError("Cada grupo precisa de pelo menos uma vaga")
+        self.slots = {CPU: cpu_slots, IO: io_slots}
+        self.directory = directory or default_directory()
+        self.min_free_memory = min_free_memory
+        self.max_cpu_percent = max_cpu_percent
+        self.max_disk_busy = max_disk_busy
+        self.settle_seconds = settle_seconds
+        self.poll_seconds = poll_seconds
+        self._sampler = None
+        self._load = None
+
+    def __getstate__(self):
+        # O amostrador é do processo: cada trabalhador do pool começa o seu
+        state = dict(self.__dict__)
+        state["_sampler"] = None
+        state["_load"] = None
+        return state
+
+    def _slot_path(self, kind, index):
+        return os.path.join(self.directory, f"{kind}.{index}.slot")
+
+    def _try_slot(self, kind):
+        """Trava uma vaga livre do grupo sem esperar; retorna (índice, arquivo aberto) ou None."""
+        os.makedirs(self.directory, exist_ok=True)
+        for index in range(self.slots[kind]):
+            handle = open(self._slot_path(kind, index), "a")
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                handle.close()
+                continue
+            return index, handle
+        return None
+
+    def current_load(self):
+        """Carga do nó, medida no máximo uma vez por poll_seconds e reaproveitada pelos dois grupos."""
+        now = time.monotonic()
+        if self._load is None or now - self._load[0] >= self.poll_seconds:
+            if self._sampler is None:
+                self._sampler = LoadSampler()
+            self._load = (now, self._sampler.sample())
+        return self._load[1]
+
+    def headroom(self, kind):
+        """(True, carga) se o nó tem folga para mais uma etapa do grupo; senão (False, motivo)."""
+        load = self.current_load()
+        if load["available_memory"] < self.min_free_memory:
+            return False, f"memória disponível {load['available_memory'] / 1024 ** 3:.1f}G"
+        if kind == CPU and load["cpu_percent"] >= self.max_cpu_percent:
+            return False, f"CPU em {load['cpu_percent']:.0f}%"
+        if kind == IO and load["disk_busy_percent"] is not None and load["disk_busy_percent"] >= self.max_disk_busy:
+            return False, f"disco ocupado {load['disk_busy_percent']:.0f}%"
+        return True, load
+
+    def _admit_marks(self, kind, update):
+        """Lê a marca da última admissão do grupo e grava `update(última)` se não for None (com trava)."""
+        with open(os.path.join(self.directory, f"{kind}.admit"), "a+") as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            handle.seek(0)
+            try:
+                last = float(handle.read() or 0)
+            except ValueError:
+                last = 0.0
+            new = update(last)
+            if new is not None:
+                handle.seek(0)
+                handle.truncate()
+                handle.write(f"{new}")
+            return last, new
+
+    def _settled(self, kind):
+        """(marca anterior, marca gravada) se a última admissão do grupo foi há mais de
+        settle_seconds; None se ainda não. A verificação e a marca são atômicas entre processos."""
+        now = time.time()
+        last, new = self._admit_marks(kind, lambda last: now if now - last >= self.settle_seconds else None)
+        return (last, new) if new is not None else None
+
+    def _undo_admission(self, kind, marks):
+        """Devolve a marca anterior se a nossa ainda for a última (etapa que falhou antes de gerar carga)."""
+        previous, ours = marks
+        self._admit_marks(kind, lambda last: previous if last == ours else None)
+
+    @contextmanager
+    def slot(self, kind, sample_name=None, logger=None):
+        """Espera uma vaga do grupo `kind` com folga no nó e a mantém enquanto o bloco executa."""
+        logger = logger or logging.getLogger()
+        start = time.monotonic()
+        reason = None
+        marks = None
+        waiting_logged = False
+        while True:
+            acquired = self._try_slot(kind)
+            if acquired is not None:
+                index, handle = acquired
+                # A vaga 0 sempre entra: garante progresso mesmo com o nó ocupado por outros processos
+                if index == 0:
+                    break
+                has_headroom, reason = self.headroom(kind)
+                if has_headroom:
+                    marks = self._settled(kind)
+                    if marks is not None:
+                        break
+                    reason = "carga da admissão anterior ainda não medida"
+                handle.close()
+            else:
+                reason = f"{self.slots[kind]} vagas {kind} ocupadas"
+            if not waiting_logged:
+                logger.info(f"Etapa {kind} de {sample_name or ''} aguardando admissão ({reason})")
+                waiting_logged = True
+            time.sleep(self.poll_seconds)
+        waited = time.monotonic() - start
+        if waiting_logged:
+            logger.info(f"Etapa {kind} de {sample_name or ''} admitida após {waited:.0f}s na vaga {index}")
+        started = time.monotonic()
+        try:
+            yield index
+        except BaseException:
+            # Etapa que falhou dentro do intervalo não gerou carga: não segura as próximas admissões
+            if marks is not None and time.monotonic() - started < self.settle_seconds:
+                self._undo_admission(kind, marks)
+            raise
+        finally:
+            handle.close()
+
+    def status(self):
+        """Vagas ocupadas por grupo (testa as travas sem mantê-las)."""
+        busy = {}
+        for kind, count in self.slots.items():
+            held = []
+            for index in range(count):
+                path = self._slot_path(kind, index)
+                if not os.path.exists(path):
+                    continue
+                with open(path, "a") as handle:
+                    try:
+                        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        held.append(index)
+            busy[kind] = held
+        return busy
+
+
+def admitted(admission, stage, sample_name=None, logger=None, no_bam=False, coverage_engine="samtools"):
+    """Vaga para a etapa (ou nada, sem controle de admissão)."""
+    if admission is None:
+        return nullcontext()
+    return admission.slot(stage_kind(stage, no_bam, coverage_engine), sample_name, logger)
+
+
+def default_slots(threads=1):
+    """Vagas padrão: núcleos / threads por etapa no grupo cpu e 2 no grupo io."""
+    return max(1, (os.cpu_count() or 1) // max(1, threads)), 2
+
+
+# Execução direta: carga atual do nó e vagas ocupadas
+if __name__ == "__main__":
+    import argparse
+
+    from intermediate_storage import format_size
+
+    parser = argparse.ArgumentParser(description="Carga do nó e vagas do controle de admissão")
+    parser.add_argument("--cpu_slots", type=int, default=default_slots()[0], help="Vagas do grupo cpu")
+    parser.add_argument("--io_slots", type=int, default=default_slots()[1], help="Vagas do grupo io")
+    parser.add_argument("--directory", default=None, help="Diretório dos arquivos de vaga (padrão: temporário do nó)")
+    args = parser.parse_args()
+
+    controller = AdmissionController(args.cpu_slots, args.io_slots, args.directory)
+    load = LoadSampler().sample()
+    disk_busy = load["disk_busy_percent"]
+    print(f"CPU: {load['cpu_percent']:.0f}% | disco: "
+          f"{'indisponível' if disk_busy is None else f'{disk_busy:.0f}% ocupado'}, "
+          f"{format_size(int(load['disk_bytes_per_second']))}/s | "
+          f"memória disponível: {format_size(load['available_memory'])}")
+    for kind, held in controller.status().items():
+        print(f"Vagas {kind}: {len(held)} de {controller.slots[kind]} ocupadas")
@@ -0,0 +1,395 @@
+# dev/bam_reader.py
+import os
+import struct
+
+import numpy as np
+
+from bgzf import BgzfReader
+
+# Leitura mínima de BAM + .bai em Python/NumPy: cabeçalho, índice e posições dos reads.
+# Sequências e qualidades só são lidas no pileup de sítios pontuais (fetch_site_bases).
+
+# Campos fixos de um registro BAM (36 bytes, incluindo o block_size)
+BAM_CORE_DTYPE = np.dtype([
+    ("block_size", "<i4"), ("ref_id", "<i4"), ("pos", "<i4"),
+    ("l_read_name", "u1"), ("mapq", "u1"), ("bin", "<u2"),
+    ("n_cigar_op", "<u2"), ("flag", "<u2"), ("l_seq", "<i4"),
+    ("next_ref_id", "<i4"), ("next_pos", "<i4"), ("tlen", "<i4"),
+])
+
+# Operações do CIGAR que consomem a referência: M, D, N, =, X
+CIGAR_CONSUMES_REFERENCE = np.zeros(16, dtype=bool)
+CIGAR_CONSUMES_REFERENCE[[0, 2, 3, 7, 8]] = True
+# Operações que consomem o read: M, I, S, =, X
+CIGAR_CONSUMES_QUERY = np.zeros(16, dtype=bool)
+CIGAR_CONSUMES_QUERY[[0, 1, 4, 7, 8]] = True
+# Trechos alinhados (consomem os dois): M, =, X
+CIGAR_ALIGNED = CIGAR_CONSUMES_REFERENCE & CIGAR_CONSUMES_QUERY
+
+# Mesmos filtros padrão do samtools bedcov/depth: não mapeado, secundário, QC fail e duplicata
+DEFAULT_SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+BAI_PSEUDO_BIN = 37450
+BAI_MIN_SHIFT = 14
+
+
+def read_bam_header(bam_file):
+    """Lê o cabeçalho do BAM; retorna (texto do cabeçalho, lista de (contig, tamanho))."""
+    with BgzfReader(bam_file) as reader:
+        if reader.read(4) != b"BAM\1":
+            raise ValueError(f"Arquivo não está no formato BAM: {bam_file}")
+        l_text = struct.unpack("<i", reader.read(4))[0]
+        text = reader.read(l_text).rstrip(b"\0").decode()
+        n_ref = struct.unpack("<i", reader.read(4))[0]
+        references = []
+        for _ in range(n_ref):
+            l_name = struct.unpack("<i", reader.read(4))[0]
+            name = reader.read(l_name).rstrip(b"\0").decode()
+            length = struct.unpack("<i", reader.read(4))[0]
+            references.append((name, length))
+    return text, references
+
+
+def read_bai(bai_file):
+    """Lê um índice .bai.
+
+    Retorna uma lista (um item por contig) de dicionários com:
+    'bins' ({bin: array Nx2 de virtual offsets}), 'linear' (array de offsets
+    mínimos por janela de 16 kb), 'mapped' e 'unmapped' (contagens do pseudo-bin).
+    """
+    with open(bai_file, "rb") as handle:
+        data = handle.read()
+    if data[:4] != b"BAI\1":
+        raise ValueError(f"Arquivo não está no formato BAI: {bai_file}")
+    n_ref = struct.unpack_from("<i", data, 4)[0]
+    position = 8
+    references = []
+    for _ in range(n_ref):
+        n_bin = struct.unpack_from("<i", data, position)[0]
+        position += 4
+        bins = {}
+        mapped = unmapped = 0
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from("<Ii", data, position)
+            position += 8
+            chunks = np.frombuffer(data, dtype="<u8", count=n_chunk * 2, offset=position).reshape(n_chunk, 2)
+            position += 16 * n_chunk
+            if bin_id == BAI_PSEUDO_BIN:
+                mapped, unmapped = int(chunks[1, 0]), int(chunks[1, 1])
+            else:
+                bins[bin_id] = chunks
+        n_intv = struct.unpack_from("<i", data, position)[0]
+        position += 4
+        linear = np.frombuffer(data, dtype="<u8", count=n_intv, offset=position)
+        position += 8 * n_intv
+        references.append({"bins": bins, "linear": linear, "mapped": mapped, "unmapped": unmapped})
+    return references
+
+
+def read_bai_counts(bai_file):
+    """Só as contagens de reads mapeados e não mapeados de cada contig (pseudo-bin do .bai).
+
+    Pula os chunks sem criar arrays; é o que o `samtools idxstats` mostra, em milissegundos.
+    """
+    with open(bai_file, "rb") as handle:
+        data = handle.read()
+    if data[:4] != b"BAI\1":
+        raise ValueError(f"Arquivo não está no formato BAI: {bai_file}")
+    n_ref = struct.unpack_from("<i", data, 4)[0]
+    position = 8
+    counts = []
+    for _ in range(n_ref):
+        n_bin = struct.unpack_from("<i", data, position)[0]
+        position += 4
+        mapped = unmapped = 0
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from("<Ii", data, position)
+            if bin_id == BAI_PSEUDO_BIN:
+                mapped, unmapped = struct.unpack_from("<QQ", data, position + 24)
+            position += 8 + 16 * n_chunk
+        n_intv = struct.unpack_from("<i", data, position)[0]
+        position += 4 + 8 * n_intv
+        counts.append((mapped, unmapped))
+    return counts
+
+
+def region_to_bins(beg, end):
+    """Bins do esquema de binning do BAM que podem conter reads em [beg, end)."""
+    end -= 1
+    bins = [0]
+    for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+def query_chunks(index_ref, beg, end):
+    """Retorna (início, fim) em virtual offsets do trecho do BAM que cobre [beg, end)."""
+    linear = index_ref["linear"]
+    window = beg >> BAI_MIN_SHIFT
+    min_offset = int(linear[min(window, len(linear) - 1)]) if len(linear) else 0
+    starts, ends = [], []
+    for bin_id in region_to_bins(beg, end):
+        chunks = index_ref["bins"].get(bin_id)
+        if chunks is None:
+            continue
+        keep = chunks[:, 1] > min_offset
+        starts.append(chunks[keep, 0])
+        ends.append(chunks[keep, 1])
+    if not starts:
+        return None
+    starts = np.concatenate(starts)
+    ends = np.concatenate(ends)
+    if not len(starts):
+        return None
+    return max(int(starts.min()), min_offset), int(ends.max())
+
+
+def find_record_offsets(raw):
+    """Offsets dos registros completos de um buffer BAM descomprimido (array uint8) e bytes consumidos.
+
+    Vetorizado: as posições que passam nos testes obrigatórios de um registro
+    (byte alto do block_size e do l_seq zerado, ref_id >= -1, nome com
+    caractere imprimível terminado em NUL, block_size comportando os campos)
+    são candidatas; a cadeia de block_size a partir do offset 0 é seguida
+    entre as candidatas por saltos dobrados. Se a cadeia parar antes do fim do
+    buffer (registro de 16 MiB ou mais, por exemplo), o restante é lido um a um.
+    """
+    size = len(raw)
+    candidates = np.empty(0, dtype=np.int64)
+    if size >= 37:
+        n = size - 36
+        candidates = np.flatnonzero((raw[3:3 + n] | raw[23:23 + n]) == 0)
+        l_read_name = raw[candidates + 12].astype(np.int64)
+        first_char = raw[candidates + 36]
+        ref_high = raw[candidates + 7]
+        keep = ((l_read_name > 0) & (first_char > 32) & (first_char < 127)
+                & ((ref_high == 0) | (ref_high == 255)))
+        candidates, l_read_name = candidates[keep], l_read_name[keep]
+        name_end = candidates + 35 + l_read_name
+        keep = name_end < size
+        keep[keep] = raw[name_end[keep]] == 0
+        candidates, l_read_name = candidates[keep], l_read_name[keep]
+        fields = raw[candidates[:, None] + np.arange(24)].view("<i4")
+        block_size = fields[:, 0].astype(np.int64)
+        l_seq = fields[:, 5].astype(np.int64)
+        n_cigar = raw[candidates + 16].astype(np.int64) | (raw[candidates + 17].astype(np.int64) << 8)
+        following = candidates + 4 + block_size
+        keep = ((fields[:, 1] >= -1) & (following <= size)
+                & (block_size >= 32 + l_read_name + 4 * n_cigar + l_seq + (l_seq + 1) // 2))
+        candidates, following = candidates[keep], following[keep]
+
+    offsets, position = np.empty(0, dtype=np.int64), 0
+    if len(candidates) and candidates[0] == 0:
+        # Próxima candidata de cada uma (ou o sentinela n); alcançáveis a partir da 0 em log2(registros) passos
+        n = len(candidates)
+        target = np.searchsorted(candidates, following)
+        found = target < n
+        found[found] = candidates[target[found]] == following[found]
+        jump = np.append(np.where(found, target, n), n)
+        reached = np.zeros(n + 1, dtype=bool)
+        reached[0] = True
+        while True:
+            targets = jump[reached]
+            if reached[targets].all():
+                break
+            reached[targets] = True
+            jump = jump[jump]
+        offsets = candidates[reached[:n]]
+        position = int(following[reached[:n]][-1])
+
+    tail = []
+    while position + 4 <= size:
+        block_size = int(raw[position:position + 4].view("<i4")[0])
+        if position + 4 + block_size > size:
+            break
+        tail.append(position)
+        position += 4 + block_size
+    if tail:
+        offsets = np.concatenate([offsets, np.asarray(tail, dtype=np.int64)])
+    return offsets, position
+
+
+def decode_cigar_ops(raw, offsets, core):
+    """Operações do CIGAR de todos os registros de uma vez.
+
+    Retorna (operações uint32, índice da primeira operação de cada registro,
+    número de operações de cada registro).
+    """
+    counts = core["n_cigar_op"].astype(np.int64)
+    firsts = np.cumsum(counts) - counts
+    within = np.arange(counts.sum()) - np.repeat(firsts, counts)
+    cigar_offsets = offsets + BAM_CORE_DTYPE.itemsize + core["l_read_name"]
+    word_offsets = np.repeat(cigar_offsets, counts) + 4 * within
+    ops = raw[word_offsets[:, None] + np.arange(4)].view("<u4").ravel()
+    return ops, firsts, counts
+
+
+def parse_alignment_batch(data):
+    """Decodifica os registros completos de um buffer BAM descomprimido.
+
+    Retorna (campos fixos como array estruturado, offsets dos registros,
+    fim de referência de cada read, bytes consumidos).
+    """
+    raw = np.frombuffer(data, dtype=np.uint8)
+    offsets, position = find_record_offsets(raw)
+    if not len(offsets):
+        return np.empty(0, dtype=BAM_CORE_DTYPE), offsets, np.empty(0, dtype=np.int64), position
+
+    core = raw[offsets[:, None] + np.arange(BAM_CORE_DTYPE.itemsize)].view(BAM_CORE_DTYPE).ravel()
+
+    # Tamanho na referência: soma das operações que consomem a referência, todos os CIGARs de uma vez
+    ops, firsts, counts = decode_cigar_ops(raw, offsets, core)
+    lengths = np.where(CIGAR_CONSUMES_REFERENCE[ops & 0xf], ops >> 4, 0).astype(np.int64)
+    consumed = np.concatenate([[0], np.cumsum(lengths)])
+    reference_end = core["pos"].astype(np.int64) + consumed[firsts + counts] - consumed[firsts]
+    return core, offsets, reference_end, position
+
+
+def iter_alignment_batches(reader, index_ref, ref_id, beg, end, batch_bytes=4 * 1024 * 1024):
+    """Gera lotes decodificados (dados, campos fixos, offsets, fins) do trecho do BAM que cobre [beg, end).
+
+    Os lotes podem conter reads de fora da região; cabe a quem consome filtrar.
+    """
+    chunk_range = query_chunks(index_ref, beg, end)
+    if chunk_range is None:
+        return
+    start_offset, end_offset = chunk_range
+    reader.seek(start_offset)
+    leftover = b""
+    while True:
+        data, offset_after = reader.read_blocks(batch_bytes)
+        if not data:
+            break
+        data = leftover + data
+        core, offsets, reference_end, consumed = parse_alignment_batch(data)
+        leftover = data[consumed:]
+        if len(core):
+            yield data, core, offsets, reference_end
+            # BAM ordenado: passou do fim da região (ou do contig), não há mais reads relevantes
+            if core["ref_id"][-1] != ref_id or core["pos"][-1] >= end:
+                break
+        # Todo registro que começa antes do fim do trecho indexado já foi decodificado
+        if offset_after >= end_offset:
+            break
+
+
+def region_read_mask(core, reference_end, ref_id, beg, end, skip_flags=DEFAULT_SKIP_FLAGS, min_mapq=0):
+    """Máscara dos reads do lote que sobrepõem [beg, end) e passam nos filtros de flag e MAPQ."""
+    positions = core["pos"].astype(np.int64)
+    return ((core["ref_id"] == ref_id) & (positions < end) & (reference_end > beg)
+            & ((core["flag"] & skip_flags) == 0) & (core["mapq"] >= min_mapq))
+
+
+def fetch_read_intervals(reader, index_ref, ref_id, beg, end, skip_flags=DEFAULT_SKIP_FLAGS,
+                         min_mapq=0, batch_bytes=4 * 1024 * 1024):
+    """Gera lotes (início, fim) dos reads de `ref_id` que sobrepõem [beg, end).
+
+    `reader` é um BgzfReader aberto no BAM e `index_ref` a entrada do contig no .bai.
+    """
+    for _data, core, _offsets, reference_end in iter_alignment_batches(reader, index_ref, ref_id, beg, end,
+                                                                       batch_bytes):
+        keep = region_read_mask(core, reference_end, ref_id, beg, end, skip_flags, min_mapq)
+        if keep.any():
+            yield core["pos"][keep].astype(np.int64), reference_end[keep]
+
+
+def fetch_aligned_blocks(reader, index_ref, ref_id, beg, end, skip_flags=DEFAULT_SKIP_FLAGS,
+                         min_mapq=0, batch_bytes=4 * 1024 * 1024):
+    """Gera lotes (início, fim) dos trechos alinhados (M/=/X) dos reads de `ref_id` que sobrepõem [beg, end).
+
+    Deleções (D) e íntrons (N) ficam de fora, como no `samtools depth`. Reads com uma
+    operação só são o próprio trecho; os CIGARs dos demais são lidos de uma vez (vetorizado).
+    """
+    for data, core, offsets, reference_end in iter_alignment_batches(reader, index_ref, ref_id, beg, end,
+                                                                     batch_bytes):
+        reads = np.flatnonzero(region_read_mask(core, reference_end, ref_id, beg, end, skip_flags, min_mapq))
+        if not len(reads):
+            continue
+        positions = core["pos"][reads].astype(np.int64)
+        n_cigar = core["n_cigar_op"][reads].astype(np.int64)
+        single = n_cigar == 1
+        starts, ends = [positions[single]], [reference_end[reads][single]]
+
+        multi = np.flatnonzero(n_cigar > 1)
+        if len(multi):
+            ops, firsts, counts = decode_cigar_ops(np.frombuffer(data, dtype=np.uint8), offsets[reads[multi]],
+                                                   core[reads[multi]])
+            codes = ops & 0xf
+            lengths = np.where(CIGAR_CONSUMES_REFERENCE[codes], ops >> 4, 0).astype(np.int64)
+            # Início de cada operação na referência: posição do read + referência consumida antes dela
+            consumed = np.cumsum(lengths) - lengths
+            op_starts = np.repeat(positions[multi], counts) + consumed - np.repeat(consumed[firsts], counts)
+            aligned = CIGAR_ALIGNED[codes] & (lengths > 0)
+            starts.append(op_starts[aligned])
+            ends.append(op_starts[aligned] + lengths[aligned])
+        yield np.concatenate(starts), np.concatenate(ends)
+
+
+def reference_to_query(ops, reference_offsets):
+    """Posição no read (ou -1 em deleções/íntrons) de cada offset na referência a partir do início do read."""
+    lengths = (ops >> 4).astype(np.int64)
+    codes = ops & 0xf
+    reference_lengths = np.where(CIGAR_CONSUMES_REFERENCE[codes], lengths, 0)
+    query_lengths = np.where(CIGAR_CONSUMES_QUERY[codes], lengths, 0)
+    reference_starts = np.cumsum(reference_lengths) - reference_lengths
+    query_starts = np.cumsum(query_lengths) - query_lengths
+    # Operação que contém cada offset (as de tamanho zero na referência, como I e S, nunca são escolhidas)
+    op = np.searchsorted(reference_starts + reference_lengths, reference_offsets, side="right")
+    op = np.minimum(op, len(ops) - 1)
+    aligned = CIGAR_CONSUMES_QUERY[codes[op]] & CIGAR_CONSUMES_REFERENCE[codes[op]]
+    return np.where(aligned, query_starts[op] + reference_offsets - reference_starts[op], -1)
+
+
+def fetch_site_bases(reader, index_ref, ref_id, site_positions, skip_flags=DEFAULT_SKIP_FLAGS, min_mapq=20,
+                     min_base_quality=20, batch_bytes=4 * 1024 * 1024):
+    """Pileup em posições pontuais: gera lotes (índice do sítio, base, qualidade) dos reads de `ref_id`.
+
+    `site_positions` são posições 0-based ordenadas. As bases vêm no código de
+    4 bits do BAM (A=1, C=2, G=4, T=8); deleções e bases abaixo de
+    `min_base_quality` são descartadas.
+    """
+    sites = np.asarray(site_positions, dtype=np.int64)
+    if not len(sites):
+        return
+    beg, end = int(sites[0]), int(sites[-1]) + 1
+    for data, core, offsets, reference_end in iter_alignment_batches(reader, index_ref, ref_id, beg, end,
+                                                                     batch_bytes):
+        reads = np.flatnonzero(region_read_mask(core, reference_end, ref_id, beg, end, skip_flags, min_mapq))
+        positions = core["pos"][reads].astype(np.int64)
+        first = np.searchsorted(sites, positions, side="left")
+        counts = np.searchsorted(sites, reference_end[reads], side="left") - first
+        if not counts.sum():
+            continue
+        # Um par (read, sítio) para cada sítio coberto pelo read
+        pair_starts = np.cumsum(counts) - counts
+        pair_read = np.repeat(np.arange(len(reads)), counts)
+        pair_site = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(pair_starts, counts)
+        query = sites[pair_site] - positions[pair_read]
+
+        # CIGAR de uma operação M/=/X: a posição no read é o próprio offset; os demais são percorridos
+        # (os pares de cada read são contíguos)
+        cigar_offsets = offsets[reads] + BAM_CORE_DTYPE.itemsize + core["l_read_name"][reads]
+        n_cigar = core["n_cigar_op"][reads].astype(np.int64)
+        raw = np.frombuffer(data, dtype=np.uint8)
+        for r in np.flatnonzero((n_cigar > 1) & (counts > 0)):
+            ops = np.frombuffer(data, dtype="<u4", count=int(n_cigar[r]), offset=int(cigar_offsets[r]))
+            pairs = slice(int(pair_starts[r]), int(pair_starts[r] + counts[r]))
+            query[pairs] = reference_to_query(ops, query[pairs])
+
+        seq_offsets = cigar_offsets + 4 * n_cigar
+        l_seq = core["l_seq"][reads].astype(np.int64)
+        valid = (query >= 0) & (query < l_seq[pair_read])
+        pair_site, pair_read, query = pair_site[valid], pair_read[valid], query[valid]
+        packed = raw[seq_offsets[pair_read] + query // 2]
+        bases = np.where(query % 2 == 0, packed >> 4, packed & 0xf)
+        qualities = raw[seq_offsets[pair_read] + (l_seq[pair_read] + 1) // 2 + query]
+        good = qualities >= min_base_quality
+        yield pair_site[good], bases[good], qualities[good]
+
+
+def find_bam_index(bam_file):
+    """Localiza o .bai de um BAM (arquivo.bam.bai ou arquivo.bai)."""
+    for candidate in (f"{bam_file}.bai", f"{os.path.splitext(bam_file)[0]}.bai"):
+        if os.path.exists(candidate):
+            return candidate
+    raise FileNotFoundError(f"Índice BAI não encontrado para {bam_file}")
@@ -0,0 +1,216 @@
+# dev/benchmark_pipeline.py
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import statistics
+import time
+
+import numpy as np
+
+from convert_files import convert_cram_to_bam
+from coverage import calculate_coverage, parse_bedcov_output
+from coverage_output import write_region_coverage
+from indexing_files import index_bam_with_progress
+from metrics import StageMetrics
+from sample_processing import write_coverage_report
+from sex_inference import infer_sex
+from stage_cache import samtools_version
+from synthetic_data import default_contigs, make_dataset
+from tool_runner import run_tool_sync
+
+# Benchmark das etapas do pipeline com dados sintéticos gerados localmente.
+# Cada etapa é medida com metrics.StageMetrics em várias repetições e o
+# resultado é gravado em JSON, para comparar versões e achar regressões.
+
+FAKE_SAMTOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_samtools.py")
+
+SCALES = {
+    "small": {"autosomes": 2, "contig_length": 1_000_000, "depth": 10, "targets": 300},
+    "medium": {"autosomes": 4, "contig_length": 5_000_000, "depth": 20, "targets": 2000},
+    "large": {"autosomes": 8, "contig_length": 20_000_000, "depth": 30, "targets": 5000},
+}
+
+
+def prepare_inputs(data_dir, scale, samtools_path, fake, seed=0):
+    """Gera referência, BED e BAM sintéticos e o CRAM de entrada (cópia do BAM com o fake_samtools)."""
+    contigs = default_contigs(scale["autosomes"], scale["contig_length"],
+                              scale["contig_length"] * 3 // 4, scale["contig_length"] // 4)
+    dataset = make_dataset(data_dir, contigs, scale["depth"], scale["targets"], seed=seed)
+    cram = os.path.join(data_dir, "sintetica.cram")
+    if fake:
+        shutil.copyfile(dataset["bam"], cram)
+        shutil.copyfile(dataset["bai"], f"{cram}.crai")
+    else:
+        run_tool_sync([samtools_path, "view", "-C", "-T", dataset["reference"], "-o", cram, dataset["bam"]])
+        run_tool_sync([samtools_path, "index", cram])
+    dataset["cram"] = cram
+    return dataset
+
+
+def measure(results, stage, repeat, function, *args, **kwargs):
+    """Executa a função medindo a etapa; guarda o registro em `results` e retorna o valor."""
+    with StageMetrics(None, "benchmark", stage, repeat=repeat) as metrics:
+        value = function(*args, **kwargs)
+    results.append(metrics.record)
+    return value
+
+
+def run_benchmark(work_dir, scale_name="small", repeats=3, samtools_path="samtools", fake=False,
+                  threads=1, seed=0):
+    """Gera os dados e mede cada etapa `repeats` vezes; retorna o dicionário de resultados."""
+    scale = SCALES[scale_name]
+    data_dir = os.path.join(work_dir, "data")
+    run_dir = os.path.join(work_dir, "run")
+    os.makedirs(run_dir, exist_ok=True)
+
+    print(f"Gerando dados sintéticos ({scale_name}) em {data_dir}")
+    generation_start = time.time()
+    dataset = prepare_inputs(data_dir, scale, samtools_path, fake, seed)
+    generation_seconds = time.time() - generation_start
+
+    bam = os.path.join(run_dir, "sintetica.bam")
+    bed = dataset["bed"]
+    results = []
+    for repeat in range(repeats):
+        print(f"Repetição {repeat + 1}/{repeats}")
+        for leftover in (bam, f"{bam}.bai"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        measure(results, "convert_cram_to_bam", repeat, convert_cram_to_bam, dataset["cram"], bam,
+                samtools_path, dataset["reference"], threads=threads, show_progress=False)
+        os.remove(f"{bam}.bai")
+        measure(results, "index_bam_with_progress", repeat, index_bam_with_progress, bam, samtools_path,
+                threads=threads, show_progress=False)
+        coverage_results = measure(results, "calculate_coverage", repeat, calculate_coverage,
+                                   bam, bed, samtools_path)
+        measure(results, "calculate_coverage_numpy", repeat, calculate_coverage, bam, bed, samtools_path,
+                engine="numpy")
+        bedcov_output = run_tool_sync([samtools_path, "bedcov", bed, bam], capture_stdout=True).stdout.decode()
+        measure(results, "parse_bedcov_output", repeat, parse_bedcov_output, bedcov_output)
+        measure(results, "infer_sex", repeat, infer_sex, bam, bed, samtools_path,
+                region_coverage=coverage_results['region_coverage'], normalize=True)
+        measure(results, "infer_sex_bedcov", repeat, infer_sex, bam, bed, samtools_path)
+        measure(results, "write_coverage_report", repeat, write_coverage_report,
+                os.path.join(run_dir, "coverage_sintetica_results.txt"), coverage_results)
+        measure(results, "write_region_coverage", repeat, write_region_coverage,
+                os.path.join(run_dir, "coverage_sintetica_regions.tsv.gz"), coverage_results['region_coverage'],
+                os.path.join(run_dir, "coverage_sintetica_regions.npz"))
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "version": git_revision(),
+        "host": socket.gethostname(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "samtools": samtools_version(samtools_path),
+        "fake_samtools": fake,
+        "scale": scale_name,
+        "dataset": {**scale, "reads": dataset["reads"], "bam_bytes": os.path.getsize(dataset["bam"]),
+                    "generation_seconds": round(generation_seconds, 3)},
+        "repeats": repeats,
+        "threads": threads,
+        "summary": summarize_results(results),
+        "results": results,
+    }
+
+
+def summarize_results(results):
+    """Mínimo, mediana e máximo do tempo de relógio por etapa, mediana de CPU e pico de RSS."""
+    by_stage = {}
+    for record in results:
+        by_stage.setdefault(record["stage"], []).append(record)
+    summary = {}
+    for stage, records in by_stage.items():
+        wall = [record["wall_seconds"] for record in records]
+        cpu = [record["cpu_user_seconds"] + record["cpu_system_seconds"]
+               + record["children_cpu_user_seconds"] + record["children_cpu_system_seconds"] for record in records]
+        summary[stage] = {
+            "wall_min": min(wall),
+            "wall_median": statistics.median(wall),
+            "wall_max": max(wall),
+            "cpu_median": round(statistics.median(cpu), 3),
+            "peak_rss_bytes": max(record["peak_rss_bytes"] for record in records),
+            "peak_children_rss_bytes": max(record["peak_children_rss_bytes"] for record in records),
+        }
+    return summary
+
+
+def git_revision():
+    """Commit atual do repositório (ou None fora de um repositório git)."""
+    try:
+        result = run_tool_sync(["git", "-C", os.path.dirname(os.path.abspath(__file__)), "rev-parse", "--short",
+                                "HEAD"], capture_stdout=True, timeout=30)
+        return result.stdout.decode().strip()
+    except Exception:
+        return None
+
+
+def compare_results(current, baseline, max_regression=0.2):
+    """Compara a mediana de cada etapa com a de um resultado anterior; retorna as etapas que pioraram."""
+    regressions = []
+    print(f"{'Etapa':<26}{'Anterior (s)':>14}{'Atual (s)':>12}{'Variação':>11}")
+    for stage, stats in current["summary"].items():
+        previous = baseline["summary"].get(stage)
+        if previous is None:
+            continue
+        before, now = previous["wall_median"], stats["wall_median"]
+        change = (now - before) / before if before else 0
+        flag = ""
+        # Diferenças de poucos milissegundos são ruído
+        if change > max_regression and now - before > 0.05:
+            regressions.append(stage)
+            flag = "  <- regressão"
+        print(f"{stage:<26}{before:>14.3f}{now:>12.3f}{change:>+11.1%}{flag}")
+    return regressions
+
+
+# Execução direta
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark das etapas do pipeline com dados sintéticos")
+    parser.add_argument("--work_dir", required=True, help="Diretório para os dados gerados e as saídas")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small", help="Tamanho dos dados sintéticos")
+    parser.add_argument("--repeats", type=int, default=3, help="Repetições de cada etapa (padrão: 3)")
+    parser.add_argument("--samtools_path", default="samtools", help="Caminho para o samtools")
+    parser.add_argument("--fake_samtools", action="store_true",
+                        help="Usa o fake_samtools.py (automático se o samtools não for encontrado)")
+    parser.add_argument("--threads", type=int, default=1, help="Threads do samtools (-@)")
+    parser.add_argument("--seed", type=int, default=0, help="Semente dos dados sintéticos")
+    parser.add_argument("--output", default=None, help="Arquivo JSON de resultados (padrão: <work_dir>/benchmark.json)")
+    parser.add_argument("--compare", default=None, help="JSON de um benchmark anterior para comparação")
+    parser.add_argument("--max_regression", type=float, default=0.2,
+                        help="Piora relativa máxima da mediana antes de acusar regressão (padrão: 0.2)")
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    logging.basicConfig(filename=os.path.join(args.work_dir, "benchmark.log"), level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    samtools_path = args.samtools_path
+    fake = args.fake_samtools or shutil.which(samtools_path) is None
+    if fake:
+        print(f"Usando o substituto {FAKE_SAMTOOLS} no lugar do samtools")
+        samtools_path = FAKE_SAMTOOLS
+
+    results = run_benchmark(args.work_dir, args.scale, args.repeats, samtools_path, fake, args.threads, args.seed)
+    output = args.output or os.path.join(args.work_dir, "benchmark.json")
+    with open(output, "w") as handle:
+        json.dump(results, handle, indent=2)
+
+    print(f"\n{'Etapa':<26}{'Mín (s)':>10}{'Mediana (s)':>13}{'Máx (s)':>10}{'CPU (s)':>10}")
+    for stage, stats in results["summary"].items():
+        print(f"{stage:<26}{stats['wall_min']:>10.3f}{stats['wall_median']:>13.3f}"
+              f"{stats['wall_max']:>10.3f}{stats['cpu_median']:>10.3f}")
+    print(f"\nResultados gravados em {output}")
+
+    if args.compare:
+        with open(args.compare) as handle:
+            baseline = json.load(handle)
+        print()
+        if compare_results(results, baseline, args.max_regression):
+            exit(1)
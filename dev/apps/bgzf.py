@@ -0,0 +1,174 @@
+# dev/bgzf.py
+import os
+import struct
+import zlib
+
+# Leitura e escrita do formato BGZF (gzip em blocos) usado por BAM, BAI e tabix.
+# Posições são "virtual offsets": (offset do bloco comprimido << 16) | offset dentro do bloco.
+
+BGZF_HEADER = struct.Struct("<4BI2BH2BH")  # cabeçalho gzip + subcampo extra "BC"
+BGZF_MAX_BLOCK_DATA = 0xff00  # máximo de bytes descomprimidos por bloco (como no htslib)
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def make_virtual_offset(block_offset, within_block):
+    """Monta um virtual offset a partir do offset do bloco e do offset interno."""
+    return (block_offset << 16) | within_block
+
+
+def split_virtual_offset(virtual_offset):
+    """Separa um virtual offset em (offset do bloco, offset interno)."""
+    return virtual_offset >> 16, virtual_offset & 0xffff
+
+
+class BgzfReader:
+    """Leitor sequencial de blocos BGZF com suporte a seek por virtual offset."""
+
+    def __init__(self, path):
+        self.path = path
+        self._handle = open(path, "rb")
+        self._block_offset = 0
+        self._next_block_offset = 0
+        self._buffer = b""
+        self._within_block = 0
+
+    def close(self):
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read_block(self):
+        """Lê e descomprime o próximo bloco; retorna False no fim do arquivo."""
+        self._block_offset = self._handle.tell()
+        header = self._handle.read(BGZF_HEADER.size)
+        if len(header) < BGZF_HEADER.size:
+            self._buffer = b""
+            return False
+        id1, id2, _cm, flags, _mtime, _xfl, _os, xlen = BGZF_HEADER.unpack(header)[:8]
+        if id1 != 31 or id2 != 139 or not flags & 4:
+            raise ValueError(f"Arquivo não está no formato BGZF: {self.path}")
+        extra = header[12:] + self._handle.read(xlen - 4)
+        block_size = None
+        position = 0
+        while position < len(extra):
+            sub_id1, sub_id2, sub_len = struct.unpack_from("<BBH", extra, position)
+            if sub_id1 == 66 and sub_id2 == 67:
+                block_size = struct.unpack_from("<H", extra, position + 4)[0] + 1
+            position += 4 + sub_len
+        if block_size is None:
+            raise ValueError(f"Bloco BGZF sem subcampo BC: {self.path}")
+        remaining = self._handle.read(block_size - 12 - xlen)
+        self._buffer = zlib.decompress(remaining[:-8], -15)
+        self._within_block = 0
+        self._next_block_offset = self._handle.tell()
+        return True
+
+    def seek(self, virtual_offset):
+        """Posiciona a leitura em um virtual offset."""
+        block_offset, within_block = split_virtual_offset(virtual_offset)
+        self._handle.seek(block_offset)
+        self._read_block()
+        self._within_block = within_block
+
+    def tell(self):
+        """Retorna o virtual offset atual."""
+        if self._within_block == len(self._buffer) and self._buffer:
+            return make_virtual_offset(self._next_block_offset, 0)
+        return make_virtual_offset(self._block_offset, self._within_block)
+
+    def read(self, size):
+        """Lê `size` bytes descomprimidos (menos se o arquivo terminar)."""
+        parts = []
+        while size > 0:
+            if self._within_block >= len(self._buffer):
+                if not self._read_block():
+                    break
+                continue
+            chunk = self._buffer[self._within_block:self._within_block + size]
+            self._within_block += len(chunk)
+            size -= len(chunk)
+            parts.append(chunk)
+        return b"".join(parts)
+
+    def read_blocks(self, max_bytes):
+        """Lê blocos inteiros a partir da posição atual até somar ~`max_bytes` descomprimidos.
+
+        Retorna (dados, virtual offset do fim). Usado para decodificar registros em lote.
+        """
+        parts = [self._buffer[self._within_block:]]
+        total = len(parts[0])
+        self._within_block = len(self._buffer)
+        while total < max_bytes and self._read_block():
+            parts.append(self._buffer)
+            total += len(self._buffer)
+            self._within_block = len(self._buffer)
+        return b"".join(parts), self.tell()
+
+    def iter_blocks(self):
+        """Gera (offset do bloco no arquivo, dados descomprimidos) de cada bloco, do início ao fim."""
+        self._handle.seek(0)
+        while self._read_block():
+            self._within_block = len(self._buffer)
+            if self._buffer:
+                yield self._block_offset, self._buffer
+
+
+class BgzfWriter:
+    """Escritor BGZF que informa o virtual offset de cada posição escrita."""
+
+    def __init__(self, path, compresslevel=6):
+        self.path = path
+        self.compresslevel = compresslevel
+        self._handle = open(path, "wb")
+        self._buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def tell(self):
+        """Virtual offset da próxima posição a ser escrita."""
+        return make_virtual_offset(self._handle.tell(), len(self._buffer))
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        block_size = len(compressed) + 25 + 1
+        self._handle.write(BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2)
+                           + struct.pack("<H", block_size - 1))
+        self._handle.write(compressed)
+        self._handle.write(struct.pack("<II", zlib.crc32(data), len(data)))
+
+    def write(self, data):
+        self._buffer.extend(data)
+        while len(self._buffer) >= BGZF_MAX_BLOCK_DATA:
+            self._write_block(bytes(self._buffer[:BGZF_MAX_BLOCK_DATA]))
+            del self._buffer[:BGZF_MAX_BLOCK_DATA]
+
+    def flush_block(self):
+        """Fecha o bloco atual (o próximo registro começa em um bloco novo)."""
+        if self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer.clear()
+
+    def close(self):
+        if self._handle.closed:
+            return
+        self.flush_block()
+        self._handle.write(BGZF_EOF)
+        self._handle.close()
+
+
+def is_bgzf(path):
+    """Verifica se o arquivo começa com um cabeçalho BGZF."""
+    if not os.path.exists(path):
+        return False
+    with open(path, "rb") as handle:
+        header = handle.read(BGZF_HEADER.size)
+    return len(header) == BGZF_HEADER.size and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
@@ -0,0 +1,270 @@
+# dev/binned_depth.py
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from bam_reader import fetch_aligned_blocks, find_bam_index, read_bai, read_bam_header
+from bgzf import BgzfReader
+from depth_stream import stream_depth
+from target_index import normalize_contig_name
+
+# Resumo da profundidade em janelas fixas (estilo mosdepth) de todo o genoma, por
+# amostra: para cada janela de `bin_size` bases, a soma da profundidade e quantas
+# bases atingem cada limiar. Só as janelas com reads são gravadas (esparso), em
+# reports/<amostra>/depth_bins_<amostra>.npz. Depois a cobertura de qualquer
+# lista de intervalos (ex.: genes pedidos após a corrida) sai desse arquivo em
+# milissegundos, sem o BAM. Dentro de uma janela a profundidade é considerada
+# uniforme: intervalos que cortam janelas ao meio recebem a fração proporcional.
+
+DEFAULT_BIN_SIZE = 100
+DEFAULT_BIN_THRESHOLDS = (10, 20, 30)
+WINDOW_BASES = 4_000_000  # trecho do contig com profundidade por base em memória (leitura do BAM)
+BINS_VERSION = 1
+
+
+def narrowest_unsigned(values):
+    """`values` em uint32 quando cabem (o caso comum), senão em uint64."""
+    if not len(values) or int(values.max()) <= np.iinfo(np.uint32).max:
+        return values.astype(np.uint32)
+    return values.astype(np.uint64)
+
+
+class DepthBins:
+    """Somas de profundidade e bases acima dos limiares por janela, por contig."""
+
+    def __init__(self, bin_size=DEFAULT_BIN_SIZE, thresholds=DEFAULT_BIN_THRESHOLDS):
+        if bin_size < 1:
+            raise ValueError("bin_size deve ser maior ou igual a 1")
+        self.bin_size = bin_size
+        # Bases acima de cada limiar por janela: cabem em uint16 até janelas de 65535 pb
+        self.count_dtype = np.uint16 if bin_size <= np.iinfo(np.uint16).max else np.uint32
+        self.thresholds = tuple(thresholds)
+        self.chrom_names = []
+        self.sums = []
+        self.at_least = []
+
+    def contig(self, name, length=0):
+        """Código do contig (criado com arrays para `length` bases, que crescem se preciso)."""
+        if name in self.chrom_names:
+            return self.chrom_names.index(name)
+        n_bins = -(-length // self.bin_size)
+        self.chrom_names.append(name)
+        self.sums.append(np.zeros(n_bins, dtype=np.uint64))
+        self.at_least.append(np.zeros((len(self.thresholds), n_bins), dtype=self.count_dtype))
+        return len(self.chrom_names) - 1
+
+    def _ensure(self, code, n_bins):
+        if len(self.sums[code]) < n_bins:
+            grow = max(n_bins, 2 * len(self.sums[code]))
+            sums = np.zeros(grow, dtype=np.uint64)
+            sums[:len(self.sums[code])] = self.sums[code]
+            at_least = np.zeros((len(self.thresholds), grow), dtype=self.count_dtype)
+            at_least[:, :self.at_least[code].shape[1]] = self.at_least[code]
+            self.sums[code], self.at_least[code] = sums, at_least
+
+    def add_dense(self, code, first_position, depth):
+        """Soma a profundidade por base de um trecho que começa em `first_position` (múltiplo de bin_size)."""
+        n_bins = -(-len(depth) // self.bin_size)
+        padded = np.zeros(n_bins * self.bin_size, dtype=depth.dtype)
+        padded[:len(depth)] = depth
+        first_bin = first_position // self.bin_size
+        self._ensure(code, first_bin + n_bins)
+        blocks = padded.reshape(n_bins, self.bin_size)
+        self.sums[code][first_bin:first_bin + n_bins] += blocks.sum(axis=1, dtype=np.uint64)
+        for t, threshold in enumerate(self.thresholds):
+            self.at_least[code][t, first_bin:first_bin + n_bins] += (blocks >= threshold).sum(axis=1, dtype=self.count_dtype)
+
+    def feed(self, chrom_names, codes, positions, depths):
+        """Consumidor do depth_stream (samtools depth): lote de (códigos, posições 0-based, profundidades)."""
+        change = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1], [True])))
+        for first, last in zip(change[:-1], change[1:]):
+            code = self.contig(chrom_names[codes[first]])
+            bins = positions[first:last] // self.bin_size
+            first_bin = int(bins.min())
+            local = bins - first_bin
+            n_bins = int(local.max()) + 1
+            self._ensure(code, first_bin + n_bins)
+            self.sums[code][first_bin:first_bin + n_bins] += np.bincount(
+                local, weights=depths[first:last], minlength=n_bins).astype(np.uint64)
+            for t, threshold in enumerate(self.thresholds):
+                self.at_least[code][t, first_bin:first_bin + n_bins] += np.bincount(
+                    local, weights=depths[first:last] >= threshold, minlength=n_bins).astype(self.count_dtype)
+
+    def save(self, path):
+        """Grava só as janelas com profundidade (npz compactado), de forma atômica."""
+        offsets, bin_ids, sums, at_least = [0], [], [], []
+        for code in range(len(self.chrom_names)):
+            covered = np.flatnonzero(self.sums[code])
+            bin_ids.append(covered.astype(np.uint32))
+            sums.append(self.sums[code][covered])
+            at_least.append(self.at_least[code][:, covered])
+            offsets.append(offsets[-1] + len(covered))
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".npz.tmp")
+        with os.fdopen(fd, "wb") as handle:
+            np.savez_compressed(
+                handle, version=BINS_VERSION, bin_size=self.bin_size, thresholds=np.asarray(self.thresholds),
+                chrom_names=np.asarray(self.chrom_names, dtype=str), offsets=np.asarray(offsets, dtype=np.int64),
+                bin_ids=np.concatenate(bin_ids) if bin_ids else np.zeros(0, dtype=np.uint32),
+                sums=narrowest_unsigned(np.concatenate(sums) if sums else np.zeros(0, dtype=np.uint64)),
+                at_least=(np.concatenate(at_least, axis=1) if at_least
+                          else np.zeros((len(self.thresholds), 0), dtype=self.count_dtype)))
+        os.replace(temp_path, path)
+        return path
+
+
+def bin_contig_reads(bam_file, index_ref, ref_id, length, depth_bins, code):
+    """Profundidade por base de um contig, em trechos de WINDOW_BASES, somada nas janelas.
+    Só os trechos alinhados contam (sem deleções nem íntrons), como no `samtools depth`."""
+    window = WINDOW_BASES - WINDOW_BASES % depth_bins.bin_size
+    with BgzfReader(bam_file) as reader:
+        for first in range(0, length, window):
+            last = min(first + window, length)
+            read_starts, read_ends = [], []
+            for starts, ends in fetch_aligned_blocks(reader, index_ref, ref_id, first, last):
+                read_starts.append(starts)
+                read_ends.append(ends)
+            if not read_starts:
+                continue
+            span = last - first
+            change = np.bincount(np.clip(np.concatenate(read_starts) - first, 0, span), minlength=span + 1)
+            change -= np.bincount(np.clip(np.concatenate(read_ends) - first, 0, span), minlength=span + 1)
+            depth_bins.add_dense(code, first, np.cumsum(change[:-1]))
+
+
+def calculate_depth_bins(alignment_file, samtools_path="samtools", ref_fasta=None, index_file=None,
+                         bin_size=DEFAULT_BIN_SIZE, thresholds=DEFAULT_BIN_THRESHOLDS, threads=1):
+    """Resumo em janelas de todo o genoma.
+
+    BAM: lido em processo pelo .bai, um contig por thread. CRAM: `samtools depth`
+    (só posições com reads) em fluxo, com DepthBins como consumidor.
+    """
+    depth_bins = DepthBins(bin_size, thresholds)
+    if alignment_file.endswith(".bam"):
+        _, references = read_bam_header(alignment_file)
+        index = read_bai(index_file or find_bam_index(alignment_file))
+        # Arrays de todos os contigs criados antes das threads (cada thread só escreve no seu)
+        codes = [depth_bins.contig(name, length) for name, length in references]
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+            futures = [pool.submit(bin_contig_reads, alignment_file, index[ref_id], ref_id, length, depth_bins,
+                                   codes[ref_id])
+                       for ref_id, (_name, length) in enumerate(references) if len(index[ref_id]["bins"])]
+            for future in futures:
+                future.result()
+    else:
+        stream_depth(alignment_file, None, [depth_bins], samtools_path, ref_fasta, index_file)
+    return depth_bins
+
+
+class DepthBinsQuery:
+    """Consulta de intervalos em um depth_bins_<amostra>.npz (carregado uma vez)."""
+
+    def __init__(self, path):
+        with np.load(path) as data:
+            if int(data["version"]) != BINS_VERSION:
+                raise ValueError(f"Versão de resumo em janelas incompatível: {path}")
+            self.bin_size = int(data["bin_size"])
+            self.thresholds = data["thresholds"].tolist()
+            self.chrom_names = data["chrom_names"].tolist()
+            offsets = data["offsets"]
+            bin_ids, sums, at_least = data["bin_ids"].astype(np.int64), data["sums"], data["at_least"]
+        self.path = path
+        self._contigs = {}
+        for code, name in enumerate(self.chrom_names):
+            rows = slice(offsets[code], offsets[code + 1])
+            # Somas acumuladas (com zero à frente) para a integral até qualquer janela
+            values = np.vstack((sums[rows], at_least[:, rows])).astype(np.float64)
+            self._contigs[name] = (bin_ids[rows], values,
+                                   np.concatenate((np.zeros((len(values), 1)), np.cumsum(values, axis=1)), axis=1))
+
+    def _integral(self, name, positions):
+        """Integral (soma da profundidade e das bases >= limiar) de 0 até cada posição."""
+        bin_ids, values, cumulative = self._contigs[name]
+        bins = positions // self.bin_size
+        index = np.searchsorted(bin_ids, bins)
+        inside = index < len(bin_ids)
+        partial = np.zeros((len(values), len(positions)))
+        hit = inside & (bin_ids[np.minimum(index, len(bin_ids) - 1)] == bins) if len(bin_ids) else inside
+        fraction = (positions - bins * self.bin_size) / self.bin_size
+        partial[:, hit] = values[:, index[hit]] * fraction[hit]
+        return cumulative[:, index] + partial
+
+    def query(self, chroms, starts, ends):
+        """Profundidade média e % de bases >= cada limiar de cada intervalo [início, fim).
+
+        Retorna um dicionário com arrays 'mean_depth' e 'percent_at_least_<N>x'.
+        """
+        chroms = list(chroms)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        totals = np.zeros((1 + len(self.thresholds), len(chroms)))
+        known = set(self.chrom_names)
+        rows_by_contig = {}
+        for row, chrom in enumerate(chroms):
+            name = normalize_contig_name(chrom, known)
+            if name is None:
+                logging.warning(f"Contig {chrom} não existe no resumo {self.path}; profundidade 0")
+                continue
+            rows_by_contig.setdefault(name, []).append(row)
+        for name, rows in rows_by_contig.items():
+            rows = np.asarray(rows)
+            totals[:, rows] = self._integral(name, ends[rows]) - self._integral(name, starts[rows])
+        lengths = np.maximum(ends - starts, 1)
+        result = {"mean_depth": totals[0] / lengths}
+        for t, threshold in enumerate(self.thresholds):
+            result[f"percent_at_least_{threshold}x"] = totals[1 + t] / lengths * 100
+        return result
+
+
+def read_intervals(bed_file):
+    """(cromossomos, inícios, fins, nomes) de um BED de consulta (4ª coluna opcional, ex.: gene)."""
+    chroms, starts, ends, names = [], [], [], []
+    with open(bed_file) as handle:
+        for line in handle:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            chroms.append(fields[0])
+            starts.append(int(fields[1]))
+            ends.append(int(fields[2]))
+            names.append(fields[3] if len(fields) > 3 else "")
+    return chroms, np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64), names
+
+
+# Execução direta: cobertura de uma lista de intervalos a partir dos resumos, sem BAM
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Cobertura de intervalos a partir dos resumos em janelas (sem BAM)")
+    parser.add_argument("bins", nargs="+", help="Arquivos depth_bins_<amostra>.npz")
+    parser.add_argument("--bed", required=True, help="BED com os intervalos (4ª coluna opcional: nome do gene)")
+    parser.add_argument("--output", default=None, help="Grava o resultado em TSV (padrão: tela)")
+    args = parser.parse_args()
+
+    chroms, starts, ends, names = read_intervals(args.bed)
+    start_time = time.perf_counter()
+    lines = []
+    for bins_file in args.bins:
+        sample = os.path.basename(bins_file).removeprefix("depth_bins_").removesuffix(".npz")
+        result = DepthBinsQuery(bins_file).query(chroms, starts, ends)
+        columns = [key for key in result if key != "mean_depth"]
+        for i in range(len(chroms)):
+            values = "\t".join(f"{result[key][i]:.1f}" for key in columns)
+            lines.append(f"{sample}\t{chroms[i]}\t{starts[i]}\t{ends[i]}\t{names[i]}\t"
+                         f"{result['mean_depth'][i]:.2f}\t{values}\n")
+    elapsed = time.perf_counter() - start_time
+    header = "Amostra\tCromossomo\tInício\tFim\tNome\tProfundidade média\t" + "\t".join(
+        f"% >= {key.removeprefix('percent_at_least_')}" for key in columns) + "\n"
+    if args.output:
+        with open(args.output, "w") as handle:
+            handle.write(header)
+            handle.writelines(lines)
+        print(f"{len(lines)} linhas gravadas em {args.output} ({elapsed * 1000:.1f} ms)")
+    else:
+        print(header, end="")
+        print("".join(lines), end="")
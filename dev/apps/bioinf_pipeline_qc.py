@@ -1,12 +1,17 @@
 import argparse
+import json
 import logging
 import os
 import glob
+import time
 import argparse 
-from tqdm import tqdm
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import nullcontext
 
 from dotenv import load_dotenv
-from sample_processing import process_one_sample
+
+# Os módulos do processamento (numpy, tqdm, psutil...) são importados dentro de
+# main, para que --help e --dry_run respondam sem carregá-los.
 
 # diretório do arquivo atual
 diretorio_arquivo = os.path.dirname(os.path.abspath(__file__))
@@ -23,9 +28,87 @@ def setup_logging(log_file):
                         format='%(asctime)s - %(levelname)s - %(message)s')
 
 
+def default_threads(jobs):
+    """Divide os núcleos disponíveis entre as amostras processadas em paralelo."""
+    return max(1, (os.cpu_count() or 1) // max(1, jobs))
+
+
+def describe_plan(cram_dir, bed_file, output_dir, intermediate_dir, jobs=1, threads=None,
+                  use_cache=True, no_plots=False):
+    """Mostra o que seria feito (amostras, BAMs existentes e etapas em cache) sem processar nada."""
+    cram_files = sorted(glob.glob(os.path.join(cram_dir, "*.cram")))
+    print(f"BED: {bed_file}{'' if os.path.exists(bed_file) else ' (não encontrado)'}")
+    print(f"Saída: {output_dir} | Intermediários: {intermediate_dir}")
+    jobs = max(1, min(jobs, len(cram_files) or 1))
+    print(f"{len(cram_files)} amostra(s) em {cram_dir}, {jobs} processo(s) e "
+          f"{threads or default_threads(jobs)} thread(s) do samtools por amostra")
+    for cram_file in cram_files:
+        sample_name = os.path.splitext(os.path.basename(cram_file))[0]
+        bam_file = os.path.join(intermediate_dir, "bam_files", f"{sample_name}.bam")
+        stages = []
+        manifest_path = os.path.join(intermediate_dir, "manifests", f"{sample_name}.json")
+        if use_cache and os.path.exists(manifest_path):
+            with open(manifest_path) as handle:
+                stages = sorted(json.load(handle).get("stages", {}))
+        print(f"  {sample_name}: BAM {'existente' if os.path.exists(bam_file) else 'a gerar'}; "
+              f"etapas no cache: {', '.join(stages) or 'nenhuma'}")
+    if no_plots:
+        print("Gráficos desligados (--no_plots): só os histogramas .npz serão gravados")
+    return cram_files
+
+
 def main(cram_dir, bed_file, output_dir, intermediate_dir,
-         samtools_path="samtools", bcftools_path="bcftools", ref_fasta=None):
-    """Executa o pipeline de controle de qualidade para múltiplos arquivos."""
+         samtools_path="samtools", bcftools_path="bcftools", ref_fasta=None,
+         jobs=1, threads=None, no_bam=False, crai_dir=None, compression_level=None,
+         coverage_engine="samtools", normalize_sex=False, per_base=False, raw_bed=False,
+         use_cache=True, coverage_shards=1, shard_mode="balanced", no_plots=False, sex_mode="coverage",
+         sex_thresholds=None, panel_vcf=None, panel_vcf_dir=None,
+         tabix_path="tabix", queue_dir=None, lease_seconds=300, bam_budget=None,
+         columnar=False, depth_bins=False, bin_size=100, quantize=None,
+         admission=False, cpu_slots=None, io_slots=None, min_free_memory=None):
+    """Executa o pipeline de controle de qualidade para múltiplos arquivos.
+
+    Com jobs > 1 as amostras são processadas em um pool de processos, cada uma
+    com `threads` threads do samtools (-@). Uma amostra com erro não interrompe
+    as demais; retorna a lista de arquivos CRAM que falharam. Com no_bam,
+    cobertura e sexo são calculados direto dos CRAMs (índices em crai_dir).
+    O BED é pré-processado uma vez (validado, ordenado, unido e com contigs
+    normalizados pelo .fai) e reaproveitado de intermediate/target_index,
+    a menos que raw_bed seja usado. coverage_shards > 1 calcula a cobertura de
+    cada amostra em partes paralelas (útil para uma amostra urgente).
+    Os PNGs dos histogramas são desenhados no fim, em lote e em processos
+    separados (plots.render_histograms), a menos que no_plots seja usado.
+    sex_mode="index" infere o sexo pelas contagens do índice (limiares em
+    sex_thresholds), com a cobertura só para os casos inconclusivos.
+    Com panel_vcf, os SNPs do painel dentro dos alvos são extraídos uma vez
+    (cache em intermediate/panel_sites) e a contaminação de cada amostra é estimada.
+    Com panel_vcf_dir (VCFs por cromossomo), o painel é montado uma vez para a
+    coorte em intermediate/verify_bam_id_map e usado como panel_vcf.
+    Com queue_dir (em disco compartilhado), as amostras são reivindicadas por
+    concessões renovadas a cada lease_seconds / 5 (work_queue.WorkQueue): vários
+    nós rodando o mesmo lote dividem as amostras, e as de um nó que caiu são
+    retomadas quando a concessão vence. Retorna só as falhas deste nó.
+    bam_budget (bytes) limita o espaço dos BAMs intermediários: BAMs sem etapas
+    pendentes são removidos (LRU) e novas conversões esperam por espaço. As reservas
+    são renovadas como as concessões; as de um nó que caiu vencem após lease_seconds.
+    columnar grava a cobertura por região também em .npz, ao lado do TSV BGZF indexado.
+    depth_bins grava, por amostra, a profundidade de todo o genoma em janelas de
+    bin_size bases, para consultar qualquer lista de intervalos depois sem o BAM.
+    quantize (limiares crescentes) grava os alvos em trechos por classe de
+    profundidade (BED), na mesma passagem do samtools depth de per_base.
+    Com admission, cada etapa que lê alinhamentos espera uma vaga do seu grupo
+    (cpu_slots para decodificação, io_slots para indexação/bedcov/depth) e folga
+    medida de CPU, disco e memória (min_free_memory bytes) no nó; jobs passa a ser
+    só o número de amostras em andamento.
+    """
+    from tqdm import tqdm
+    from metrics import StageMetrics
+    from plots import render_histograms
+    from sample_processing import process_one_sample
+    from target_index import load_target_index
+    from contamination import load_panel_sites
+    from panel_map_create import prepare_verifybamid_panel
+
     log_file = f'{output_dir}{os.sep}logs{os.sep}pipeline.log'
     os.makedirs(os.path.dirname(log_file), exist_ok=True)
     setup_logging(log_file)
@@ -51,16 +134,153 @@ def main(cram_dir, bed_file, output_dir, intermediate_dir,
         logging.error(f"Nenhum arquivo CRAM encontrado em: {cram_dir}")
         raise FileNotFoundError(f"Nenhum arquivo CRAM encontrado em: {cram_dir}")
 
-    for cram_file in tqdm(cram_files, desc="Processando amostras", unit="amostra", colour='blue'):
-        try: 
-            # verificar antes se o arquivo cram já foi processado 
-            process_one_sample(cram_file, bed_file, output_dir, intermediate_dir,
-                               samtools_path, bcftools_path, ref_fasta)
-        except Exception as e:
-            logging.error(f"Erro ao processar a amostra {cram_file}: {e}")
-            raise
+    jobs = max(1, min(jobs, len(cram_files)))
+    if threads is None:
+        threads = default_threads(jobs)
+    logging.info(f"Processando {len(cram_files)} amostras com {jobs} processo(s) e {threads} thread(s) do samtools por amostra")
+
+    if no_bam and not ref_fasta:
+        logging.warning("Modo sem BAM sem --ref_fasta: o samtools tentará obter a referência pelo cabeçalho do CRAM")
+    target_index = None
+    if not raw_bed:
+        target_index = load_target_index(bed_file, intermediate_dir, ref_fasta)
+
+    if panel_vcf_dir and not panel_vcf:
+        # Painel da coorte: filtrado pelos alvos uma única vez, nunca por amostra
+        panel_vcf = prepare_verifybamid_panel(panel_vcf_dir, os.path.join(intermediate_dir, "verify_bam_id_map"),
+                                              target_index=target_index, bed_file=bed_file,
+                                              bcftools_path=bcftools_path, tabix_path=tabix_path)
+
+    panel_sites = None
+    if panel_vcf:
+        if not os.path.exists(panel_vcf):
+            logging.error(f"Painel VCF não encontrado: {panel_vcf}")
+            raise FileNotFoundError(f"Painel VCF não encontrado: {panel_vcf}")
+        panel_sites = load_panel_sites(panel_vcf, intermediate_dir, target_index, bed_file)
+
+    storage = None
+    if bam_budget and not no_bam:
+        from intermediate_storage import IntermediateStorage, format_size
+        # Reservas de outro nó expiram com a mesma duração das concessões da fila
+        storage = IntermediateStorage(os.path.join(intermediate_dir, "bam_files"), bam_budget,
+                                      pin_ttl=lease_seconds)
+        logging.info(f"Orçamento de BAMs intermediários: {format_size(bam_budget)}")
 
+    admission_controller = None
+    if admission:
+        from admission import AdmissionController, default_slots, MIN_FREE_MEMORY
+        default_cpu, default_io = default_slots(threads)
+        admission_controller = AdmissionController(cpu_slots or default_cpu, io_slots or default_io,
+                                                   min_free_memory=min_free_memory or MIN_FREE_MEMORY)
+        logging.info(f"Controle de admissão: {admission_controller.slots['cpu']} vagas cpu, "
+                     f"{admission_controller.slots['io']} vagas io ({admission_controller.directory})")
+
+    sample_options = dict(threads=threads, no_bam=no_bam, crai_dir=crai_dir,
+                          compression_level=compression_level, coverage_engine=coverage_engine,
+                          normalize_sex=normalize_sex, per_base=per_base,
+                          target_index=target_index, use_cache=use_cache,
+                          coverage_shards=coverage_shards, shard_mode=shard_mode,
+                          sex_mode=sex_mode, sex_thresholds=sex_thresholds, panel_sites=panel_sites,
+                          storage=storage, columnar=columnar, depth_bins=depth_bins, bin_size=bin_size,
+                          quantize=quantize, admission=admission_controller)
+
+    # Modo fila: cada amostra é reivindicada por concessão no diretório compartilhado,
+    # para que vários nós drenem o mesmo lote sem repetir amostras
+    samples = {os.path.splitext(os.path.basename(cram_file))[0]: cram_file for cram_file in cram_files}
+    work_queue = None
+    if queue_dir:
+        from work_queue import WorkQueue, POLL_SECONDS
+        work_queue = WorkQueue(queue_dir, lease_seconds)
+        logging.info(f"Modo fila em {queue_dir} (trabalhador {work_queue.token})")
+    pending = list(cram_files)
+
+    def next_sample(busy):
+        """Próxima amostra a processar; no modo fila espera concessões de outros nós
+        (que podem vencer) enquanto houver amostras inacabadas e nada em andamento."""
+        if work_queue is None:
+            return pending.pop(0) if pending else None
+        while True:
+            name = work_queue.claim_next(list(samples))
+            if name is not None:
+                return samples[name]
+            if busy or not work_queue.unfinished(list(samples)):
+                return None
+            time.sleep(min(POLL_SECONDS, work_queue.lease_seconds / 2))
+
+    def finish_sample(cram_file, error=None):
+        if error is not None:
+            logging.error(f"Erro ao processar a amostra {cram_file}: {error}")
+            failed.append(cram_file)
+        name = os.path.splitext(os.path.basename(cram_file))[0]
+        if storage is not None:
+            # Solta o BAM também quando a amostra falhou no meio das etapas
+            storage.release(name)
+        if work_queue is not None:
+            if error is None:
+                work_queue.mark_done(name)
+            else:
+                work_queue.mark_failed(name, error)
+        progress.update(1)
+
+    failed = []
+    histograms = []
+    initial = len(cram_files) - len(work_queue.unfinished(list(samples))) if work_queue else 0
+    progress = tqdm(total=len(cram_files), initial=initial, desc="Processando amostras", unit="amostra",
+                    colour='blue')
+
+    with (work_queue.heartbeat() if work_queue else nullcontext(),
+          storage.heartbeat() if storage else nullcontext()):
+        if jobs == 1:
+            while True:
+                cram_file = next_sample(busy=False)
+                if cram_file is None:
+                    break
+                try:
+                    histograms.append(process_one_sample(cram_file, bed_file, output_dir, intermediate_dir,
+                                                         samtools_path, bcftools_path, ref_fasta,
+                                                         **sample_options))
+                    finish_sample(cram_file)
+                except Exception as e:
+                    finish_sample(cram_file, e)
+        else:
+            # Cada processo configura o log do pipeline (necessário quando o método de início é 'spawn')
+            with ProcessPoolExecutor(max_workers=jobs, initializer=setup_logging,
+                                     initargs=(log_file,)) as executor:
+                # No máximo `jobs` amostras em andamento (no modo fila, só essas têm concessão)
+                futures = {}
+                while True:
+                    while len(futures) < jobs:
+                        cram_file = next_sample(busy=bool(futures))
+                        if cram_file is None:
+                            break
+                        futures[executor.submit(process_one_sample, cram_file, bed_file, output_dir,
+                                                intermediate_dir, samtools_path, bcftools_path, ref_fasta,
+                                                show_progress=False, **sample_options)] = cram_file
+                    if not futures:
+                        break
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        cram_file = futures.pop(future)
+                        try:
+                            histograms.append(future.result())
+                            finish_sample(cram_file)
+                        except Exception as e:
+                            tqdm.write(f"Erro ao processar a amostra {cram_file}: {e}")
+                            finish_sample(cram_file, e)
+    progress.close()
+
+    if histograms and not no_plots:
+        print(f"Desenhando {len(histograms)} histograma(s) de cobertura")
+        with StageMetrics(os.path.join(output_dir, "logs", "metrics.jsonl"), None, "plots",
+                          samples=len(histograms)):
+            plot_failures = render_histograms(histograms, workers=jobs)
+        if plot_failures:
+            logging.error(f"{len(plot_failures)} histograma(s) não foram desenhados: {', '.join(plot_failures)}")
+
+    if failed:
+        logging.error(f"{len(failed)} de {len(cram_files)} amostras falharam: {', '.join(failed)}")
     logging.info("Pipeline de controle de qualidade para múltiplos arquivos concluído")
+    return failed
 
 
 
@@ -87,6 +307,81 @@ if __name__ == "__main__":
     parser.add_argument("--ref_fasta",
                         default=f'{project_dir}data{os.sep}input{os.sep}ref_gen_files{os.sep}{os.getenv("REF_GEN_FILE_NAME")}',
                         help="Caminho para o arquivo FASTA do genoma de referência (opcional)")
+    parser.add_argument("--no_bam", action="store_true",
+                        help="Calcula cobertura e sexo direto do CRAM (+ .crai), sem gerar o BAM intermediário")
+    parser.add_argument("--crai_dir",
+                        default=f'{project_dir}data{os.sep}input{os.sep}crai_files',
+                        help="Diretório contendo os arquivos CRAI (usado com --no_bam)")
+    parser.add_argument("--compression_level", type=int, choices=range(0, 10), default=None,
+                        help="Nível de compressão (0-9) do BAM intermediário (padrão: o do samtools)")
+    parser.add_argument("--coverage_engine", choices=["samtools", "numpy"], default="samtools",
+                        help="Cálculo de cobertura: samtools bedcov ou motor NumPy em processo sobre o BAM indexado")
+    parser.add_argument("--coverage_shards", type=int, default=1,
+                        help="Divide os alvos em N partes com cobertura calculada em paralelo (padrão: 1)")
+    parser.add_argument("--shard_mode", choices=["balanced", "contig"], default="balanced",
+                        help="Divisão dos alvos: partes com total de bases equilibrado ou contigs inteiros")
+    parser.add_argument("--normalize_sex", action="store_true",
+                        help="Normaliza a cobertura de X e Y pela média dos autossomos na inferência de sexo")
+    parser.add_argument("--sex_mode", choices=["coverage", "index"], default="coverage",
+                        help="Sexo pela cobertura de X/Y ou pelas contagens de reads do índice (.bai/idxstats), "
+                             "com a cobertura só nos casos inconclusivos")
+    parser.add_argument("--sex_x_ratio", type=float, default=0.75,
+                        help="Modo index: razão X/autossomos mínima para feminino e máxima para masculino (padrão: 0.75)")
+    parser.add_argument("--sex_y_ratio", type=float, default=0.1,
+                        help="Modo index: razão Y/autossomos mínima para masculino (padrão: 0.1)")
+    parser.add_argument("--sex_y_female_ratio", type=float, default=0.05,
+                        help="Modo index: razão Y/autossomos máxima para feminino (padrão: 0.05)")
+    parser.add_argument("--panel_vcf", default=None,
+                        help="VCF (.vcf.gz) de SNPs com AF para estimar a contaminação (FREEMIX) de cada amostra")
+    parser.add_argument("--panel_vcf_dir", default=None,
+                        help="Diretório com VCFs por cromossomo (ex.: data/input/vcfs_separated_files); "
+                             "monta o painel uma vez para a coorte, só com SNPs nos alvos")
+    parser.add_argument("--tabix_path", default="tabix", help="Caminho para o tabix (painel de --panel_vcf_dir)")
+    parser.add_argument("--queue", action="store_true",
+                        help="Modo fila para vários nós no mesmo disco compartilhado: cada amostra é reivindicada "
+                             "por uma concessão (intermediate/queue/<lote>) e nunca processada duas vezes")
+    parser.add_argument("--queue_dir", default=None,
+                        help="Diretório da fila (implica --queue; use quando os nós montam o disco em caminhos diferentes)")
+    parser.add_argument("--lease_seconds", type=float, default=300,
+                        help="Modo fila: segundos sem renovação até a amostra de um nó parado ser retomada (padrão: 300)")
+    parser.add_argument("--bam_budget", default=None,
+                        help="Espaço máximo dos BAMs intermediários (ex.: 500G): remove BAMs já usados (LRU) "
+                             "e segura novas conversões até haver espaço")
+    parser.add_argument("--columnar", action="store_true",
+                        help="Grava a cobertura por região também em binário colunar (.npz), além do TSV BGZF indexado")
+    parser.add_argument("--depth_bins", action="store_true",
+                        help="Grava a profundidade de todo o genoma em janelas (depth_bins_<amostra>.npz) "
+                             "para consultar genes/intervalos depois sem o BAM (binned_depth.py)")
+    parser.add_argument("--bin_size", type=int, default=100,
+                        help="Tamanho das janelas de --depth_bins em pares de base (padrão: 100)")
+    parser.add_argument("--quantize", nargs="?", const="1,10,30", default=None,
+                        help="Grava os alvos em trechos por classe de profundidade (quantized_<amostra>.bed); "
+                             "limiares separados por vírgula (padrão: 1,10,30 -> 0, 1-9, 10-29, 30+)")
+    parser.add_argument("--admission", action="store_true",
+                        help="Admite cada etapa pela carga do nó (CPU, memória e disco via psutil), com vagas "
+                             "separadas para etapas de CPU e de I/O; use --jobs maior que as vagas")
+    parser.add_argument("--cpu_slots", type=int, default=None,
+                        help="Vagas para etapas de CPU (decodificação de CRAM) (padrão: núcleos / threads)")
+    parser.add_argument("--io_slots", type=int, default=None,
+                        help="Vagas para etapas de I/O (index, bedcov, depth sobre o BAM) (padrão: 2)")
+    parser.add_argument("--min_free_memory", default=None,
+                        help="Memória disponível mínima para admitir uma etapa (ex.: 4G; padrão: 2G)")
+    parser.add_argument("--per_base", action="store_true",
+                        help="Calcula a distribuição exata da profundidade por base (samtools depth) com memória fixa")
+    parser.add_argument("--raw_bed", action="store_true",
+                        help="Usa o BED como está, sem o pré-processamento em cache (ordenar, unir alvos e normalizar "
+                             "contigs). Por padrão alvos sobrepostos ou adjacentes são unidos e os relatórios por "
+                             "região trazem uma linha por bloco unido, não por linha do BED")
+    parser.add_argument("--no_plots", action="store_true",
+                        help="Não desenha os PNGs (os histogramas ficam em .npz; desenhe depois com plots.py)")
+    parser.add_argument("--dry_run", action="store_true",
+                        help="Só mostra as amostras e as etapas em cache, sem processar nada")
+    parser.add_argument("--no_cache", action="store_true",
+                        help="Refaz todas as etapas, ignorando o cache de etapas (intermediate/manifests)")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Número de amostras processadas em paralelo (padrão: 1)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Threads do samtools (-@) por amostra (padrão: núcleos disponíveis / jobs)")
 
     args = parser.parse_args()
 
@@ -99,10 +394,66 @@ if __name__ == "__main__":
         parser.error("--output_dir é obrigatório")
     if not args.intermediate_dir:
         parser.error("--intermediate_dir é obrigatório")
+    if args.jobs < 1:
+        parser.error("--jobs deve ser maior ou igual a 1")
+    if args.threads is not None and args.threads < 1:
+        parser.error("--threads deve ser maior ou igual a 1")
+    if args.coverage_shards < 1:
+        parser.error("--coverage_shards deve ser maior ou igual a 1")
+
+    if args.bin_size < 1:
+        parser.error("--bin_size deve ser maior ou igual a 1")
+    quantize = None
+    if args.quantize:
+        from depth_stream import parse_quantize_thresholds
+        try:
+            quantize = parse_quantize_thresholds(args.quantize)
+        except ValueError as e:
+            parser.error(f"--quantize: {e}")
+    if (args.cpu_slots is not None and args.cpu_slots < 1) or (args.io_slots is not None and args.io_slots < 1):
+        parser.error("--cpu_slots e --io_slots devem ser maiores ou iguais a 1")
+    min_free_memory = None
+    if args.min_free_memory:
+        from intermediate_storage import parse_size
+        try:
+            min_free_memory = parse_size(args.min_free_memory)
+        except ValueError as e:
+            parser.error(f"--min_free_memory: {e}")
+    if args.lease_seconds <= 0:
+        parser.error("--lease_seconds deve ser maior que zero")
+    queue_dir = args.queue_dir
+    bam_budget = None
+    if args.bam_budget:
+        from intermediate_storage import parse_size
+        try:
+            bam_budget = parse_size(args.bam_budget)
+        except ValueError as e:
+            parser.error(f"--bam_budget: {e}")
+    if args.queue and not queue_dir:
+        from work_queue import batch_directory
+        queue_dir = batch_directory(args.intermediate_dir, args.cram_dir, args.bed)
+
+    if args.dry_run:
+        describe_plan(args.cram_dir, args.bed, args.output_dir, args.intermediate_dir,
+                      args.jobs, args.threads, not args.no_cache, args.no_plots)
+        exit(0)
 
     try:
-        main(args.cram_dir, args.bed, args.output_dir, args.intermediate_dir,
-             args.samtools_path, args.bcftools_path, args.ref_fasta)
+        failed = main(args.cram_dir, args.bed, args.output_dir, args.intermediate_dir,
+                      args.samtools_path, args.bcftools_path, args.ref_fasta,
+                      args.jobs, args.threads, args.no_bam, args.crai_dir,
+                      args.compression_level, args.coverage_engine,
+                      args.normalize_sex, args.per_base, args.raw_bed,
+                      not args.no_cache, args.coverage_shards, args.shard_mode, args.no_plots,
+                      args.sex_mode, {"x_ratio_threshold": args.sex_x_ratio, "y_ratio_threshold": args.sex_y_ratio,
+                                      "y_female_ratio": args.sex_y_female_ratio},
+                      args.panel_vcf, args.panel_vcf_dir, args.tabix_path,
+                      queue_dir, args.lease_seconds, bam_budget,
+                      args.columnar, args.depth_bins, args.bin_size, quantize,
+                      args.admission, args.cpu_slots, args.io_slots, min_free_memory)
     except Exception as e:
         print(f"Erro durante a execução do pipeline: {e}")
         exit(1)
+    if failed:
+        print(f"{len(failed)} amostra(s) falharam, veja {args.output_dir}{os.sep}logs{os.sep}pipeline.log")
+        exit(1)
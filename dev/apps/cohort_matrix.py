@@ -0,0 +1,197 @@
+# dev/cohort_matrix.py
+import fcntl
+import json
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+# Matriz de coorte regiões × amostras com a profundidade média de cada alvo.
+# Fica em output/cohort/<hash do BED>/: as regiões em regions.npz, a lista de
+# amostras em cohort.json e os valores em blocos chunk_<n>.npy (float32, 64
+# amostras por bloco, ordem de coluna para que cada amostra seja contígua),
+# abertos por memória mapeada. Consultas da coorte inteira não tocam nos BAMs.
+
+COHORT_VERSION = 1
+SAMPLES_PER_CHUNK = 64
+
+
+class CohortMatrix:
+    """Armazenamento em disco da matriz de coorte de um layout de alvos."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.metadata_path = os.path.join(directory, "cohort.json")
+        self.regions_path = os.path.join(directory, "regions.npz")
+        self.lock_path = os.path.join(directory, ".lock")
+
+    @contextmanager
+    def locked(self, exclusive=True):
+        """Trava do diretório (fcntl), segura com amostras gravando em paralelo."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.lock_path, "a") as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def chunk_path(self, chunk):
+        return os.path.join(self.directory, f"chunk_{chunk:05d}.npy")
+
+    def read_metadata(self):
+        if not os.path.exists(self.metadata_path):
+            return {"version": COHORT_VERSION, "regions": None, "chunk_size": SAMPLES_PER_CHUNK, "samples": []}
+        with open(self.metadata_path) as handle:
+            metadata = json.load(handle)
+        if metadata.get("version") != COHORT_VERSION:
+            raise ValueError(f"Versão de matriz de coorte incompatível: {self.metadata_path}")
+        return metadata
+
+    def _write_metadata(self, metadata):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".json.tmp")
+        with os.fdopen(fd, "w") as handle:
+            json.dump(metadata, handle, indent=2)
+        os.replace(temp_path, self.metadata_path)
+
+    def _write_regions(self, region_table):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".npz.tmp")
+        with os.fdopen(fd, "wb") as handle:
+            np.savez(handle, chrom_names=np.asarray(region_table.chrom_names, dtype=str),
+                     chrom_codes=region_table.chrom_codes, starts=region_table.starts, ends=region_table.ends)
+        os.replace(temp_path, self.regions_path)
+
+    def regions(self):
+        """Tupla (nomes de cromossomo, códigos, inícios, fins) das linhas da matriz."""
+        with np.load(self.regions_path) as data:
+            return data["chrom_names"].tolist(), data["chrom_codes"], data["starts"], data["ends"]
+
+    def samples(self):
+        with self.locked(exclusive=False):
+            return self.read_metadata()["samples"]
+
+    def add_sample(self, sample_name, region_table):
+        """Grava (ou substitui) a coluna da amostra com a profundidade média de cada região."""
+        depths = np.zeros(len(region_table), dtype=np.float32)
+        lengths = region_table.lengths
+        np.divide(region_table.depths, lengths, out=depths, where=lengths > 0, casting="unsafe")
+
+        with self.locked():
+            metadata = self.read_metadata()
+            if metadata["regions"] is None:
+                self._write_regions(region_table)
+                metadata["regions"] = len(region_table)
+            else:
+                _names, _codes, starts, ends = self.regions()
+                if (len(starts) != len(region_table) or not np.array_equal(starts, region_table.starts)
+                        or not np.array_equal(ends, region_table.ends)):
+                    logging.error(f"Regiões da amostra {sample_name} diferem das da matriz de coorte "
+                                  f"{self.directory}")
+                    raise ValueError(f"Regiões da amostra {sample_name} diferem das da matriz de coorte")
+
+            samples = metadata["samples"]
+            if sample_name not in samples:
+                samples.append(sample_name)
+            column = samples.index(sample_name)
+            chunk, within_chunk = divmod(column, metadata["chunk_size"])
+
+            path = self.chunk_path(chunk)
+            if os.path.exists(path):
+                matrix = np.load(path, mmap_mode="r+")
+            else:
+                matrix = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, fortran_order=True,
+                                                   shape=(metadata["regions"], metadata["chunk_size"]))
+                matrix[:] = np.nan
+            matrix[:, within_chunk] = depths
+            matrix.flush()
+            del matrix
+            self._write_metadata(metadata)
+        return path
+
+    def iter_chunks(self, row_slice=slice(None)):
+        """Gera (nomes das amostras, bloco regiões × amostras) só com as colunas preenchidas."""
+        metadata = self.read_metadata()
+        samples, chunk_size = metadata["samples"], metadata["chunk_size"]
+        for chunk in range(-(-len(samples) // chunk_size)):
+            names = samples[chunk * chunk_size:(chunk + 1) * chunk_size]
+            matrix = np.load(self.chunk_path(chunk), mmap_mode="r")
+            yield names, matrix[row_slice, :len(names)]
+
+    def sample_depths(self, sample_name):
+        """Profundidade média por região de uma amostra (cópia em memória)."""
+        with self.locked(exclusive=False):
+            metadata = self.read_metadata()
+            column = metadata["samples"].index(sample_name)
+            chunk, within_chunk = divmod(column, metadata["chunk_size"])
+            return np.array(np.load(self.chunk_path(chunk), mmap_mode="r")[:, within_chunk])
+
+    def low_coverage_fraction(self, min_depth, row_block=1_000_000):
+        """Para cada região, a fração das amostras com profundidade média abaixo de `min_depth`
+        e a profundidade média da coorte. Lê a matriz em blocos de `row_block` regiões."""
+        with self.locked(exclusive=False):
+            metadata = self.read_metadata()
+            n_regions, n_samples = metadata["regions"] or 0, len(metadata["samples"])
+            below = np.zeros(n_regions, dtype=np.int64)
+            totals = np.zeros(n_regions, dtype=np.float64)
+            for first in range(0, n_regions, row_block):
+                rows = slice(first, min(first + row_block, n_regions))
+                for _names, block in self.iter_chunks(rows):
+                    values = np.asarray(block)
+                    below[rows] += np.count_nonzero(values < min_depth, axis=1)
+                    totals[rows] += values.sum(axis=1, dtype=np.float64)
+        if not n_samples:
+            return below.astype(np.float64), totals
+        return below / n_samples, totals / n_samples
+
+    def low_coverage_targets(self, min_depth=20, min_fraction=0.1):
+        """Regiões abaixo de `min_depth` em mais de `min_fraction` das amostras.
+
+        Retorna uma lista de tuplas (cromossomo, início, fim, fração abaixo, profundidade média).
+        """
+        fraction, mean_depth = self.low_coverage_fraction(min_depth)
+        chrom_names, chrom_codes, starts, ends = self.regions()
+        rows = np.flatnonzero(fraction > min_fraction)
+        return [(chrom_names[chrom_codes[row]], int(starts[row]), int(ends[row]),
+                 float(fraction[row]), float(mean_depth[row])) for row in rows]
+
+
+def cohort_directory(output_dir, layout_key):
+    """Diretório da matriz de coorte para um layout de alvos (hash do BED normalizado)."""
+    return os.path.join(output_dir, "cohort", layout_key)
+
+
+# Execução direta: consultas na matriz de coorte
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Consultas na matriz de coorte (regiões × amostras)")
+    parser.add_argument("cohort_dir", help="Diretório da matriz (output/cohort/<hash do BED>)")
+    parser.add_argument("--min_depth", type=float, default=20,
+                        help="Profundidade média mínima de uma região (padrão: 20)")
+    parser.add_argument("--min_fraction", type=float, default=0.1,
+                        help="Lista regiões abaixo de --min_depth em mais desta fração das amostras (padrão: 0.1)")
+    parser.add_argument("--samples", action="store_true", help="Apenas lista as amostras da matriz")
+    parser.add_argument("--output", default=None, help="Grava o resultado em TSV (padrão: tela)")
+    args = parser.parse_args()
+
+    cohort = CohortMatrix(args.cohort_dir)
+    if args.samples:
+        for name in cohort.samples():
+            print(name)
+    else:
+        targets = cohort.low_coverage_targets(args.min_depth, args.min_fraction)
+        lines = [f"{chrom}\t{start}\t{end}\t{fraction:.3f}\t{depth:.2f}\n"
+                 for chrom, start, end, fraction, depth in targets]
+        header = "Cromossomo\tInício\tFim\tFração abaixo\tProfundidade média\n"
+        if args.output:
+            with open(args.output, "w") as handle:
+                handle.write(header)
+                handle.writelines(lines)
+            print(f"{len(targets)} regiões gravadas em {args.output}")
+        else:
+            print(header, end="")
+            print("".join(lines), end="")
+            print(f"{len(targets)} regiões abaixo de {args.min_depth}x em mais de {args.min_fraction:.0%} "
+                  f"de {len(cohort.samples())} amostras")
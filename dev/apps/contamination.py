@@ -1,51 +1,380 @@
 # dev/contamination.py
-import subprocess
+import asyncio
+import gzip
+import hashlib
 import logging
+import os
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 
-# não implementado
+from bam_reader import fetch_site_bases, find_bam_index, read_bai, read_bam_header
+from bgzf import BgzfReader
+from coverage import build_alignment_command, group_targets, match_contig_name
+from target_index import build_target_index, file_sha256, normalize_contig_name
+from tool_runner import run_async, run_tool
 
+# Estimativa de contaminação no estilo do FREEMIX (VerifyBamID), sem ferramentas externas:
+# contagens de bases ref/alt nos SNPs do painel que caem dentro dos alvos e ajuste da
+# fração de contaminação alfa por máxima verossimilhança (grade vetorizada em NumPy).
+# Para cada sítio com frequência alélica p, o genótipo da amostra (g) e o do contaminante
+# (h) seguem Hardy-Weinberg e a fração esperada de reads alt é (1 - alfa) g/2 + alfa h/2.
 
-def estimate_contamination(bam_file, verifybamid_path="VerifyBamID"):
-    """Estima a contaminação em um arquivo BAM."""
+PANEL_SITES_VERSION = 1
+DEFAULT_MIN_MAF = 0.01
+DEFAULT_MIN_MAPQ = 20
+DEFAULT_MIN_BASE_QUALITY = 20
+ALPHA_GRID = np.linspace(0.0, 0.5, 501)
 
+# Código de 4 bits das bases no BAM
+BASE_CODES = {"A": 1, "C": 2, "G": 4, "T": 8}
+AF_REGEX = re.compile(r"(?:^|;)AF=([0-9.eE+-]+)")
+
+
+class PanelSites:
+    """SNPs bialélicos do painel dentro dos alvos: posições 0-based, bases (código BAM) e frequência alt.
+
+    Os sítios do contig i ficam em positions[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, contig_names, offsets, positions, ref_codes, alt_codes, allele_freqs, key=None):
+        self.contig_names = list(contig_names)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.ref_codes = np.asarray(ref_codes, dtype=np.uint8)
+        self.alt_codes = np.asarray(alt_codes, dtype=np.uint8)
+        self.allele_freqs = np.asarray(allele_freqs, dtype=np.float64)
+        self.key = key
+
+    def __len__(self):
+        return len(self.positions)
+
+    def contig_slice(self, contig):
+        if contig not in self.contig_names:
+            return slice(0, 0)
+        i = self.contig_names.index(contig)
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def write_positions(self, path, contigs=None):
+        """Grava os sítios (de `contigs`, ou todos) como lista de posições (contig e posição 1-based),
+        para o `samtools mpileup -l`."""
+        with open(path, "w") as handle:
+            for contig in contigs or self.contig_names:
+                block = self.contig_slice(contig)
+                handle.writelines(f"{contig}\t{position + 1}\n" for position in self.positions[block].tolist())
+        return path
+
+    def save(self, path):
+        """Grava os sítios em .npz (escrita atômica)."""
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npz.tmp")
+        with os.fdopen(fd, "wb") as handle:
+            np.savez(handle, version=PANEL_SITES_VERSION, contig_names=np.asarray(self.contig_names, dtype=str),
+                     offsets=self.offsets, positions=self.positions, ref_codes=self.ref_codes,
+                     alt_codes=self.alt_codes, allele_freqs=self.allele_freqs, key=np.asarray(self.key or ""))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data["version"]) != PANEL_SITES_VERSION:
+                raise ValueError(f"Versão de sítios do painel incompatível: {path}")
+            return cls(data["contig_names"].tolist(), data["offsets"], data["positions"], data["ref_codes"],
+                       data["alt_codes"], data["allele_freqs"], str(data["key"]) or None)
+
+
+def build_panel_sites(panel_vcf, target_index, min_maf=DEFAULT_MIN_MAF):
+    """Lê o VCF do painel e guarda os SNPs bialélicos com AF em [min_maf, 1 - min_maf] dentro dos alvos."""
+    known_contigs = set(target_index.contig_names)
+    contig_names = {}
+    per_contig = {}
+    opener = gzip.open if panel_vcf.endswith(".gz") else open
+    with opener(panel_vcf, "rt") as vcf:
+        for line in vcf:
+            if line.startswith("#"):
+                continue
+            chrom, position, _id, ref, alt, _qual, _filter, info = line.split("\t", 8)[:8]
+            if ref not in BASE_CODES or alt not in BASE_CODES:
+                continue
+            match = AF_REGEX.search(info)
+            if match is None:
+                continue
+            allele_freq = float(match.group(1))
+            if not min_maf <= allele_freq <= 1 - min_maf:
+                continue
+            if chrom not in contig_names:
+                contig_names[chrom] = normalize_contig_name(chrom, known_contigs)
+            contig = contig_names[chrom]
+            if contig is None:
+                continue
+            sites = per_contig.setdefault(contig, ([], [], [], []))
+            sites[0].append(int(position) - 1)
+            sites[1].append(BASE_CODES[ref])
+            sites[2].append(BASE_CODES[alt])
+            sites[3].append(allele_freq)
+
+    contigs = [name for name in target_index.contig_names if name in per_contig]
+    offsets = [0]
+    columns = ([], [], [], [])
+    for contig in contigs:
+        positions = np.asarray(per_contig[contig][0], dtype=np.int64)
+        block = target_index.contig_slice(contig)
+        starts, ends = target_index.starts[block], target_index.ends[block]
+        # Alvos já ordenados e unidos: o alvo candidato de cada sítio é o último que começa antes dele
+        target = np.searchsorted(starts, positions, side="right") - 1
+        inside = (target >= 0) & (positions < ends[np.maximum(target, 0)])
+        # Mantém só o primeiro registro de cada posição (ordem crescente)
+        kept = np.flatnonzero(inside)
+        _unique, first = np.unique(positions[kept], return_index=True)
+        kept = kept[first]
+        for column, values in zip(columns, per_contig[contig]):
+            column.append(np.asarray(values)[kept])
+        offsets.append(offsets[-1] + len(kept))
+
+    return PanelSites(contigs, offsets, *[np.concatenate(column) if column else [] for column in columns])
+
+
+def load_panel_sites(panel_vcf, intermediate_dir, target_index=None, bed_file=None, min_maf=DEFAULT_MIN_MAF):
+    """Carrega os sítios do painel do cache (intermediate/panel_sites) ou os extrai do VCF.
+
+    A chave do cache junta o VCF (caminho, tamanho e data), os alvos e o `min_maf`.
+    """
+    if target_index is None:
+        target_index = build_target_index(bed_file)
+    stat = os.stat(panel_vcf)
+    digest = hashlib.sha256()
+    digest.update(f"{os.path.abspath(panel_vcf)}\t{stat.st_size}\t{stat.st_mtime_ns}".encode())
+    digest.update(f"\t{target_index.bed_hash or file_sha256(bed_file)}\t{min_maf}\tv{PANEL_SITES_VERSION}".encode())
+    key = digest.hexdigest()[:16]
+
+    cache_dir = os.path.join(intermediate_dir, "panel_sites")
+    os.makedirs(cache_dir, exist_ok=True)
+    sites_path = os.path.join(cache_dir, f"{key}.npz")
+    if os.path.exists(sites_path):
+        logging.info(f"Sítios do painel carregados do cache: {sites_path}")
+        return PanelSites.load(sites_path)
+
+    logging.info(f"Extraindo os SNPs do painel {panel_vcf} dentro dos alvos -> {sites_path}")
+    panel_sites = build_panel_sites(panel_vcf, target_index, min_maf)
+    panel_sites.key = key
+    panel_sites.save(sites_path)
+    logging.info(f"{len(panel_sites)} SNPs do painel em {len(panel_sites.contig_names)} contigs")
+    return panel_sites
+
+
+def count_contig_alleles(bam_file, index, ref_id, sites, ref_codes, alt_codes, min_mapq, min_base_quality):
+    """Contagens (ref, alt, erro esperado somado, bases usadas) nos sítios de um contig (leitor próprio)."""
+    ref_counts = np.zeros(len(sites), dtype=np.int64)
+    alt_counts = np.zeros(len(sites), dtype=np.int64)
+    error_sum = 0.0
+    bases_used = 0
+    with BgzfReader(bam_file) as reader:
+        for first, last, _beg, _end in group_targets(sites, sites + 1):
+            for site_ids, bases, qualities in fetch_site_bases(reader, index[ref_id], ref_id, sites[first:last],
+                                                               min_mapq=min_mapq,
+                                                               min_base_quality=min_base_quality):
+                site_ids = site_ids + first
+                is_ref = bases == ref_codes[site_ids]
+                is_alt = bases == alt_codes[site_ids]
+                ref_counts += np.bincount(site_ids[is_ref], minlength=len(sites))
+                alt_counts += np.bincount(site_ids[is_alt], minlength=len(sites))
+                error_sum += float(np.power(10.0, -qualities.astype(np.float64) / 10.0).sum())
+                bases_used += len(bases)
+    return ref_counts, alt_counts, error_sum, bases_used
+
+
+def count_alleles_bam(bam_file, panel_sites, index_file=None, threads=1, min_mapq=DEFAULT_MIN_MAPQ,
+                      min_base_quality=DEFAULT_MIN_BASE_QUALITY):
+    """Pileup em processo nos sítios do painel, um contig por tarefa (threads)."""
+    _, references = read_bam_header(bam_file)
+    index = read_bai(index_file or find_bam_index(bam_file))
+    contig_ids = {name: ref_id for ref_id, (name, _length) in enumerate(references)}
+
+    ref_counts = np.zeros(len(panel_sites), dtype=np.int64)
+    alt_counts = np.zeros(len(panel_sites), dtype=np.int64)
+    tasks = {}
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        for contig in panel_sites.contig_names:
+            ref_id = match_contig_name(contig, contig_ids)
+            if ref_id is None:
+                logging.warning(f"Contig {contig} do painel não existe no BAM {bam_file}")
+                continue
+            block = panel_sites.contig_slice(contig)
+            tasks[pool.submit(count_contig_alleles, bam_file, index, ref_id, panel_sites.positions[block],
+                              panel_sites.ref_codes[block], panel_sites.alt_codes[block],
+                              min_mapq, min_base_quality)] = block
+        error_sum = 0.0
+        bases_used = 0
+        for future, block in tasks.items():
+            contig_ref, contig_alt, contig_error, contig_bases = future.result()
+            ref_counts[block] = contig_ref
+            alt_counts[block] = contig_alt
+            error_sum += contig_error
+            bases_used += contig_bases
+    return ref_counts, alt_counts, error_sum / bases_used if bases_used else 0.0
+
+
+def parse_pileup_bases(bases, ref_base=None):
+    """Bases lidas de uma coluna do `samtools mpileup` (sem marcas de início/fim de read nem indels).
+
+    Com a referência (-f/--reference) o mpileup escreve '.' e ',' nas bases iguais à
+    referência; elas viram `ref_base`.
+    """
+    read = []
+    i = 0
+    while i < len(bases):
+        char = bases[i]
+        if char == "^":
+            i += 2
+            continue
+        if char in "+-":
+            j = i + 1
+            while j < len(bases) and bases[j].isdigit():
+                j += 1
+            i = j + int(bases[i + 1:j])
+            continue
+        if char in ".,":
+            read.append(ref_base)
+        elif char != "$":
+            read.append(char.upper())
+        i += 1
+    return read
+
+
+def count_alleles_mpileup(alignment_file, panel_sites, samtools_path="samtools", ref_fasta=None, index_file=None,
+                          min_mapq=DEFAULT_MIN_MAPQ, min_base_quality=DEFAULT_MIN_BASE_QUALITY):
+    """Contagens ref/alt com o `samtools mpileup` nos sítios do painel (para CRAM).
+
+    Roda um mpileup por contig (`-r contig`) ao mesmo tempo pelo tool_runner
+    (limite de MAX_CONCURRENT_TOOLS); cada um preenche as linhas do seu contig.
+    """
+    code_to_base = {code: base for base, code in BASE_CODES.items()}
+    ref_counts = np.zeros(len(panel_sites), dtype=np.int64)
+    alt_counts = np.zeros(len(panel_sites), dtype=np.int64)
+    error = [0.0, 0]
+
+    def contig_feed(contig, block):
+        site_rows = {position + 1: row
+                     for row, position in enumerate(panel_sites.positions[block].tolist(), block.start)}
+
+        def feed(lines):
+            for line in lines:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) < 6 or parts[0] != contig:
+                    continue
+                row = site_rows.get(int(parts[1]))
+                if row is None:
+                    continue
+                ref_base = code_to_base[int(panel_sites.ref_codes[row])]
+                bases = parse_pileup_bases(parts[4], ref_base)
+                ref_counts[row] = bases.count(ref_base)
+                alt_counts[row] = bases.count(code_to_base[int(panel_sites.alt_codes[row])])
+                qualities = np.frombuffer(parts[5].encode(), dtype=np.uint8).astype(np.float64) - 33
+                error[0] += float(np.power(10.0, -qualities / 10.0).sum())
+                error[1] += len(qualities)
+        return feed
+
+    async def run_contig(contig, block):
+        fd, positions_file = tempfile.mkstemp(prefix="panel_sites_", suffix=".txt")
+        os.close(fd)
+        try:
+            panel_sites.write_positions(positions_file, [contig])
+            command = build_alignment_command(samtools_path, "mpileup",
+                                              ["-B", "-q", str(min_mapq), "-Q", str(min_base_quality),
+                                               "-r", contig, "-l", positions_file],
+                                              alignment_file, ref_fasta, index_file)
+            await run_tool(command, stdout_consumer=contig_feed(contig, block), lines=True)
+        finally:
+            os.remove(positions_file)
+
+    async def run_all(blocks):
+        await asyncio.gather(*(run_contig(contig, block) for contig, block in blocks))
+
+    blocks = [(contig, panel_sites.contig_slice(contig)) for contig in panel_sites.contig_names]
+    run_async(run_all([(contig, block) for contig, block in blocks if block.stop > block.start]))
+    return ref_counts, alt_counts, error[0] / error[1] if error[1] else 0.0
+
+
+def contamination_log_likelihood(ref_counts, alt_counts, allele_freqs, alphas, error_rate, block_sites=500):
+    """Log-verossimilhança total para cada alfa (vetor), somando os sítios em blocos."""
+    alphas = np.asarray(alphas, dtype=np.float64)
+    dosages = np.array([0.0, 0.5, 1.0])
+    # Fração alt esperada para cada (alfa, genótipo da amostra, genótipo do contaminante)
+    fractions = ((1 - alphas)[:, None, None] * dosages[None, :, None]
+                 + alphas[:, None, None] * dosages[None, None, :]).reshape(len(alphas), 9)
+    log_alt = np.log(fractions * (1 - error_rate) + (1 - fractions) * error_rate / 3)
+    log_ref = np.log((1 - fractions) * (1 - error_rate) + fractions * error_rate / 3)
+
+    total = np.zeros(len(alphas))
+    for first in range(0, len(ref_counts), block_sites):
+        ref = ref_counts[first:first + block_sites].astype(np.float64)
+        alt = alt_counts[first:first + block_sites].astype(np.float64)
+        p = allele_freqs[first:first + block_sites]
+        priors = np.stack([(1 - p) ** 2, 2 * p * (1 - p), p ** 2], axis=1)
+        log_priors = np.log((priors[:, :, None] * priors[:, None, :]).reshape(len(p), 9))
+        # sítios × alfas × 9 combinações de genótipos
+        terms = (alt[:, None, None] * log_alt[None] + ref[:, None, None] * log_ref[None]
+                 + log_priors[:, None, :])
+        peak = terms.max(axis=2, keepdims=True)
+        total += (peak[:, :, 0] + np.log(np.exp(terms - peak).sum(axis=2))).sum(axis=0)
+    return total
+
+
+def fit_contamination(ref_counts, alt_counts, allele_freqs, error_rate):
+    """Alfa de máxima verossimilhança: grade de 0 a 0,5 (passo 0,001) refinada em torno do melhor ponto."""
+    covered = (ref_counts + alt_counts) > 0
+    ref_counts, alt_counts, allele_freqs = ref_counts[covered], alt_counts[covered], allele_freqs[covered]
+    error_rate = min(max(error_rate, 1e-4), 0.1)
+    likelihood = contamination_log_likelihood(ref_counts, alt_counts, allele_freqs, ALPHA_GRID, error_rate)
+    best = ALPHA_GRID[int(np.argmax(likelihood))]
+    fine_grid = np.clip(np.linspace(best - 0.001, best + 0.001, 201), 0.0, 0.5)
+    fine = contamination_log_likelihood(ref_counts, alt_counts, allele_freqs, fine_grid, error_rate)
+    best_index = int(np.argmax(fine))
+    return float(fine_grid[best_index]), float(fine[best_index]), float(likelihood[0])
+
+
+def estimate_contamination(alignment_file, panel_sites, samtools_path="samtools", ref_fasta=None, index_file=None,
+                           threads=1, min_mapq=DEFAULT_MIN_MAPQ, min_base_quality=DEFAULT_MIN_BASE_QUALITY):
+    """Estima a fração de contaminação (FREEMIX) de um BAM ou CRAM nos sítios do painel.
+
+    BAM indexado é lido em processo, um contig por thread; CRAM usa o `samtools mpileup`.
+    """
     try:
-        # Executar VerifyBamID (requer arquivo de população, que você precisará obter)
-        # Este é um exemplo e pode precisar de ajustes nos parâmetros
-        process = subprocess.Popen(
-            [verifybamid_path, "-i", bam_file, "-o", "contamination_results", "-P", "population.hinfo"],  # population.hinfo é um arquivo de haplótipos de referência
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-        )
-        stdout, stderr = process.communicate()
+        if alignment_file.endswith(".cram"):
+            ref_counts, alt_counts, error_rate = count_alleles_mpileup(alignment_file, panel_sites, samtools_path,
+                                                                       ref_fasta, index_file, min_mapq,
+                                                                       min_base_quality)
+        else:
+            ref_counts, alt_counts, error_rate = count_alleles_bam(alignment_file, panel_sites, index_file, threads,
+                                                                   min_mapq, min_base_quality)
 
-        if stderr:
-            logging.error(f"Erro ao estimar contaminação: {stderr}")
-            raise Exception(stderr)
+        depths = ref_counts + alt_counts
+        covered = int(np.count_nonzero(depths))
+        results = {
+            "sites": len(panel_sites),
+            "sites_covered": covered,
+            "mean_depth": float(depths[depths > 0].mean()) if covered else 0.0,
+            "error_rate": error_rate,
+        }
+        if not covered:
+            logging.warning(f"Nenhum sítio do painel com reads em {alignment_file}; contaminação não estimada")
+            results.update({"freemix": None, "log_likelihood": None, "log_likelihood_no_contamination": None})
+            return results
 
-        contamination_result = parse_verifybamid_output(stdout)
-        return contamination_result
+        freemix, log_likelihood, log_likelihood_zero = fit_contamination(ref_counts, alt_counts,
+                                                                         panel_sites.allele_freqs, error_rate)
+        results.update({
+            "freemix": freemix,
+            "log_likelihood": log_likelihood,
+            "log_likelihood_no_contamination": log_likelihood_zero,
+        })
+        logging.info(f"Contaminação estimada de {alignment_file}: FREEMIX {freemix:.4f} ({covered} sítios)")
+        return results
 
     except FileNotFoundError:
-        logging.error(f"Ferramenta 'VerifyBamID' não encontrada. Verifique se está instalada e no PATH.")
+        # A mensagem já foi registrada pelo tool_runner
         raise
     except Exception as e:
         logging.error(f"Erro ao executar a estimativa de contaminação: {e}")
         raise
-
-def parse_verifybamid_output(output):
-    """Analisa a saída do VerifyBamID."""
-
-    #  Implemente a lógica para extrair as estimativas de contaminação da saída
-    #  A saída do VerifyBamID é complexa e precisa ser cuidadosamente analisada.
-    #  Este é um exemplo simples e pode precisar de adaptações.
-
-    lines = output.strip().split('\n')
-    contamination_estimate = {}
-    for line in lines:
-        if line.startswith("##BestChi2"):
-           parts = line.split('\t')
-           contamination_estimate["CHIPMIX"] = float(parts[12])
-           contamination_estimate["FREEMIX"] = float(parts[13])
-           contamination_estimate["BESTMIX"] = parts[11]
-           break
-    return contamination_estimate
\ No newline at end of file
@@ -1,6 +1,3 @@
-import logging
-import subprocess
-import os
 '''def run_command(command, log_message):
     """Executa um comando de linha de comando e trata erros."""
     try:
@@ -51,11 +48,11 @@ def run_command(command, log_message):
     print(f"\n[✔] Finalizado: {log_message}\n")'''
 ################################
 import os
-import time
 import logging
-import threading
 from tqdm import tqdm
 
+from tool_runner import ToolError, run_tool_sync, run_tools_sync
+
 
 def estimate_bam_size_bytes(cram_path, ratio=3.0):
     """Estima o tamanho do BAM com base no tamanho do CRAM."""
@@ -63,64 +60,76 @@ def estimate_bam_size_bytes(cram_path, ratio=3.0):
     return int(cram_size * ratio)
 
 
-def run_command_with_progress(command_list, bam_path, estimated_size, log_message):
-    """Executa comando via shell e exibe barra de progresso baseada no crescimento do arquivo BAM."""
+def run_command_with_progress(command_list, input_path, log_message, show_progress=True,
+                              chunk_size=4 * 1024 * 1024):
+    """Executa o comando enviando `input_path` pelo stdin e mostra o progresso real em bytes lidos."""
     logging.info(f"Executando: {log_message}")
     print(f"\n[Início] {log_message}\n")
 
-    # Barra de progresso
-    pbar = tqdm(total=estimated_size,
+    total_size = os.path.getsize(input_path)
+    pbar = tqdm(total=total_size,
                 colour='green', 
                 unit='B', 
                 unit_scale=True, 
                 desc="Convertendo CRAM → BAM",
-                bar_format="{desc}: {bar} {percentage:3.0f}% | {elapsed} elapsed"
+                disable=not show_progress
             )
-    stop_event = threading.Event()
 
-    def monitor_bam_growth():
-        while not stop_event.is_set():
-            if os.path.exists(bam_path):
-                actual_size = os.path.getsize(bam_path)
-                pbar.n = min(actual_size, estimated_size)
-                pbar.refresh()
-            time.sleep(1)
+    progress = {"bytes_sent": 0}
 
-    monitor_thread = threading.Thread(target=monitor_bam_growth)
-    monitor_thread.start()
+    def on_input(size):
+        progress["bytes_sent"] += size
+        pbar.update(size)
 
     try:
-        # Usa os.system apenas para manter compatível com seu código atual
-        exit_code = os.system(" ".join(command_list))
-        if exit_code != 0:
-            raise RuntimeError(f"Erro ao executar: {log_message}")
+        run_tool_sync(command_list, stdin_path=input_path, on_input=on_input, chunk_bytes=chunk_size)
+    except ToolError as e:
+        raise RuntimeError(f"Erro ao executar: {log_message}: {e.stderr}")
     finally:
-        stop_event.set()
-        monitor_thread.join()
-        pbar.n = estimated_size
-        pbar.refresh()
         pbar.close()
+    bytes_sent = progress["bytes_sent"]
 
+    logging.info(f"{log_message}: {bytes_sent} bytes processados")
     print(f"\n[✔] Finalizado: {log_message}\n")
-
-
-def convert_cram_to_bam(cram_file, output_bam, samtools_path="samtools", ref_fasta=None):
-    """Converte CRAM para BAM usando samtools (sem ordenação), com barra de progresso."""
-    estimated_bam_size = estimate_bam_size_bytes(cram_file)
-
-    command = [samtools_path, "view", "-b", "-o", output_bam]
+    return bytes_sent
+
+
+def convert_cram_to_bam(cram_file, output_bam, samtools_path="samtools", ref_fasta=None,
+                        threads=1, show_progress=True, compression_level=None):
+    """Converte CRAM para BAM indexado em uma única passagem (samtools view --write-index).
+
+    O CRAM é enviado pelo stdin, então a barra de progresso mostra os bytes
+    realmente processados. O BAM e o .bai são gravados com nome temporário e
+    renomeados apenas no sucesso, para não deixar um BAM incompleto para trás.
+    `compression_level` (0-9) é repassado para o samtools (-l).
+    """
+    bam_index = f"{output_bam}.bai"
+    temp_bam = f"{output_bam}.tmp"
+    temp_index = f"{temp_bam}.bai"
+
+    command = [samtools_path, "view", "-b", "-@", str(threads), "--write-index",
+               "-o", f"{temp_bam}##idx##{temp_index}"]
+    if compression_level is not None:
+        command.extend(["-l", str(compression_level)])
     if ref_fasta:
         command.extend(["-T", ref_fasta])
-    command.append(cram_file)
+    command.append("-")
 
-    run_command_with_progress(
-        command,
-        output_bam,
-        estimated_bam_size,
-        f"Conversão de CRAM para BAM: {cram_file} -> {output_bam}"
-    )
+    try:
+        run_command_with_progress(
+            command,
+            cram_file,
+            f"Conversão de CRAM para BAM: {cram_file} -> {output_bam}",
+            show_progress
+        )
+        os.replace(temp_index, bam_index)
+        os.replace(temp_bam, output_bam)
+    finally:
+        for leftover in (temp_bam, temp_index):
+            if os.path.exists(leftover):
+                os.remove(leftover)
 
-    logging.info(f"CRAM convertido para BAM: {output_bam}")
+    logging.info(f"CRAM convertido para BAM: {output_bam} (índice: {bam_index})")
 
 ################################
 '''
@@ -160,23 +169,14 @@ def convert_bam_to_fastq(bam_file, output_fastq_prefix, samtools_path="samtools"
     fastq_file_R2 = f"{output_fastq_prefix}_R2.fastq"
 
     try:
-        #  samtools fastq -1 para R1, -2 para R2
-        process_R1 = subprocess.Popen([samtools_path, "fastq", "-1", fastq_file_R1, bam_file],
-                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        process_R2 = subprocess.Popen([samtools_path, "fastq", "-2", fastq_file_R2, bam_file],
-                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-        stdout_R1, stderr_R1 = process_R1.communicate()
-        stdout_R2, stderr_R2 = process_R2.communicate()
-
-        if stderr_R1 or stderr_R2:
-            logging.error(f"Erro ao converter BAM para FASTQ: {stderr_R1 or stderr_R2}")
-            raise Exception(stderr_R1 or stderr_R2)
+        #  samtools fastq -1 para R1, -2 para R2 (as duas execuções rodam ao mesmo tempo)
+        run_tools_sync([[samtools_path, "fastq", "-1", fastq_file_R1, bam_file],
+                        [samtools_path, "fastq", "-2", fastq_file_R2, bam_file]])
 
         logging.info(f"BAM convertido para FASTQ: {fastq_file_R1}, {fastq_file_R2}")
 
     except FileNotFoundError:
-        logging.error(f"Ferramenta 'samtools' não encontrada. Verifique se está no PATH.")
+        # A mensagem já foi registrada pelo tool_runner
         raise
     except Exception as e:
         logging.error(f"Erro ao converter BAM para FASTQ: {e}")
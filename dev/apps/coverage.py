@@ -1,73 +1,458 @@
-import subprocess
+import io
+import json
+import os
+import asyncio
 import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
-def parse_bedcov_output(output):
-    """Analisa a saída do samtools bedcov."""
-    results = []
-    total_bases = 0
-    covered_10x = 0
-    covered_30x = 0
-    
-    for line in output.strip().split('\n'):
-        parts = line.split('\t')
-        if len(parts) < 4:
-            logging.warning(f"Skipping malformed line: {line}")
-            continue
-        chrom, start, end, *_, depth = parts[:3] + parts[len(parts)-1:] #pega os 3 primeiros e o ultimo
-        
-        try: #tenta a conversão para int, se falhar ignora a linha
-            start = int(start)
-            end = int(end)
-            depth = int(depth)
+import numpy as np
+
+from bam_reader import read_bam_header, read_bai, fetch_read_intervals, find_bam_index
+from bgzf import BgzfReader
+from tool_runner import run_async, run_tool
+
+# Versão das métricas de summarize_region_coverage (entra na impressão digital da
+# etapa de cobertura; resultados em cache de versões anteriores são recalculados)
+COVERAGE_SUMMARY_VERSION = 2
+
+
+class RegionTable:
+    """Tabela compacta de regiões com colunas NumPy (no lugar de uma lista de dicionários).
+
+    Os cromossomos são guardados como códigos inteiros que indexam `chrom_names`.
+    Iterar na tabela gera dicionários {'chrom', 'start', 'end', 'depth'} para
+    manter compatibilidade com o formato antigo de 'region_coverage'.
+    """
+
+    def __init__(self, chrom_names, chrom_codes, starts, ends, depths):
+        self.chrom_names = list(chrom_names)
+        self.chrom_codes = np.asarray(chrom_codes, dtype=np.int32)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.depths = np.asarray(depths, dtype=np.int64)
+
+    @classmethod
+    def from_regions(cls, regions):
+        """Cria a tabela a partir de uma lista de dicionários de região."""
+        chrom_ids = {}
+        codes = [chrom_ids.setdefault(region['chrom'], len(chrom_ids)) for region in regions]
+        return cls(list(chrom_ids), codes,
+                   [region['start'] for region in regions],
+                   [region['end'] for region in regions],
+                   [region['depth'] for region in regions])
+
+    @classmethod
+    def concatenate(cls, tables):
+        """Junta várias tabelas (na ordem dada), unificando os códigos de cromossomo."""
+        chrom_ids = {}
+        codes = []
+        for table in tables:
+            remap = np.asarray([chrom_ids.setdefault(name, len(chrom_ids)) for name in table.chrom_names],
+                               dtype=np.int32)
+            codes.append(remap[table.chrom_codes] if len(table) else table.chrom_codes)
+        if not tables:
+            return cls([], [], [], [], [])
+        return cls(list(chrom_ids), np.concatenate(codes),
+                   np.concatenate([table.starts for table in tables]),
+                   np.concatenate([table.ends for table in tables]),
+                   np.concatenate([table.depths for table in tables]))
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def lengths(self):
+        return self.ends - self.starts
+
+    @property
+    def chroms(self):
+        """Nome do cromossomo de cada região (array de objetos)."""
+        return np.asarray(self.chrom_names, dtype=object)[self.chrom_codes]
+
+    def chrom_mask(self, chrom_regex):
+        """Máscara das regiões cujo cromossomo casa com a expressão regular."""
+        matching = [code for code, name in enumerate(self.chrom_names) if chrom_regex.match(name)]
+        return np.isin(self.chrom_codes, matching)
+
+    def iter_rows(self):
+        """Gera tuplas (cromossomo, início, fim, profundidade) sem criar dicionários."""
+        names = self.chrom_names
+        for code, start, end, depth in zip(self.chrom_codes.tolist(), self.starts.tolist(),
+                                           self.ends.tolist(), self.depths.tolist()):
+            yield names[code], start, end, depth
+
+    def __iter__(self):
+        for chrom, start, end, depth in self.iter_rows():
+            yield {'chrom': chrom, 'start': start, 'end': end, 'depth': depth}
+
+
+class BedcovStreamParser:
+    """Lê a saída do samtools bedcov em lotes de linhas, acumulando colunas NumPy."""
+
+    def __init__(self):
+        self._chrom_ids = {}
+        self._codes, self._starts, self._ends, self._depths = [], [], [], []
+
+    def _parse_rows_one_by_one(self, rows):
+        """Caminho lento, só para lotes com linhas inválidas (mantém os avisos por linha)."""
+        valid = []
+        for parts in rows:
+            try: #tenta a conversão para int, se falhar ignora a linha
+                valid.append((parts[0], int(parts[1]), int(parts[2]), int(parts[-1])))
+            except ValueError:
+                line = '\t'.join(parts)
+                logging.warning(f"Skipping line with invalid numeric data: {line}")
+        return valid
+
+    def feed(self, lines):
+        """Processa um lote de linhas de texto."""
+        rows = []
+        for line in lines:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) < 4:
+                if line.strip():
+                    logging.warning(f"Skipping malformed line: {line.rstrip()}")
+                continue
+            rows.append(parts)
+        if not rows:
+            return
+        try:
+            #pega os 3 primeiros e o ultimo
+            starts = np.array([parts[1] for parts in rows]).astype(np.int64)
+            ends = np.array([parts[2] for parts in rows]).astype(np.int64)
+            depths = np.array([parts[-1] for parts in rows]).astype(np.int64)
+            chroms = [parts[0] for parts in rows]
         except ValueError:
-            logging.warning(f"Skipping line with invalid numeric data: {line}")
-            continue
-            
-        region_length = end - start
-        
-        total_bases += region_length
-        if depth >= 10:
-            covered_10x += region_length
-        if depth >= 30:
-            covered_30x += region_length
-            
-        results.append({
-            'chrom': chrom,
-            'start': start,
-            'end': end,
-            'depth': depth
-            })
-            
-    mean_depth = sum(region['depth'] * (region['end'] - region['start']) for region in results) / total_bases if total_bases else 0
-    percent_10x = (covered_10x / total_bases) * 100 if total_bases else 0
-    percent_30x = (covered_30x / total_bases) * 100 if total_bases else 0
+            valid = self._parse_rows_one_by_one(rows)
+            if not valid:
+                return
+            chroms, starts, ends, depths = zip(*valid)
+        chrom_ids = self._chrom_ids
+        self._codes.append(np.array([chrom_ids.setdefault(chrom, len(chrom_ids)) for chrom in chroms],
+                                    dtype=np.int32))
+        self._starts.append(np.asarray(starts, dtype=np.int64))
+        self._ends.append(np.asarray(ends, dtype=np.int64))
+        self._depths.append(np.asarray(depths, dtype=np.int64))
+
+    def finish(self):
+        """Retorna a RegionTable com todas as regiões lidas."""
+        if not self._starts:
+            return RegionTable([], [], [], [], [])
+        return RegionTable(list(self._chrom_ids), np.concatenate(self._codes), np.concatenate(self._starts),
+                           np.concatenate(self._ends), np.concatenate(self._depths))
+
+
+def read_bedcov_table(stream, batch_lines=65536):
+    """Lê a saída do samtools bedcov de `stream` (ex.: Popen.stdout) aos poucos; retorna a RegionTable."""
+    parser = BedcovStreamParser()
+    batch = []
+    for line in stream:
+        batch.append(line)
+        if len(batch) >= batch_lines:
+            parser.feed(batch)
+            batch = []
+    parser.feed(batch)
+    return parser.finish()
+
+
+def parse_bedcov_stream(stream, batch_lines=65536):
+    """Analisa a saída do samtools bedcov lendo `stream` (ex.: Popen.stdout) aos poucos."""
+    return summarize_region_coverage(read_bedcov_table(stream, batch_lines))
+
+
+def parse_bedcov_output(output):
+    """Analisa a saída do samtools bedcov (texto completo)."""
+    return parse_bedcov_stream(io.StringIO(output))
+
+
+def summarize_region_coverage(table):
+    """Calcula as métricas gerais a partir da RegionTable (profundidade somada do bedcov).
+
+    A profundidade média é a soma das profundidades dividida pelo total de bases;
+    os percentuais >= 10x/30x são as bases das regiões cuja profundidade média
+    (soma / tamanho da região) atinge o limiar.
+    """
+    lengths = table.lengths
+    total_bases = int(lengths.sum())
+    mean_depth = table.depths.sum() / total_bases if total_bases else 0
+    region_means = np.zeros(len(table), dtype=np.float64)
+    np.divide(table.depths, lengths, out=region_means, where=lengths > 0)
+    percent_10x = (lengths[region_means >= 10].sum() / total_bases) * 100 if total_bases else 0
+    percent_30x = (lengths[region_means >= 30].sum() / total_bases) * 100 if total_bases else 0
     
     return {
-        'mean_depth': mean_depth,
-        'percent_covered_10x': percent_10x,
-        'percent_covered_30x': percent_30x,
-        'region_coverage': results
+        'mean_depth': float(mean_depth),
+        'percent_covered_10x': float(percent_10x),
+        'percent_covered_30x': float(percent_30x),
+        'region_coverage': table
         }
 
-def calculate_coverage(bam_file, bed_file, samtools_path="samtools"):
-    """Calcula a cobertura nas regiões exônicas."""
-    
+def save_coverage_results(path, coverage_data):
+    """Grava o resultado do calculate_coverage (tabela + métricas) em .npz, de forma atômica."""
+    table = coverage_data['region_coverage']
+    summary = {key: value for key, value in coverage_data.items() if key != 'region_coverage'}
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".npz.tmp")
+    with os.fdopen(fd, "wb") as handle:
+        np.savez(handle, chrom_names=np.asarray(table.chrom_names, dtype=str), chrom_codes=table.chrom_codes,
+                 starts=table.starts, ends=table.ends, depths=table.depths, summary=json.dumps(summary))
+    os.replace(temp_path, path)
+
+
+def load_coverage_results(path):
+    """Lê um resultado gravado por save_coverage_results."""
+    with np.load(path) as data:
+        coverage_data = json.loads(str(data['summary']))
+        coverage_data['region_coverage'] = RegionTable(data['chrom_names'].tolist(), data['chrom_codes'],
+                                                       data['starts'], data['ends'], data['depths'])
+    return coverage_data
+
+
+def build_alignment_command(samtools_path, subcommand, options, alignment_file,
+                            ref_fasta=None, index_file=None):
+    """Monta o comando do samtools para ler um BAM ou diretamente um CRAM.
+
+    Para CRAM, `ref_fasta` é passado com --reference e, quando o índice .crai
+    não está ao lado do arquivo, `index_file` é informado com -X.
+    """
+    command = [samtools_path, subcommand]
+    if ref_fasta:
+        command.extend(["--reference", ref_fasta])
+    if index_file:
+        command.append("-X")
+    command.extend(options)
+    command.append(alignment_file)
+    if index_file:
+        command.append(index_file)
+    return command
+
+
+async def run_bedcov_async(bam_file, bed_file, samtools_path="samtools", ref_fasta=None, index_file=None):
+    """Executa o samtools bedcov e retorna a RegionTable (saída lida em fluxo, em lotes de linhas)."""
+    command = build_alignment_command(samtools_path, "bedcov", [bed_file], bam_file,
+                                      ref_fasta, index_file)
+    parser = BedcovStreamParser()
+    await run_tool(command, stdout_consumer=parser.feed, lines=True)
+    return parser.finish()
+
+
+def run_bedcov(bam_file, bed_file, samtools_path="samtools", ref_fasta=None, index_file=None):
+    """Versão síncrona de run_bedcov_async."""
+    return run_async(run_bedcov_async(bam_file, bed_file, samtools_path, ref_fasta, index_file))
+
+
+def shard_targets(chroms, lengths, shards, mode="balanced"):
+    """Divide os alvos (índices das linhas do BED) em até `shards` grupos para rodar em paralelo.
+
+    `mode="contig"` mantém cada contig inteiro em um grupo (contigs maiores primeiro,
+    sempre no grupo menos carregado); `mode="balanced"` corta a lista de alvos em
+    trechos contíguos com aproximadamente o mesmo total de bases.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if mode == "contig":
+        rows_by_contig = {}
+        for i, chrom in enumerate(chroms):
+            rows_by_contig.setdefault(chrom, []).append(i)
+        contig_rows = sorted(rows_by_contig.values(), key=lambda rows: -lengths[rows].sum())
+        groups = [[] for _ in range(min(shards, len(contig_rows)))]
+        loads = np.zeros(len(groups), dtype=np.int64)
+        for rows in contig_rows:
+            target = int(np.argmin(loads))
+            groups[target].extend(rows)
+            loads[target] += lengths[rows].sum()
+        return [np.sort(np.asarray(rows, dtype=np.int64)) for rows in groups if rows]
+    if mode != "balanced":
+        raise ValueError(f"Modo de divisão desconhecido: {mode}")
+
+    cumulative = np.cumsum(lengths)
+    total = int(cumulative[-1]) if len(cumulative) else 0
+    cuts = np.searchsorted(cumulative, np.arange(1, shards) * total / shards, side="right")
+    bounds = np.unique(np.concatenate(([0], cuts, [len(lengths)])))
+    return [np.arange(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1) if bounds[i + 1] > bounds[i]]
+
+
+def calculate_coverage_bedcov_sharded(bam_file, chroms, starts, ends, samtools_path="samtools", ref_fasta=None,
+                                      index_file=None, shards=2, shard_mode="balanced", temp_dir=None):
+    """Roda um samtools bedcov por grupo de alvos ao mesmo tempo (tool_runner) e junta na ordem do BED."""
+    depth_sums = np.zeros(len(chroms), dtype=np.int64)
+
+    async def run_shard(rows):
+        fd, shard_bed = tempfile.mkstemp(dir=temp_dir, suffix=".shard.bed")
+        try:
+            with os.fdopen(fd, "w") as bed:
+                bed.writelines(f"{chroms[i]}\t{starts[i]}\t{ends[i]}\n" for i in rows.tolist())
+            table = await run_bedcov_async(bam_file, shard_bed, samtools_path, ref_fasta, index_file)
+        finally:
+            os.remove(shard_bed)
+        if len(table) != len(rows):
+            raise RuntimeError(f"samtools bedcov retornou {len(table)} regiões para {len(rows)} alvos")
+        depth_sums[rows] = table.depths
+
+    async def run_all(shard_rows):
+        await asyncio.gather(*(run_shard(rows) for rows in shard_rows))
+
+    shard_rows = shard_targets(chroms, ends - starts, shards, shard_mode)
+    logging.info(f"Cobertura dividida em {len(shard_rows)} partes ({shard_mode})")
+    run_async(run_all(shard_rows))
+
+    chrom_ids = {}
+    chrom_codes = [chrom_ids.setdefault(chrom, len(chrom_ids)) for chrom in chroms]
+    return summarize_region_coverage(RegionTable(list(chrom_ids), chrom_codes, starts, ends, depth_sums))
+
+
+def calculate_coverage(bam_file, bed_file, samtools_path="samtools", ref_fasta=None, index_file=None,
+                       engine="samtools", target_index=None, shards=1, shard_mode="balanced"):
+    """Calcula a cobertura nas regiões exônicas (aceita BAM ou CRAM + .crai).
+
+    `engine="numpy"` usa o cálculo em processo (calculate_coverage_numpy),
+    disponível apenas para BAM indexado; para CRAM o samtools bedcov é usado.
+    Com `target_index` (TargetIndex em cache), o BED normalizado dele é usado.
+    Com `shards` > 1, os alvos são divididos (ver shard_targets) e processados
+    em paralelo; o resultado é o mesmo, na ordem do BED.
+    """
+    if target_index is not None:
+        bed_file = target_index.bed_path
+    if engine == "numpy":
+        if bam_file.endswith(".cram"):
+            logging.warning(f"Motor numpy não lê CRAM; usando samtools bedcov para {bam_file}")
+        else:
+            return calculate_coverage_numpy(bam_file, bed_file, index_file, target_index=target_index,
+                                            shards=shards, shard_mode=shard_mode)
+
     try:
+        if shards > 1:
+            if target_index is not None:
+                chroms = [name for name, _start, _end in target_index.iter_rows()]
+                starts, ends = target_index.starts, target_index.ends
+            else:
+                chroms, starts, ends = read_bed_targets(bed_file)
+            return calculate_coverage_bedcov_sharded(bam_file, chroms, starts, ends, samtools_path, ref_fasta,
+                                                     index_file, shards, shard_mode)
         # Use samtools bedcov
-        process = subprocess.Popen([samtools_path, "bedcov", bed_file, bam_file],
-                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        stdout, stderr = process.communicate()
-        
-        if stderr:
-            logging.error(f"Erro ao calcular cobertura: {stderr}")
-            raise Exception(stderr)
-        
-        coverage_data = parse_bedcov_output(stdout)
-        return coverage_data
+        return summarize_region_coverage(run_bedcov(bam_file, bed_file, samtools_path, ref_fasta, index_file))
     
     except FileNotFoundError:
-        logging.error(f"Ferramenta 'samtools' não encontrada. Verifique se está no PATH.")
+        # A mensagem já foi registrada pelo tool_runner
         raise
     except Exception as e:
         logging.error(f"Erro ao executar o cálculo de cobertura: {e}")
         raise
+
+
+def read_bed_targets(bed_file):
+    """Lê as regiões do BED na ordem do arquivo; retorna (cromossomos, inícios, fins)."""
+    chroms, starts, ends = [], [], []
+    with open(bed_file) as bed:
+        for line in bed:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            parts = line.split('\t')
+            chroms.append(parts[0])
+            starts.append(int(parts[1]))
+            ends.append(int(parts[2]))
+    return chroms, np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+
+
+def match_contig_name(chrom, contig_ids):
+    """Encontra o contig do BAM para um nome do BED, aceitando com ou sem o prefixo 'chr'."""
+    if chrom in contig_ids:
+        return contig_ids[chrom]
+    alternative = chrom[3:] if chrom.lower().startswith("chr") else f"chr{chrom}"
+    return contig_ids.get(alternative)
+
+
+def group_targets(starts, ends, max_gap=65536, max_span=4_000_000):
+    """Agrupa alvos próximos (já ordenados) para decodificar cada trecho do BAM uma só vez."""
+    groups = []
+    group_start = 0
+    group_beg, group_end = starts[0], ends[0]
+    for i in range(1, len(starts)):
+        if starts[i] - group_end > max_gap or max(group_end, ends[i]) - group_beg > max_span:
+            groups.append((group_start, i, group_beg, group_end))
+            group_start, group_beg, group_end = i, starts[i], ends[i]
+        else:
+            group_end = max(group_end, ends[i])
+    groups.append((group_start, len(starts), group_beg, group_end))
+    return groups
+
+
+def compute_target_depths(bam_file, index, contig_ids, chroms, starts, ends, rows, thresholds,
+                          depth_sums, bases_at_threshold):
+    """Preenche depth_sums/bases_at_threshold para as linhas `rows` do BED (abre seu próprio leitor)."""
+    targets_by_contig = {}
+    for i in rows.tolist():
+        targets_by_contig.setdefault(chroms[i], []).append(i)
+
+    with BgzfReader(bam_file) as reader:
+        for chrom, target_ids in targets_by_contig.items():
+            ref_id = match_contig_name(chrom, contig_ids)
+            if ref_id is None:
+                logging.warning(f"Contig {chrom} do BED não existe no BAM {bam_file}; cobertura 0")
+                continue
+            target_ids = np.asarray(target_ids)
+            target_ids = target_ids[np.argsort(starts[target_ids], kind="stable")]
+            contig_starts, contig_ends = starts[target_ids], ends[target_ids]
+
+            for first, last, group_beg, group_end in group_targets(contig_starts, contig_ends):
+                span = int(group_end - group_beg)
+                depth_change = np.zeros(span + 1, dtype=np.int64)
+                for read_starts, read_ends in fetch_read_intervals(reader, index[ref_id], ref_id,
+                                                                   int(group_beg), int(group_end)):
+                    depth_change += np.bincount(np.clip(read_starts - group_beg, 0, span), minlength=span + 1)
+                    depth_change -= np.bincount(np.clip(read_ends - group_beg, 0, span), minlength=span + 1)
+                depth = np.cumsum(depth_change[:-1])
+
+                # Somas acumuladas permitem obter cada alvo do grupo com duas leituras
+                ids = target_ids[first:last]
+                local_starts = contig_starts[first:last] - group_beg
+                local_ends = contig_ends[first:last] - group_beg
+                cumulative = np.concatenate(([0], np.cumsum(depth)))
+                depth_sums[ids] = cumulative[local_ends] - cumulative[local_starts]
+                for t, threshold in enumerate(thresholds):
+                    cumulative = np.concatenate(([0], np.cumsum(depth >= threshold)))
+                    bases_at_threshold[t, ids] = cumulative[local_ends] - cumulative[local_starts]
+
+
+def calculate_coverage_numpy(bam_file, bed_file, index_file=None, thresholds=(10, 30), target_index=None,
+                             shards=1, shard_mode="balanced"):
+    """Calcula a cobertura em processo, lendo o BAM pelo .bai com NumPy (sem samtools).
+
+    Retorna o mesmo dicionário de parse_bedcov_output (profundidade somada por
+    região, como o bedcov) e também a fração real de bases com profundidade
+    >= cada limiar em 'percent_bases_covered_<N>x'. Com `target_index`, os alvos
+    vêm do índice em cache em vez de uma nova leitura do BED. Com `shards` > 1,
+    os grupos de alvos são lidos em paralelo (threads; zlib e NumPy liberam o GIL).
+    """
+    if target_index is not None:
+        chroms = [name for name, _start, _end in target_index.iter_rows()]
+        starts, ends = target_index.starts, target_index.ends
+    else:
+        chroms, starts, ends = read_bed_targets(bed_file)
+    _, references = read_bam_header(bam_file)
+    index = read_bai(index_file or find_bam_index(bam_file))
+    contig_ids = {name: ref_id for ref_id, (name, _length) in enumerate(references)}
+
+    depth_sums = np.zeros(len(chroms), dtype=np.int64)
+    bases_at_threshold = np.zeros((len(thresholds), len(chroms)), dtype=np.int64)
+
+    shard_rows = shard_targets(chroms, ends - starts, shards, shard_mode) if shards > 1 else [np.arange(len(chroms))]
+    if len(shard_rows) > 1:
+        with ThreadPoolExecutor(max_workers=len(shard_rows)) as pool:
+            futures = [pool.submit(compute_target_depths, bam_file, index, contig_ids, chroms, starts, ends, rows,
+                                   thresholds, depth_sums, bases_at_threshold) for rows in shard_rows]
+            for future in futures:
+                future.result()
+    else:
+        compute_target_depths(bam_file, index, contig_ids, chroms, starts, ends, shard_rows[0], thresholds,
+                              depth_sums, bases_at_threshold)
+
+    chrom_ids = {}
+    chrom_codes = [chrom_ids.setdefault(chrom, len(chrom_ids)) for chrom in chroms]
+    coverage_data = summarize_region_coverage(RegionTable(list(chrom_ids), chrom_codes, starts, ends, depth_sums))
+    total_bases = int((ends - starts).sum())
+    for t, threshold in enumerate(thresholds):
+        coverage_data[f'percent_bases_covered_{threshold}x'] = (
+            bases_at_threshold[t].sum() / total_bases * 100 if total_bases else 0)
+    return coverage_data
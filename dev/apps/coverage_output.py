@@ -0,0 +1,273 @@
+# dev/coverage_output.py
+import functools
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+from bam_reader import BAI_MIN_SHIFT, query_chunks
+from bgzf import BGZF_MAX_BLOCK_DATA, BgzfReader, BgzfWriter
+
+# Cobertura por região em arquivo compactado e indexado: TSV em BGZF
+# (coverage_<amostra>_regions.tsv.gz) com índice tabix (.tbi) gerado aqui mesmo,
+# sem o tabix, e opcionalmente as mesmas colunas em binário (.npz). Tudo é
+# montado em lote a partir das colunas da RegionTable: o texto sai de uma vez,
+# os blocos BGZF têm tamanho fixo e os virtual offsets de cada linha (e com eles
+# os bins e o índice linear) são calculados com NumPy.
+# Consulta: `tabix arquivo.tsv.gz chr1:1000-2000` ou query_region_coverage.
+
+TABIX_FORMAT_BED = 0x10000  # genérico, coordenadas 0-based (preset bed do tabix)
+TSV_HEADER = "#chrom\tstart\tend\tdepth_sum\tmean_depth\n"
+BIN_LEVELS = ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1))
+
+
+def region_bins(begs, ends):
+    """Bin (esquema do BAI/tabix) de cada intervalo [beg, end), vetorizado."""
+    last = np.maximum(ends - 1, begs)
+    bins = np.zeros(len(begs), dtype=np.int64)
+    pending = np.ones(len(begs), dtype=bool)
+    for shift, offset in BIN_LEVELS:
+        fits = pending & ((begs >> shift) == (last >> shift))
+        bins[fits] = offset + (begs[fits] >> shift)
+        pending &= ~fits
+    return bins
+
+
+def region_lines(table):
+    """Linhas do TSV (bytes) e a posição do fim de cada uma (depois do '\\n')."""
+    mean_depth = np.zeros(len(table), dtype=np.float64)
+    np.divide(table.depths, table.lengths, out=mean_depth, where=table.lengths > 0)
+    names = table.chrom_names
+    body = "".join([f"{names[code]}\t{start}\t{end}\t{depth}\t{mean:.2f}\n" for code, start, end, depth, mean in
+                    zip(table.chrom_codes.tolist(), table.starts.tolist(), table.ends.tolist(),
+                        table.depths.tolist(), mean_depth.tolist())]).encode()
+    line_ends = np.flatnonzero(np.frombuffer(body, dtype=np.uint8) == ord("\n")) + 1
+    return body, line_ends
+
+
+def write_bgzf_blocks(path, data, compresslevel=6):
+    """Grava `data` em blocos BGZF de tamanho fixo; retorna o offset no arquivo de cada bloco
+    (mais um, o do fim), para converter posições descomprimidas em virtual offsets."""
+    block_offsets = []
+    with BgzfWriter(path, compresslevel) as writer:
+        for first in range(0, len(data), BGZF_MAX_BLOCK_DATA):
+            block_offsets.append(writer.tell() >> 16)
+            writer.write(data[first:first + BGZF_MAX_BLOCK_DATA])
+            writer.flush_block()
+        block_offsets.append(writer.tell() >> 16)
+    return np.asarray(block_offsets, dtype=np.uint64)
+
+
+def virtual_offsets(positions, block_offsets):
+    """Virtual offsets das posições descomprimidas (blocos de BGZF_MAX_BLOCK_DATA bytes)."""
+    blocks, within = np.divmod(positions, BGZF_MAX_BLOCK_DATA)
+    return (block_offsets[blocks] << np.uint64(16)) | within.astype(np.uint64)
+
+
+def build_tabix_index(codes, begs, ends, starts_voffset, ends_voffset):
+    """Bins, chunks e índice linear de cada contig a partir das colunas das linhas (ordenadas).
+
+    Retorna uma lista por contig de (bins, chunks por bin, array Nx2 de chunks ordenados
+    por bin, índice linear).
+    """
+    references = []
+    for code in range(int(codes.max()) + 1 if len(codes) else 0):
+        rows = np.flatnonzero(codes == code)
+        if not len(rows):
+            references.append((np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                               np.zeros((0, 2), dtype=np.uint64), np.zeros(0, dtype=np.uint64)))
+            continue
+        bins = region_bins(begs[rows], ends[rows])
+        # Chunks: linhas seguidas (no arquivo) no mesmo bin viram um chunk só
+        order = np.lexsort((rows, bins))
+        sorted_bins, sorted_rows = bins[order], rows[order]
+        new_chunk = np.ones(len(order), dtype=bool)
+        new_chunk[1:] = (sorted_bins[1:] != sorted_bins[:-1]) | (np.diff(sorted_rows) != 1)
+        first = np.flatnonzero(new_chunk)
+        last = np.append(first[1:], len(order)) - 1
+        chunk_bins = sorted_bins[first]
+        chunks = np.column_stack((starts_voffset[sorted_rows[first]], ends_voffset[sorted_rows[last]]))
+        bin_ids, chunk_counts = np.unique(chunk_bins, return_counts=True)
+
+        # Índice linear: menor offset de uma linha que cobre cada janela de 16 kb
+        window_first = begs[rows] >> BAI_MIN_SHIFT
+        window_last = np.maximum(ends[rows] - 1, begs[rows]) >> BAI_MIN_SHIFT
+        spans = window_last - window_first + 1
+        windows = np.repeat(window_first, spans) + (np.arange(spans.sum()) -
+                                                    np.repeat(np.cumsum(spans) - spans, spans))
+        linear = np.full(int(window_last.max()) + 1, np.iinfo(np.uint64).max, dtype=np.uint64)
+        np.minimum.at(linear, windows, np.repeat(starts_voffset[rows], spans))
+        # Janelas vazias herdam o offset da anterior (como o htslib); as do início ficam com 0
+        empty = linear == np.iinfo(np.uint64).max
+        previous = np.where(empty, 0, np.arange(len(linear)))
+        np.maximum.accumulate(previous, out=previous)
+        linear = linear[previous]
+        linear[linear == np.iinfo(np.uint64).max] = 0
+        references.append((bin_ids, chunk_counts, chunks, linear))
+    return references
+
+
+def write_tabix_index(tbi_path, chrom_names, references):
+    """Grava o índice .tbi (BGZF) no formato do tabix, preset bed."""
+    names = b"".join(name.encode() + b"\0" for name in chrom_names)
+    parts = [b"TBI\1", struct.pack("<8i", len(chrom_names), TABIX_FORMAT_BED, 1, 2, 3, ord("#"), 0, len(names)),
+             names]
+    for bin_ids, chunk_counts, chunks, linear in references:
+        # Cada bin ocupa uma palavra de 8 bytes (bin, n_chunk) seguida de 2 palavras por chunk:
+        # a seção inteira é montada como um único array de uint64
+        words_per_bin = 1 + 2 * chunk_counts
+        header_positions = np.cumsum(words_per_bin) - words_per_bin
+        words = np.empty(int(words_per_bin.sum()), dtype="<u8")
+        is_header = np.zeros(len(words), dtype=bool)
+        is_header[header_positions] = True
+        words[is_header] = bin_ids.astype(np.uint64) | (chunk_counts.astype(np.uint64) << np.uint64(32))
+        words[~is_header] = chunks.ravel()
+        parts.extend([struct.pack("<i", len(bin_ids)), words.tobytes(),
+                      struct.pack("<i", len(linear)), linear.astype("<u8", copy=False).tobytes()])
+    with BgzfWriter(tbi_path) as writer:
+        writer.write(b"".join(parts))
+
+
+def read_tabix_index(tbi_path):
+    """Lê um .tbi; retorna (nomes dos contigs, lista de dicionários como bam_reader.read_bai)."""
+    with BgzfReader(tbi_path) as reader:
+        data = b"".join(iter(lambda: reader.read(1 << 20), b""))
+    if data[:4] != b"TBI\1":
+        raise ValueError(f"Arquivo não está no formato tabix: {tbi_path}")
+    n_ref, _format, _seq, _beg, _end, _meta, _skip, l_nm = struct.unpack_from("<8i", data, 4)
+    position = 36
+    chrom_names = [name.decode() for name in data[position:position + l_nm].split(b"\0")[:n_ref]]
+    position += l_nm
+    references = []
+    for _ in range(n_ref):
+        n_bin = struct.unpack_from("<i", data, position)[0]
+        position += 4
+        bins = {}
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from("<Ii", data, position)
+            position += 8
+            bins[bin_id] = np.frombuffer(data, dtype="<u8", count=n_chunk * 2, offset=position).reshape(n_chunk, 2)
+            position += 16 * n_chunk
+        n_intv = struct.unpack_from("<i", data, position)[0]
+        position += 4
+        references.append({"bins": bins,
+                           "linear": np.frombuffer(data, dtype="<u8", count=n_intv, offset=position)})
+        position += 8 * n_intv
+    return chrom_names, references
+
+
+@functools.lru_cache(maxsize=16)
+def _cached_tabix_index(tbi_path, mtime_ns):
+    return read_tabix_index(tbi_path)
+
+
+def load_tabix_index(tbi_path):
+    """read_tabix_index memorizado por processo (relido se o .tbi mudar): consultas seguidas
+    no mesmo arquivo só pagam a leitura do índice uma vez."""
+    return _cached_tabix_index(tbi_path, os.stat(tbi_path).st_mtime_ns)
+
+
+def write_region_coverage(tsv_path, table, columnar_path=None, compresslevel=6):
+    """Grava a cobertura por região em TSV BGZF + .tbi (e .npz colunar com `columnar_path`).
+
+    As linhas são ordenadas por cromossomo (ordem de aparição) e início, como o tabix exige.
+    Retorna a lista de arquivos gravados.
+    """
+    order = np.lexsort((table.starts, table.chrom_codes))
+    if np.any(order != np.arange(len(order))):
+        table = type(table)(table.chrom_names, table.chrom_codes[order], table.starts[order],
+                            table.ends[order], table.depths[order])
+    header = TSV_HEADER.encode()
+    body, line_ends = region_lines(table)
+    line_ends += len(header)
+    line_starts = np.concatenate(([len(header)], line_ends[:-1]))
+
+    directory = os.path.dirname(tsv_path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_tsv = tempfile.mkstemp(dir=directory, suffix=".tsv.gz.tmp")
+    os.close(fd)
+    temp_tbi = f"{temp_tsv}.tbi"
+    try:
+        block_offsets = write_bgzf_blocks(temp_tsv, header + body, compresslevel)
+        starts_voffset = virtual_offsets(line_starts, block_offsets)
+        ends_voffset = virtual_offsets(line_ends, block_offsets)
+        references = build_tabix_index(table.chrom_codes, table.starts, table.ends, starts_voffset, ends_voffset)
+        write_tabix_index(temp_tbi, table.chrom_names, references)
+        os.replace(temp_tbi, f"{tsv_path}.tbi")
+        os.replace(temp_tsv, tsv_path)
+    finally:
+        for leftover in (temp_tsv, temp_tbi):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    outputs = [tsv_path, f"{tsv_path}.tbi"]
+
+    if columnar_path:
+        mean_depth = np.zeros(len(table), dtype=np.float32)
+        np.divide(table.depths, table.lengths, out=mean_depth, where=table.lengths > 0, casting="unsafe")
+        fd, temp_npz = tempfile.mkstemp(dir=directory, suffix=".npz.tmp")
+        with os.fdopen(fd, "wb") as handle:
+            np.savez(handle, chrom_names=np.asarray(table.chrom_names, dtype=str), chrom_codes=table.chrom_codes,
+                     starts=table.starts, ends=table.ends, depths=table.depths, mean_depth=mean_depth)
+        os.replace(temp_npz, columnar_path)
+        outputs.append(columnar_path)
+    return outputs
+
+
+def query_region_coverage(tsv_path, chrom, start=0, end=None):
+    """Regiões de `chrom` que se sobrepõem a [start, end), lidas com acesso aleatório pelo .tbi.
+
+    Retorna uma lista de tuplas (cromossomo, início, fim, profundidade somada, profundidade média).
+    """
+    chrom_names, references = load_tabix_index(f"{tsv_path}.tbi")
+    if chrom not in chrom_names:
+        return []
+    end = end if end is not None else 1 << 29
+    span = query_chunks(references[chrom_names.index(chrom)], start, end)
+    if span is None:
+        return []
+    first, last = span
+    parts = []
+    with BgzfReader(tsv_path) as reader:
+        reader.seek(first)
+        position = first
+        while position < last:
+            data, position = reader.read_blocks(1 << 16)
+            if not data:
+                break
+            parts.append(data)
+    regions = []
+    for line in b"".join(parts).split(b"\n")[:-1]:
+        fields = line.decode().split("\t")
+        if fields[0] != chrom:
+            continue
+        region_start, region_end = int(fields[1]), int(fields[2])
+        if region_start >= end:
+            break
+        if region_end > start:
+            regions.append((chrom, region_start, region_end, int(fields[3]), float(fields[4])))
+    return regions
+
+
+def parse_region(text):
+    """'chr1:1000-2000' (1-based, como no tabix) -> ('chr1', 999, 2000); 'chr1' -> ('chr1', 0, None)."""
+    chrom, _, span = text.partition(":")
+    if not span:
+        return chrom, 0, None
+    first, _, last = span.replace(",", "").partition("-")
+    return chrom, max(int(first) - 1, 0), int(last) if last else None
+
+
+# Execução direta: consulta de regiões em um coverage_<amostra>_regions.tsv.gz
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Consulta a cobertura por região (TSV BGZF indexado)")
+    parser.add_argument("tsv_gz", help="Arquivo coverage_<amostra>_regions.tsv.gz (com o .tbi ao lado)")
+    parser.add_argument("regions", nargs="+", help="Regiões no formato do tabix (ex.: chr1:1000-2000 ou chrX)")
+    args = parser.parse_args()
+
+    print(TSV_HEADER, end="")
+    for region in args.regions:
+        for chrom, start, end, depth, mean_depth in query_region_coverage(args.tsv_gz, *parse_region(region)):
+            print(f"{chrom}\t{start}\t{end}\t{depth}\t{mean_depth:.2f}")
@@ -0,0 +1,227 @@
+# dev/depth_stream.py
+import os
+import tempfile
+
+import numpy as np
+
+from coverage import build_alignment_command
+from tool_runner import run_tool_sync
+
+# Leitura em fluxo do `samtools depth` com memória limitada: a saída é lida em
+# blocos de bytes, convertida em lotes NumPy e repassada a "consumidores"
+# (ex.: histograma de profundidade) sem guardar as posições.
+
+DEFAULT_MAX_DEPTH = 10000
+DEFAULT_DEPTH_THRESHOLDS = (1, 10, 20, 30, 50, 100)
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+DEFAULT_QUANTIZE_THRESHOLDS = (1, 10, 30)  # classes 0, 1-9, 10-29 e 30+
+
+
+class DepthStreamParser:
+    """Converte blocos da saída do `samtools depth` (cromossomo, posição, profundidade) em arrays."""
+
+    def __init__(self):
+        self.chrom_names = []
+        self._chrom_ids = {}
+        self._pending = b""
+
+    def _chrom_code(self, name):
+        code = self._chrom_ids.get(name)
+        if code is None:
+            code = self._chrom_ids[name] = len(self.chrom_names)
+            self.chrom_names.append(name.decode())
+        return code
+
+    def parse(self, chunk, final=False):
+        """Analisa um bloco de bytes; retorna (códigos, posições 0-based, profundidades) ou None.
+
+        Linhas incompletas no fim do bloco ficam guardadas para o próximo.
+        """
+        data = self._pending + chunk
+        if final:
+            self._pending = b""
+        else:
+            cut = data.rfind(b"\n") + 1
+            data, self._pending = data[:cut], data[cut:]
+        tokens = data.split()
+        if not tokens:
+            return None
+        if len(tokens) % 3:
+            raise ValueError("Saída do samtools depth com número inesperado de colunas")
+
+        chroms = np.array(tokens[0::3])
+        positions = np.array(tokens[1::3]).astype(np.int64) - 1
+        depths = np.array(tokens[2::3]).astype(np.int64)
+
+        # O cromossomo muda raramente: converte só os pontos de troca em códigos
+        change = np.flatnonzero(np.concatenate(([True], chroms[1:] != chroms[:-1])))
+        run_codes = np.array([self._chrom_code(bytes(chroms[i])) for i in change], dtype=np.int32)
+        codes = np.repeat(run_codes, np.diff(np.append(change, len(chroms))))
+        return codes, positions, depths
+
+
+class DepthHistogram:
+    """Histograma de profundidade por base com tamanho fixo (profundidades acima de `max_depth` são agrupadas)."""
+
+    def __init__(self, max_depth=DEFAULT_MAX_DEPTH):
+        self.max_depth = max_depth
+        self.counts = np.zeros(max_depth + 1, dtype=np.int64)
+        self.depth_sum = 0
+
+    def feed(self, chrom_names, codes, positions, depths):
+        self.counts += np.bincount(np.minimum(depths, self.max_depth), minlength=self.max_depth + 1)
+        self.depth_sum += int(depths.sum())
+
+    def percentile(self, q):
+        """Percentil `q` (0-100) da profundidade por base."""
+        total = self.counts.sum()
+        if not total:
+            return 0
+        cumulative = np.cumsum(self.counts)
+        return int(np.searchsorted(cumulative, np.ceil(total * q / 100), side="left"))
+
+    def summary(self, thresholds=DEFAULT_DEPTH_THRESHOLDS, percentiles=DEFAULT_PERCENTILES):
+        """Métricas por base: total de bases, média, mediana, percentis e % de bases >= N."""
+        total_bases = int(self.counts.sum())
+        at_least = np.cumsum(self.counts[::-1])[::-1]  # at_least[d] = bases com profundidade >= d
+        return {
+            'total_bases': total_bases,
+            'mean_depth': self.depth_sum / total_bases if total_bases else 0,
+            'median_depth': self.percentile(50),
+            'percentiles': {q: self.percentile(q) for q in percentiles},
+            'percent_bases_at_least': {
+                threshold: (int(at_least[min(threshold, self.max_depth)]) / total_bases * 100 if total_bases else 0)
+                for threshold in thresholds
+            },
+            'max_depth': self.max_depth,
+        }
+
+
+def parse_quantize_thresholds(text):
+    """Converte '1,10,30' nos limiares crescentes das classes de profundidade."""
+    try:
+        thresholds = tuple(int(value) for value in str(text).split(",") if value.strip())
+    except ValueError:
+        raise ValueError(f"Limiares inválidos: {text} (use, por exemplo, 1,10,30)")
+    if not thresholds or thresholds[0] < 1 or any(b <= a for a, b in zip(thresholds, thresholds[1:])):
+        raise ValueError(f"Limiares devem ser inteiros crescentes maiores que zero: {text}")
+    return thresholds
+
+
+def quantize_labels(thresholds):
+    """Rótulos das classes: (1, 10, 30) -> ['0', '1-9', '10-29', '30+']."""
+    bounds = (0,) + tuple(thresholds)
+    labels = [f"{low}-{high - 1}" if high - 1 > low else f"{low}" for low, high in zip(bounds, bounds[1:])]
+    return labels + [f"{bounds[-1]}+"]
+
+
+class QuantizedCoverage:
+    """Consumidor que grava os alvos em trechos contínuos da mesma classe de profundidade (BED).
+
+    Cada lote é classificado de uma vez; trechos fechados vão direto para o
+    arquivo e só o trecho aberto no fim do lote fica em memória, para ser
+    estendido pelo lote seguinte. Use como gerenciador de contexto: o BED só
+    aparece (troca atômica) se a passagem terminar sem erro.
+    """
+
+    def __init__(self, bed_path, thresholds=DEFAULT_QUANTIZE_THRESHOLDS):
+        self.bed_path = bed_path
+        self.thresholds = np.asarray(thresholds, dtype=np.int64)
+        self.labels = quantize_labels(thresholds)
+        self.bases = np.zeros(len(self.labels), dtype=np.int64)
+        self.runs = 0
+        self._open_run = None  # (cromossomo, início, fim, classe)
+        self._handle = None
+
+    def __enter__(self):
+        directory = os.path.dirname(self.bed_path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, self._temp_path = tempfile.mkstemp(dir=directory, suffix=".bed.tmp")
+        self._handle = os.fdopen(fd, "w")
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self._write_run(self._open_run)
+            self._open_run = None
+        self._handle.close()
+        if exc_type is None:
+            os.replace(self._temp_path, self.bed_path)
+        else:
+            os.remove(self._temp_path)
+        return False
+
+    def _write_run(self, run):
+        if run is not None:
+            chrom, start, end, bucket = run
+            self._handle.write(f"{chrom}\t{start}\t{end}\t{self.labels[bucket]}\n")
+            self.runs += 1
+
+    def feed(self, chrom_names, codes, positions, depths):
+        buckets = np.searchsorted(self.thresholds, depths, side="right")
+        self.bases += np.bincount(buckets, minlength=len(self.labels))
+        # Um trecho começa onde muda o cromossomo, a classe ou há salto de posição (outro alvo)
+        breaks = np.flatnonzero(np.concatenate(([True], (codes[1:] != codes[:-1])
+                                                | (positions[1:] != positions[:-1] + 1)
+                                                | (buckets[1:] != buckets[:-1]))))
+        run_ends = np.append(breaks[1:], len(positions))
+        run_codes = codes[breaks].tolist()
+        run_starts = positions[breaks].tolist()
+        run_stops = (positions[run_ends - 1] + 1).tolist()
+        run_buckets = buckets[breaks].tolist()
+
+        first = (chrom_names[run_codes[0]], run_starts[0], run_stops[0], run_buckets[0])
+        open_run = self._open_run
+        if open_run is not None and open_run[0] == first[0] and open_run[2] == first[1] and open_run[3] == first[3]:
+            first = (open_run[0], open_run[1], first[2], first[3])
+        else:
+            self._write_run(open_run)
+        closed = [first] + [(chrom_names[code], start, stop, bucket) for code, start, stop, bucket
+                            in zip(run_codes[1:], run_starts[1:], run_stops[1:], run_buckets[1:])]
+        self._open_run = closed.pop()
+        self._handle.write("".join(f"{chrom}\t{start}\t{stop}\t{self.labels[bucket]}\n"
+                                   for chrom, start, stop, bucket in closed))
+        self.runs += len(closed)
+
+    def summary(self):
+        """Bases e percentual dos alvos em cada classe, e o número de trechos gravados."""
+        total = int(self.bases.sum())
+        return {
+            'total_bases': total,
+            'bases': dict(zip(self.labels, self.bases.tolist())),
+            'percent': {label: (int(count) / total * 100 if total else 0)
+                        for label, count in zip(self.labels, self.bases)},
+            'runs': self.runs,
+        }
+
+
+def stream_depth(alignment_file, bed_file, consumers, samtools_path="samtools", ref_fasta=None,
+                 index_file=None, chunk_bytes=8 * 1024 * 1024):
+    """Executa `samtools depth -a -b bed` e repassa cada lote aos consumidores (método feed).
+
+    Sem BED (bed_file=None), percorre o genoma inteiro, só com as posições cobertas.
+    Só um bloco de `chunk_bytes` da saída fica em memória por vez.
+    """
+    depth_args = ["-a", "-b", bed_file] if bed_file else []
+    command = build_alignment_command(samtools_path, "depth", depth_args, alignment_file, ref_fasta, index_file)
+    parser = DepthStreamParser()
+
+    def feed(chunk, final=False):
+        batch = parser.parse(chunk, final)
+        if batch is not None:
+            for consumer in consumers:
+                consumer.feed(parser.chrom_names, *batch)
+
+    run_tool_sync(command, stdout_consumer=feed, chunk_bytes=chunk_bytes)
+    feed(b"", final=True)
+
+
+def calculate_depth_distribution(alignment_file, bed_file, samtools_path="samtools", ref_fasta=None,
+                                 index_file=None, max_depth=DEFAULT_MAX_DEPTH,
+                                 thresholds=DEFAULT_DEPTH_THRESHOLDS):
+    """Distribuição exata da profundidade por base nos alvos do BED, com memória O(max_depth)."""
+    histogram = DepthHistogram(max_depth)
+    stream_depth(alignment_file, bed_file, [histogram], samtools_path, ref_fasta, index_file)
+    summary = histogram.summary(thresholds)
+    summary['histogram'] = histogram.counts
+    return summary
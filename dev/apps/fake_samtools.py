@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# dev/fake_samtools.py
+import os
+import shutil
+import sys
+
+import numpy as np
+
+from bam_reader import read_bam_header, read_bai, fetch_aligned_blocks, find_bam_index
+from bgzf import BgzfReader
+from coverage import calculate_coverage_numpy, group_targets, match_contig_name
+from synthetic_data import index_bam
+from target_index import build_target_index
+
+# Substituto do samtools para benchmarks e testes em máquinas sem o binário.
+# Implementa só o que o pipeline usa (view, index, bedcov, depth, idxstats e
+# --version) em cima do leitor BAM em NumPy. Não lê CRAM de verdade: nos dados
+# sintéticos o "CRAM" é uma cópia do BAM (e o .crai uma cópia do .bai).
+
+FAKE_VERSION = "samtools 1.21 (fake_samtools)"
+
+# Opções que recebem um valor (as demais são tratadas como flags)
+OPTIONS_WITH_VALUE = {"-@", "-o", "-l", "-T", "--reference", "-b", "-r", "-m", "-Q", "-q", "-O", "--threads"}
+
+
+def split_arguments(arguments):
+    """Separa opções ({opção: valor ou True}) e argumentos posicionais."""
+    options, positional = {}, []
+    i = 0
+    while i < len(arguments):
+        argument = arguments[i]
+        if argument in OPTIONS_WITH_VALUE:
+            options[argument] = arguments[i + 1]
+            i += 2
+            continue
+        if argument.startswith("-") and argument != "-":
+            options[argument] = True
+        else:
+            positional.append(argument)
+        i += 1
+    return options, positional
+
+
+def alignment_and_index(options, positional):
+    """Arquivo de alinhamento e índice (-X informa o índice depois do arquivo)."""
+    if options.get("-X"):
+        return positional[-2], positional[-1]
+    return positional[-1], None
+
+
+def command_view(options, positional):
+    """Copia a entrada (arquivo ou stdin) para a saída; com ##idx## também gera o .bai."""
+    output = options.get("-o")
+    index_path = None
+    if output and "##idx##" in output:
+        output, index_path = output.split("##idx##")
+    source = positional[-1] if positional else "-"
+    with (sys.stdin.buffer if source == "-" else open(source, "rb")) as reader:
+        with (open(output, "wb") if output else sys.stdout.buffer) as writer:
+            shutil.copyfileobj(reader, writer, 4 * 1024 * 1024)
+    if index_path:
+        index_bam(output, index_path)
+
+
+def command_index(options, positional):
+    index_bam(positional[0], positional[1] if len(positional) > 1 else None)
+
+
+def command_bedcov(options, positional):
+    bed_file = positional[0]
+    alignment_file, index_file = alignment_and_index(options, positional[1:])
+    table = calculate_coverage_numpy(alignment_file, bed_file, index_file)['region_coverage']
+    out = sys.stdout
+    for chrom, start, end, depth in table.iter_rows():
+        out.write(f"{chrom}\t{start}\t{end}\t{depth}\n")
+
+
+def command_depth(options, positional):
+    """samtools depth -a -b bed: profundidade de cada posição dos alvos (alvos sobrepostos unidos).
+    Sem -b: todas as posições cobertas do genoma. Deleções e íntrons não contam, como no samtools."""
+    alignment_file, index_file = alignment_and_index(options, positional)
+    _, references = read_bam_header(alignment_file)
+    index = read_bai(index_file or find_bam_index(alignment_file))
+    contig_ids = {name: ref_id for ref_id, (name, _length) in enumerate(references)}
+    out = sys.stdout.buffer
+    if "-b" not in options:
+        with BgzfReader(alignment_file) as reader:
+            for ref_id, (contig, length) in enumerate(references):
+                depth = np.zeros(length + 1, dtype=np.int64)
+                for read_starts, read_ends in fetch_aligned_blocks(reader, index[ref_id], ref_id, 0, length):
+                    depth += np.bincount(np.clip(read_starts, 0, length), minlength=length + 1)
+                    depth -= np.bincount(np.clip(read_ends, 0, length), minlength=length + 1)
+                depth = np.cumsum(depth[:-1])
+                covered = np.flatnonzero(depth)
+                out.write("".join(f"{contig}\t{p}\t{d}\n" for p, d in zip((covered + 1).tolist(),
+                                                                         depth[covered].tolist())).encode())
+        return
+    targets = build_target_index(options["-b"])
+    with BgzfReader(alignment_file) as reader:
+        for contig in targets.contig_names:
+            block = targets.contig_slice(contig)
+            starts, ends = targets.starts[block], targets.ends[block]
+            ref_id = match_contig_name(contig, contig_ids)
+            for first, last, group_beg, group_end in group_targets(starts, ends):
+                span = int(group_end - group_beg)
+                depth = np.zeros(span + 1, dtype=np.int64)
+                if ref_id is not None:
+                    for read_starts, read_ends in fetch_aligned_blocks(reader, index[ref_id], ref_id,
+                                                                       int(group_beg), int(group_end)):
+                        depth += np.bincount(np.clip(read_starts - group_beg, 0, span), minlength=span + 1)
+                        depth -= np.bincount(np.clip(read_ends - group_beg, 0, span), minlength=span + 1)
+                depth = np.cumsum(depth[:-1])
+                for start, end in zip(starts[first:last].tolist(), ends[first:last].tolist()):
+                    positions = np.arange(start + 1, end + 1)
+                    values = depth[start - group_beg:end - group_beg]
+                    out.write("".join(f"{contig}\t{p}\t{d}\n" for p, d in zip(positions.tolist(),
+                                                                               values.tolist())).encode())
+
+
+def command_idxstats(options, positional):
+    alignment_file, index_file = alignment_and_index(options, positional)
+    _, references = read_bam_header(alignment_file)
+    index = read_bai(index_file or find_bam_index(alignment_file))
+    for (name, length), entry in zip(references, index):
+        print(f"{name}\t{length}\t{entry['mapped']}\t{entry['unmapped']}")
+    print("*\t0\t0\t0")
+
+
+COMMANDS = {
+    "view": command_view,
+    "index": command_index,
+    "bedcov": command_bedcov,
+    "depth": command_depth,
+    "idxstats": command_idxstats,
+}
+
+
+def main(arguments):
+    if not arguments or arguments[0] in ("--version", "version"):
+        print(FAKE_VERSION)
+        return 0
+    command = COMMANDS.get(arguments[0])
+    if command is None:
+        print(f"fake_samtools: subcomando não suportado: {arguments[0]}", file=sys.stderr)
+        return 1
+    options, positional = split_arguments(arguments[1:])
+    try:
+        command(options, positional)
+    except BrokenPipeError:
+        # Quem lê a saída encerrou antes (ex.: head); não é erro
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    except Exception as e:
+        print(f"fake_samtools {arguments[0]}: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
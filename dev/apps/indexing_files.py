@@ -1,45 +1,48 @@
 import os
-import subprocess
-import threading
-import time
+import psutil
 from tqdm import tqdm
 
-def index_bam_with_progress(bam_file, samtools_path="samtools"):
-    """Indexa um arquivo BAM com samtools e exibe uma barra de progresso simulada."""
-    bai_file = bam_file + ".bai"
-    estimated_time = 10  # segundos (ajustável)
+from tool_runner import ToolError, run_tool_sync
 
-    pbar = tqdm(total=estimated_time, desc="Indexando BAM", bar_format="{desc}: {elapsed} elapsed", colour='green')
-    stop_event = threading.Event()
+def index_bam_with_progress(bam_file, samtools_path="samtools", threads=1, show_progress=True):
+    """Indexa um arquivo BAM com samtools, com barra de progresso pelos bytes lidos pelo processo.
 
-    def fake_progress():
-        for _ in range(estimated_time):
-            if stop_event.is_set():
-                break
-            pbar.update(1)
-            time.sleep(1)
+    Usado apenas para BAMs sem índice; o convert_cram_to_bam já grava o .bai.
+    """
+    bam_size = os.path.getsize(bam_file)
+    pbar = tqdm(total=bam_size, desc="Indexando BAM", unit='B', unit_scale=True, colour='green',
+                disable=not show_progress)
 
-    def wait_for_index():
-        while not stop_event.is_set():
-            if os.path.exists(bai_file):
-                stop_event.set()
-                break
-            time.sleep(0.5)
+    def update_progress(pid):
+        try:
+            pbar.n = min(psutil.Process(pid).io_counters().read_chars, bam_size)
+            pbar.refresh()
+        except (psutil.Error, AttributeError):
+            # Processo já encerrado ou contadores de I/O indisponíveis nesta plataforma
+            pass
 
     try:
-        thread1 = threading.Thread(target=fake_progress)
-        thread2 = threading.Thread(target=wait_for_index)
-        thread1.start()
-        thread2.start()
+        run_tool_sync([samtools_path, "index", "-@", str(threads), bam_file],
+                      monitor=update_progress if show_progress else None)
+        pbar.n = bam_size
 
-        subprocess.run([samtools_path, "index", bam_file], check=True)
-
-        thread1.join()
-        thread2.join()
-
-    except subprocess.CalledProcessError as e:
+    except ToolError as e:
         raise RuntimeError(f"Erro ao indexar BAM: {e}")
     finally:
-        pbar.n = estimated_time
         pbar.refresh()
         pbar.close()
+
+
+def find_crai_file(cram_file, crai_dir=None):
+    """Localiza o índice .crai de um CRAM (em crai_dir ou ao lado do CRAM)."""
+    cram_name = os.path.basename(cram_file)
+    sample_name = os.path.splitext(cram_name)[0]
+    candidates = []
+    for directory in (crai_dir, os.path.dirname(cram_file)):
+        if directory:
+            candidates.append(os.path.join(directory, f"{cram_name}.crai"))
+            candidates.append(os.path.join(directory, f"{sample_name}.crai"))
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    raise FileNotFoundError(f"Índice CRAI não encontrado para {cram_file} (procurado em: {', '.join(candidates)})")
@@ -0,0 +1,284 @@
+# dev/intermediate_storage.py
+import fcntl
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Orçamento de disco para os BAMs intermediários (intermediate/bam_files). Um
+# registro JSON (.storage.json, protegido por trava fcntl) guarda, por amostra,
+# os arquivos (BAM + .bai), os bytes ocupados, o último uso e as etapas que ainda
+# vão ler o BAM. Enquanto alguma etapa precisa dele, o BAM fica preso; depois
+# disso pode ser removido, do menos usado recentemente para o mais recente, para
+# abrir espaço para novas conversões. Uma conversão que não cabe no orçamento
+# espera até que outras amostras liberem seus BAMs.
+# Com o diretório compartilhado entre nós (modo fila), o dono renova suas reservas
+# periodicamente (heartbeat); a reserva de outra máquina sem renovação há mais de
+# pin_ttl segundos é de um nó que caiu e deixa de prender o BAM.
+
+LEDGER_VERSION = 1
+POLL_SECONDS = 5
+PIN_TTL_SECONDS = 300
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(text):
+    """Converte tamanhos como '500G', '1.5T' ou '1048576' em bytes."""
+    value = str(text).strip().upper().removesuffix("B").removesuffix("I")
+    unit = value[-1] if value and value[-1] in SIZE_UNITS else ""
+    try:
+        size = float(value[:len(value) - len(unit)]) * SIZE_UNITS[unit]
+    except ValueError:
+        raise ValueError(f"Tamanho inválido: {text} (use, por exemplo, 500G)")
+    if size <= 0:
+        raise ValueError(f"Tamanho deve ser maior que zero: {text}")
+    return int(size)
+
+
+def format_size(size):
+    for unit in ("T", "G", "M", "K"):
+        if size >= SIZE_UNITS[unit]:
+            return f"{size / SIZE_UNITS[unit]:.1f}{unit}"
+    return f"{size}B"
+
+
+def owner_token():
+    """Dono das reservas: máquina e processo principal do pipeline."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def owner_alive(owner):
+    """False só quando o dono é desta máquina e o processo não existe mais
+    (donos de outras máquinas são avaliados pela renovação da reserva)."""
+    host, _, pid = owner.rpartition(":")
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+    return True
+
+
+class IntermediateStorage:
+    """Gerenciador dos BAMs intermediários com orçamento de `budget_bytes`."""
+
+    def __init__(self, directory, budget_bytes, owner=None, poll_seconds=POLL_SECONDS, pin_ttl=PIN_TTL_SECONDS):
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self.owner = owner or owner_token()
+        self.poll_seconds = poll_seconds
+        self.pin_ttl = pin_ttl
+        self.ledger_path = os.path.join(directory, ".storage.json")
+        self.lock_path = os.path.join(directory, ".storage.lock")
+
+    @contextmanager
+    def locked(self):
+        """Trava exclusiva do registro (fcntl) e o registro carregado; grava ao sair."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.lock_path, "a") as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                ledger = self._read_ledger()
+                self._adopt_untracked(ledger)
+                yield ledger
+                self._write_ledger(ledger)
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _read_ledger(self):
+        if os.path.exists(self.ledger_path):
+            try:
+                with open(self.ledger_path) as handle:
+                    ledger = json.load(handle)
+                if ledger.get("version") == LEDGER_VERSION:
+                    return ledger
+            except (OSError, ValueError) as e:
+                logging.warning(f"Registro de armazenamento ilegível, recriado: {self.ledger_path}: {e}")
+        return {"version": LEDGER_VERSION, "entries": {}}
+
+    def _write_ledger(self, ledger):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".json.tmp")
+        with os.fdopen(fd, "w") as handle:
+            json.dump(ledger, handle, indent=2)
+        os.replace(temp_path, self.ledger_path)
+
+    def bam_files(self, sample_name):
+        bam_file = os.path.join(self.directory, f"{sample_name}.bam")
+        return [bam_file, f"{bam_file}.bai"]
+
+    def _adopt_untracked(self, ledger):
+        """BAMs de execuções anteriores (sem registro) entram como removíveis, pela data de modificação."""
+        entries = ledger["entries"]
+        for name in os.listdir(self.directory):
+            if not name.endswith(".bam"):
+                continue
+            sample_name = name[:-len(".bam")]
+            if sample_name in entries:
+                continue
+            files = self.bam_files(sample_name)
+            entries[sample_name] = {
+                "files": files,
+                "bytes": sum(os.path.getsize(path) for path in files if os.path.exists(path)),
+                "last_used": os.path.getmtime(files[0]),
+                "pin": None,
+            }
+        # Registros cujos arquivos sumiram (removidos à mão) deixam de contar
+        for sample_name in [name for name, entry in entries.items()
+                            if entry["pin"] is None and not os.path.exists(entry["files"][0])]:
+            del entries[sample_name]
+
+    def _pin_alive(self, pin):
+        """Reserva desta máquina: o processo dono existe. De outra máquina: renovada há menos de pin_ttl."""
+        host, _, _pid = pin["owner"].rpartition(":")
+        if host == socket.gethostname():
+            return owner_alive(pin["owner"])
+        return time.time() - pin.get("renewed_at", 0) < self.pin_ttl
+
+    def _is_pinned(self, entry):
+        pin = entry["pin"]
+        return pin is not None and bool(pin["stages"]) and self._pin_alive(pin)
+
+    def _evict(self, ledger, needed_bytes):
+        """Remove BAMs sem etapas pendentes (LRU) até caber `needed_bytes`; retorna os bytes livres."""
+        entries = ledger["entries"]
+        used = sum(entry["bytes"] for entry in entries.values())
+        candidates = sorted((entry["last_used"], sample_name) for sample_name, entry in entries.items()
+                            if not self._is_pinned(entry))
+        for _last_used, sample_name in candidates:
+            if used + needed_bytes <= self.budget_bytes:
+                break
+            entry = entries.pop(sample_name)
+            for path in entry["files"]:
+                if os.path.exists(path):
+                    os.remove(path)
+            used -= entry["bytes"]
+            logging.info(f"BAM intermediário de {sample_name} removido ({format_size(entry['bytes'])}) "
+                         f"para liberar espaço")
+        return self.budget_bytes - used
+
+    def acquire(self, sample_name, stages, estimate_bytes):
+        """Prende o BAM da amostra para as `stages` que vão lê-lo.
+
+        Se o BAM ainda não existe, reserva `estimate_bytes` no orçamento, removendo
+        BAMs de outras amostras sem etapas pendentes e, se ainda faltar espaço,
+        esperando outras amostras terminarem. Retorna os segundos de espera.
+        """
+        waited = 0.0
+        while True:
+            with self.locked() as ledger:
+                entries = ledger["entries"]
+                entry = entries.get(sample_name)
+                pin = {"owner": self.owner, "stages": list(stages), "renewed_at": time.time()}
+                if entry is not None and os.path.exists(entry["files"][0]):
+                    entry.update(pin=pin, last_used=time.time())
+                    return waited
+                free = self._evict(ledger, estimate_bytes)
+                others_pinned = any(self._is_pinned(other) for name, other in entries.items()
+                                    if name != sample_name)
+                # Um BAM maior que o orçamento inteiro passa quando nada mais ocupa espaço
+                if free >= estimate_bytes or not others_pinned:
+                    if free < estimate_bytes:
+                        logging.warning(f"BAM estimado de {sample_name} ({format_size(estimate_bytes)}) "
+                                        f"excede o orçamento livre ({format_size(max(free, 0))})")
+                    entries[sample_name] = {"files": self.bam_files(sample_name), "bytes": estimate_bytes,
+                                            "last_used": time.time(), "pin": pin}
+                    return waited
+            if not waited:
+                logging.info(f"Conversão de {sample_name} aguardando espaço no orçamento de BAMs "
+                             f"({format_size(self.budget_bytes)})")
+            time.sleep(self.poll_seconds)
+            waited += self.poll_seconds
+
+    def commit(self, sample_name):
+        """Atualiza os bytes reservados com o tamanho real do BAM e do .bai."""
+        with self.locked() as ledger:
+            entry = ledger["entries"].get(sample_name)
+            if entry is not None:
+                entry["bytes"] = sum(os.path.getsize(path) for path in entry["files"] if os.path.exists(path))
+
+    def stage_done(self, sample_name, stage):
+        """Uma etapa terminou de ler o BAM; sem etapas pendentes, ele pode ser removido."""
+        with self.locked() as ledger:
+            entry = ledger["entries"].get(sample_name)
+            if entry is not None and entry["pin"] is not None and stage in entry["pin"]["stages"]:
+                entry["pin"]["stages"].remove(stage)
+                entry["last_used"] = time.time()
+
+    def renew(self):
+        """Renova as reservas deste dono (chamado pelo heartbeat)."""
+        with self.locked() as ledger:
+            now = time.time()
+            for entry in ledger["entries"].values():
+                if entry["pin"] is not None and entry["pin"]["owner"] == self.owner:
+                    entry["pin"]["renewed_at"] = now
+
+    @contextmanager
+    def heartbeat(self, interval=None):
+        """Renova as reservas em uma thread enquanto o bloco executa."""
+        interval = interval or max(1.0, self.pin_ttl / 5)
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                try:
+                    self.renew()
+                except OSError as e:
+                    logging.error(f"Erro ao renovar reservas de BAMs em {self.directory}: {e}")
+
+        thread = threading.Thread(target=beat, name="storage-heartbeat", daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+
+    def release(self, sample_name):
+        """Solta o BAM da amostra (fim do processamento, com sucesso ou erro)."""
+        with self.locked() as ledger:
+            entry = ledger["entries"].get(sample_name)
+            if entry is not None and entry["pin"] is not None:
+                entry["pin"] = None
+                if not os.path.exists(entry["files"][0]):
+                    # Reserva de uma conversão que falhou
+                    del ledger["entries"][sample_name]
+
+    def usage(self):
+        """(bytes ocupados, bytes presos por etapas pendentes, número de BAMs)."""
+        with self.locked() as ledger:
+            entries = ledger["entries"].values()
+            return (sum(entry["bytes"] for entry in entries),
+                    sum(entry["bytes"] for entry in entries if self._is_pinned(entry)), len(entries))
+
+    def trim(self):
+        """Remove BAMs sem etapas pendentes até o total caber no orçamento."""
+        with self.locked() as ledger:
+            return self._evict(ledger, 0)
+
+
+# Execução direta: uso do orçamento e remoção dos BAMs excedentes
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Orçamento de disco dos BAMs intermediários")
+    parser.add_argument("bam_dir", help="Diretório dos BAMs (ex.: data/intermediate/bam_files)")
+    parser.add_argument("--budget", required=True, help="Orçamento em bytes ou com unidade (ex.: 500G)")
+    parser.add_argument("--trim", action="store_true", help="Remove BAMs sem etapas pendentes até caber no orçamento")
+    args = parser.parse_args()
+
+    try:
+        storage = IntermediateStorage(args.bam_dir, parse_size(args.budget))
+    except ValueError as e:
+        parser.error(str(e))
+    if args.trim:
+        storage.trim()
+    used, pinned, count = storage.usage()
+    print(f"{count} BAMs ocupando {format_size(used)} de {format_size(storage.budget_bytes)} "
+          f"({format_size(pinned)} presos por etapas pendentes)")
@@ -0,0 +1,172 @@
+# dev/metrics.py
+import fcntl
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import psutil
+
+# Telemetria por etapa: tempo de relógio, tempo de CPU (do processo e dos processos
+# filhos, ex.: samtools), pico de memória (RSS) dos filhos e bytes lidos/gravados.
+# Cada etapa vira uma linha JSON em output/logs/metrics.jsonl.
+
+SAMPLE_INTERVAL = 0.2  # segundos entre amostragens dos processos filhos
+
+
+def read_io_counters(process):
+    """Contadores de I/O do processo (dicionário) ou None se indisponíveis nesta plataforma."""
+    try:
+        counters = process.io_counters()
+    except (psutil.Error, AttributeError, NotImplementedError):
+        return None
+    return {
+        "read_bytes": counters.read_bytes,
+        "write_bytes": counters.write_bytes,
+        "read_chars": getattr(counters, "read_chars", counters.read_bytes),
+        "write_chars": getattr(counters, "write_chars", counters.write_bytes),
+    }
+
+
+class StageMetrics:
+    """Mede uma etapa (usar com `with`) e grava o resultado ao sair.
+
+    Os processos filhos são amostrados em uma thread: pico de RSS somado e os
+    últimos contadores de I/O vistos de cada filho (um filho que termina entre
+    duas amostragens tem os bytes finais subestimados).
+    """
+
+    def __init__(self, metrics_file, sample, stage, **extra):
+        self.metrics_file = metrics_file
+        self.sample = sample
+        self.stage = stage
+        self.extra = extra
+        self.record = None
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._children_io = {}
+        self._peak_children_rss = 0
+        self._peak_rss = 0
+
+    def _sample(self):
+        try:
+            children = self._process.children(recursive=True)
+            self._peak_rss = max(self._peak_rss, self._process.memory_info().rss)
+        except psutil.Error:
+            return
+        total_rss = 0
+        for child in children:
+            try:
+                total_rss += child.memory_info().rss
+            except psutil.Error:
+                continue
+            counters = read_io_counters(child)
+            if counters is not None:
+                self._children_io[child.pid] = counters
+        self._peak_children_rss = max(self._peak_children_rss, total_rss)
+
+    def _sampler(self):
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            self._sample()
+
+    def __enter__(self):
+        self._start_wall = time.time()
+        self._start_cpu = self._process.cpu_times()
+        self._start_io = read_io_counters(self._process)
+        self._sample()
+        self._thread = threading.Thread(target=self._sampler, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        end_cpu = self._process.cpu_times()
+        end_io = read_io_counters(self._process)
+
+        record = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self._start_wall)),
+            "host": socket.gethostname(),
+            "pid": self._process.pid,
+            "sample": self.sample,
+            "stage": self.stage,
+            "status": "ok" if exc_type is None else "erro",
+            "wall_seconds": round(time.time() - self._start_wall, 3),
+            "cpu_user_seconds": round(end_cpu.user - self._start_cpu.user, 3),
+            "cpu_system_seconds": round(end_cpu.system - self._start_cpu.system, 3),
+            "children_cpu_user_seconds": round(end_cpu.children_user - self._start_cpu.children_user, 3),
+            "children_cpu_system_seconds": round(end_cpu.children_system - self._start_cpu.children_system, 3),
+            "peak_rss_bytes": self._peak_rss,
+            "peak_children_rss_bytes": self._peak_children_rss,
+        }
+        # Bytes do próprio processo (diferença) + dos processos filhos vistos durante a etapa
+        for key in ("read_bytes", "write_bytes", "read_chars", "write_chars"):
+            own = end_io[key] - self._start_io[key] if end_io and self._start_io else 0
+            record[key] = own + sum(counters[key] for counters in self._children_io.values())
+        record.update(self.extra)
+        self.record = record
+
+        if self.metrics_file:
+            try:
+                append_metrics(self.metrics_file, record)
+            except OSError as e:
+                logging.warning(f"Não foi possível gravar métricas em {self.metrics_file}: {e}")
+        return False
+
+
+def append_metrics(metrics_file, record):
+    """Acrescenta uma linha JSON ao arquivo (com trava, seguro entre processos)."""
+    os.makedirs(os.path.dirname(metrics_file), exist_ok=True)
+    with open(metrics_file, "a") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            handle.write(json.dumps(record) + "\n")
+            handle.flush()
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def summarize_metrics(metrics_file):
+    """Totais por etapa: execuções, tempo total/médio/máximo, CPU, pico de RSS e bytes lidos/gravados."""
+    summary = {}
+    with open(metrics_file) as handle:
+        for line in handle:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            stage = summary.setdefault(record["stage"], {
+                "runs": 0, "errors": 0, "wall_seconds": 0.0, "max_wall_seconds": 0.0,
+                "cpu_seconds": 0.0, "peak_children_rss_bytes": 0, "read_chars": 0, "write_chars": 0,
+            })
+            stage["runs"] += 1
+            stage["errors"] += record["status"] != "ok"
+            stage["wall_seconds"] += record["wall_seconds"]
+            stage["max_wall_seconds"] = max(stage["max_wall_seconds"], record["wall_seconds"])
+            stage["cpu_seconds"] += (record["cpu_user_seconds"] + record["cpu_system_seconds"]
+                                     + record["children_cpu_user_seconds"] + record["children_cpu_system_seconds"])
+            stage["peak_children_rss_bytes"] = max(stage["peak_children_rss_bytes"],
+                                                   record["peak_children_rss_bytes"])
+            # read_chars/write_chars contam também o que veio do cache de páginas
+            stage["read_chars"] += record["read_chars"]
+            stage["write_chars"] += record["write_chars"]
+    return summary
+
+
+# Execução direta: resumo das métricas de um lote
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Resumo por etapa de output/logs/metrics.jsonl")
+    parser.add_argument("metrics_file", help="Arquivo metrics.jsonl gerado pelo pipeline")
+    args = parser.parse_args()
+
+    print(f"{'Etapa':<12}{'Execuções':>10}{'Erros':>7}{'Tempo (s)':>11}{'Médio (s)':>11}"
+          f"{'Máx (s)':>9}{'CPU (s)':>10}{'Pico RSS (MB)':>15}{'Lido (MB)':>11}{'Gravado (MB)':>14}")
+    for name, stage in summarize_metrics(args.metrics_file).items():
+        print(f"{name:<12}{stage['runs']:>10}{stage['errors']:>7}{stage['wall_seconds']:>11.1f}"
+              f"{stage['wall_seconds'] / stage['runs']:>11.1f}{stage['max_wall_seconds']:>9.1f}"
+              f"{stage['cpu_seconds']:>10.1f}{stage['peak_children_rss_bytes'] / 2**20:>15.1f}"
+              f"{stage['read_chars'] / 2**20:>11.1f}{stage['write_chars'] / 2**20:>14.1f}")
@@ -1,46 +1,207 @@
 # dev/panelmapcreate.py
 
+import gzip
+import hashlib
 import os
+import struct
 import subprocess
 import logging
 
-# Não implementado
+from bgzf import BgzfReader
+from coverage_output import read_tabix_index
+from target_index import build_target_index, file_sha256, natural_contig_key, normalize_contig_name
+from tool_runner import run_tool_sync, run_tools_sync
 
-def prepare_verifybamid_panel(chromossome_dir, intermediate_dir, output_name):
-    """
-    Concatena arquivos .vcf.gz válidos com bcftools e salva painel final para uso no VerifyBamID.
-    Caminhos devem ser absolutos.
-    """
-    chromossome_dir = os.path.abspath(chromossome_dir)
-    intermediate_dir = os.path.abspath(intermediate_dir)
-    os.makedirs(intermediate_dir, exist_ok=True)
-    output_path = os.path.join(intermediate_dir, output_name)
+# Painel de SNPs para a estimativa de contaminação, montado uma vez por coorte:
+# cada VCF por cromossomo é filtrado em paralelo (bcftools view: só alvos do exoma,
+# SNPs bialélicos comuns, sem genótipos) e só as saídas pequenas são concatenadas.
+# O resultado fica em intermediate/<diretório>/<chave>/, com a chave formada pelo
+# conjunto de VCFs (caminho, tamanho e data), o hash do BED e o MAF mínimo.
 
-    # Filtra apenas arquivos .vcf.gz (ignora .tbi e outros)
-    vcf_files = sorted([
+PANEL_VERSION = 1
+DEFAULT_MIN_MAF = 0.01
+
+
+def list_panel_vcfs(chromossome_dir):
+    """Arquivos .vcf.gz do diretório (ignora .tbi e outros)."""
+    return sorted([
         os.path.join(chromossome_dir, f)
         for f in os.listdir(chromossome_dir)
         if f.endswith(".vcf.gz")
     ])
 
+
+def csi_contig_names(csi_path):
+    """Nomes dos contigs guardados no cabeçalho de um .csi (None se o índice não os traz).
+
+    O .csi de um VCF (bcftools/tabix -C) guarda no campo auxiliar o mesmo
+    cabeçalho do .tbi; o de um BCF não tem nomes (eles ficam no cabeçalho do BCF).
+    """
+    with BgzfReader(csi_path) as reader:
+        header = reader.read(16)
+        if header[:4] != b"CSI\1":
+            raise ValueError(f"Arquivo não está no formato CSI: {csi_path}")
+        _min_shift, _depth, l_aux = struct.unpack_from("<3i", header, 4)
+        if l_aux < 28:
+            return None
+        aux = reader.read(l_aux)
+    l_nm = struct.unpack_from("<i", aux, 24)[0]
+    return [name.decode() for name in aux[28:28 + l_nm].split(b"\0") if name]
+
+
+def vcf_contigs(vcf_file):
+    """Contigs com registros no VCF, na ordem do arquivo.
+
+    Com o índice ao lado (.tbi, ou .csi com nomes), a lista vem do índice, sem
+    descomprimir o VCF. Sem índice, vêm das linhas ##contig do cabeçalho a partir
+    do contig do primeiro registro (pode incluir contigs declarados sem registros,
+    o que só amplia o arquivo de regiões). Só um VCF sem ##contig é lido por inteiro.
+    """
+    if os.path.exists(f"{vcf_file}.tbi"):
+        chrom_names, _references = read_tabix_index(f"{vcf_file}.tbi")
+        return chrom_names
+    if os.path.exists(f"{vcf_file}.csi"):
+        chrom_names = csi_contig_names(f"{vcf_file}.csi")
+        if chrom_names is not None:
+            return chrom_names
+    declared = []
+    with gzip.open(vcf_file, "rt") as vcf:
+        for line in vcf:
+            if line.startswith("##contig=<"):
+                for field in line.strip()[len("##contig=<"):-1].split(","):
+                    if field.startswith("ID="):
+                        declared.append(field[len("ID="):])
+                        break
+                continue
+            if line.startswith("#"):
+                continue
+            first = line.split("\t", 1)[0]
+            if first in declared:
+                return declared[declared.index(first):]
+            # Último recurso: sem ##contig, todos os registros são lidos
+            contigs = [first]
+            for line in vcf:
+                chrom = line.split("\t", 1)[0]
+                if contigs[-1] != chrom and chrom not in contigs:
+                    contigs.append(chrom)
+            return contigs
+    return []
+
+
+def panel_key(vcf_files, bed_id, min_maf):
+    """Chave do cache do painel: conjunto de VCFs (caminho, tamanho, data), BED e MAF mínimo."""
+    digest = hashlib.sha256()
+    for vcf_file in vcf_files:
+        stat = os.stat(vcf_file)
+        digest.update(f"{os.path.abspath(vcf_file)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+    digest.update(f"{bed_id}\t{min_maf}\tv{PANEL_VERSION}".encode())
+    return digest.hexdigest()[:16]
+
+
+def filter_command(vcf_file, output_path, regions_file=None, bcftools_path="bcftools", min_maf=DEFAULT_MIN_MAF):
+    """bcftools view: SNPs bialélicos com MAF >= min_maf, sem genótipos (e só nos alvos, com regions_file).
+
+    Com o índice (.tbi/.csi) do VCF, -R salta direto para os alvos; sem ele, -T filtra lendo o arquivo todo.
+    """
+    command = [bcftools_path, "view", "-m2", "-M2", "-v", "snps", "-q", f"{min_maf}:minor", "-G"]
+    if regions_file:
+        indexed = os.path.exists(f"{vcf_file}.tbi") or os.path.exists(f"{vcf_file}.csi")
+        command.extend(["-R" if indexed else "-T", regions_file])
+    command.extend(["-Oz", "-o", output_path, vcf_file])
+    return command
+
+
+def prepare_verifybamid_panel(chromossome_dir, intermediate_dir, output_name="merged_panel.vcf.gz",
+                              target_index=None, bed_file=None, bcftools_path="bcftools", tabix_path="tabix",
+                              min_maf=DEFAULT_MIN_MAF):
+    """
+    Filtra (em paralelo) e concatena os .vcf.gz válidos com bcftools e salva o painel final indexado.
+    Com `target_index` (ou `bed_file`) só os SNPs dentro dos alvos são mantidos e cromossomos sem
+    alvos são pulados. Reaproveita o painel em cache quando as entradas não mudaram.
+    Caminhos devem ser absolutos.
+    """
+    chromossome_dir = os.path.abspath(chromossome_dir)
+    intermediate_dir = os.path.abspath(intermediate_dir)
+
+    vcf_files = list_panel_vcfs(chromossome_dir)
     if not vcf_files:
         raise FileNotFoundError(f"Nenhum arquivo .vcf.gz encontrado em {chromossome_dir}")
 
-    print(f"🔗 Concatenando {len(vcf_files)} arquivos VCF com bcftools...")
+    if target_index is None and bed_file:
+        target_index = build_target_index(bed_file)
+    bed_id = None
+    if target_index is not None:
+        bed_id = target_index.bed_hash or (file_sha256(bed_file) if bed_file else None)
+
+    key = panel_key(vcf_files, bed_id, min_maf)
+    panel_dir = os.path.join(intermediate_dir, key)
+    output_path = os.path.join(panel_dir, output_name)
+    if os.path.exists(output_path) and os.path.exists(f"{output_path}.tbi"):
+        logging.info(f"Painel VCF reaproveitado do cache: {output_path}")
+        print(f"Painel VCF já existe: {output_path}")
+        return output_path
+    os.makedirs(panel_dir, exist_ok=True)
+
+    # Um filtro por VCF; arquivos de cromossomos sem alvos ficam de fora
+    commands, filtered, regions_files = [], [], []
+    for vcf_file in vcf_files:
+        name = os.path.basename(vcf_file)[:-len(".vcf.gz")]
+        contigs = vcf_contigs(vcf_file)
+        regions_file = None
+        if target_index is not None:
+            known = set(target_index.contig_names)
+            targets = {}
+            for chrom in contigs:
+                contig = normalize_contig_name(chrom, known)
+                if contig is not None:
+                    targets[chrom] = contig
+            if not targets:
+                logging.info(f"Sem alvos nos contigs de {vcf_file}; arquivo ignorado no painel")
+                continue
+            # Regiões com o nome de contig usado no VCF (chr1 x 1)
+            regions_file = os.path.join(panel_dir, f"{name}.targets.bed")
+            regions_files.append(regions_file)
+            with open(regions_file, "w") as regions:
+                for chrom, contig in targets.items():
+                    block = target_index.contig_slice(contig)
+                    regions.writelines(f"{chrom}\t{start}\t{end}\n" for start, end in
+                                       zip(target_index.starts[block].tolist(), target_index.ends[block].tolist()))
+        output = os.path.join(panel_dir, f"{name}.filtered.vcf.gz")
+        commands.append(filter_command(vcf_file, output, regions_file, bcftools_path, min_maf))
+        filtered.append((contigs, output))
+
+    if not commands:
+        raise ValueError(f"Nenhum VCF de {chromossome_dir} tem contigs com alvos do BED")
+
+    print(f"🔎 Filtrando {len(commands)} arquivos VCF com bcftools (em paralelo)...")
+    temp_output = os.path.join(panel_dir, f"tmp.{output_name}")
 
     try:
-        # Concatenar os arquivos
-        cmd_concat = ["bcftools", "concat", "-Oz", "-o", output_path] + vcf_files
-        subprocess.run(cmd_concat, check=True)
+        # Os filtros rodam ao mesmo tempo (limite de MAX_CONCURRENT_TOOLS processos)
+        run_tools_sync(commands)
+
+        # Concatenar os arquivos filtrados na ordem natural dos cromossomos
+        filtered.sort(key=lambda item: natural_contig_key(item[0][0]) if item[0] else (2, 0, item[1]))
+        print(f"🔗 Concatenando {len(filtered)} arquivos filtrados com bcftools...")
+        cmd_concat = [bcftools_path, "concat", "-Oz", "-o", temp_output] + [path for _contigs, path in filtered]
+        run_tool_sync(cmd_concat)
 
         # Indexar com tabix
-        subprocess.run(["tabix", "-p", "vcf", output_path], check=True)
+        run_tool_sync([tabix_path, "-f", "-p", "vcf", temp_output])
+        os.replace(f"{temp_output}.tbi", f"{output_path}.tbi")
+        os.replace(temp_output, output_path)
+        for path in [path for _contigs, path in filtered] + regions_files:
+            os.remove(path)
 
         print(f"✅ Painel VCF gerado: {output_path}")
         return output_path
     except subprocess.CalledProcessError as e:
         logging.error(f"Erro ao gerar painel VCF: {e}")
         raise
+    finally:
+        for leftover in (temp_output, f"{temp_output}.tbi"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
 
 
 # Execução direta para testes
@@ -51,6 +212,11 @@ if __name__ == "__main__":
     parser.add_argument("--chromossome_dir", required=True, help="Diretório com arquivos .vcf.gz por cromossomo")
     parser.add_argument("--intermediate_dir", required=True, help="Diretório de saída para o painel final")
     parser.add_argument("--output_name", default="merged_panel.vcf.gz", help="Nome do painel final (default: merged_panel.vcf.gz)")
+    parser.add_argument("--bed", default=None, help="BED dos alvos: mantém só os SNPs dentro deles")
+    parser.add_argument("--bcftools_path", default="bcftools", help="Caminho para o bcftools")
+    parser.add_argument("--tabix_path", default="tabix", help="Caminho para o tabix")
+    parser.add_argument("--min_maf", type=float, default=DEFAULT_MIN_MAF,
+                        help="Frequência mínima do alelo menos comum (padrão: 0.01)")
 
     args = parser.parse_args()
 
@@ -58,7 +224,11 @@ if __name__ == "__main__":
         prepare_verifybamid_panel(
             chromossome_dir=args.chromossome_dir,
             intermediate_dir=args.intermediate_dir,
-            output_name=args.output_name
+            output_name=args.output_name,
+            bed_file=args.bed,
+            bcftools_path=args.bcftools_path,
+            tabix_path=args.tabix_path,
+            min_maf=args.min_maf,
         )
     except Exception as e:
         print(f"❌ Erro: {e}")
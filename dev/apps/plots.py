@@ -0,0 +1,105 @@
+# dev/plots.py
+import glob
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Gráficos fora do processamento das amostras: as etapas só gravam os arrays do
+# histograma (.npz) e os PNGs são desenhados depois, em lote, em processos
+# separados com o backend não interativo Agg. O matplotlib só é importado
+# dentro do processo que desenha.
+
+HISTOGRAM_BINS = 50
+
+
+def coverage_histogram(depths, bins=HISTOGRAM_BINS):
+    """Contagens e limites das classes do histograma de profundidade (como o plt.hist)."""
+    counts, edges = np.histogram(np.asarray(depths), bins=bins)
+    return counts, edges
+
+
+def save_histogram(path, counts, edges, title, xlabel, ylabel):
+    """Grava o histograma pré-calculado (contagens, limites e textos do gráfico) em .npz."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez(path, counts=counts, edges=edges, title=np.asarray(title), xlabel=np.asarray(xlabel),
+             ylabel=np.asarray(ylabel))
+    return path
+
+
+def render_histogram(histogram_file, png_file):
+    """Desenha o PNG a partir do .npz (usa uma Figure própria, sem o estado global do pyplot)."""
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+
+    with np.load(histogram_file) as data:
+        counts, edges = data["counts"], data["edges"]
+        title, xlabel, ylabel = str(data["title"]), str(data["xlabel"]), str(data["ylabel"])
+    figure = Figure()
+    axes = figure.subplots()
+    axes.hist(edges[:-1], bins=edges, weights=counts)
+    axes.set_title(title)
+    axes.set_xlabel(xlabel)
+    axes.set_ylabel(ylabel)
+    figure.savefig(png_file)
+    return png_file
+
+
+def png_path(histogram_file):
+    """PNG correspondente a um histograma (coverage_X_histogram.npz -> coverage_X_results.png)."""
+    return histogram_file.replace("_histogram.npz", "_results.png")
+
+
+def pending_histograms(histogram_files):
+    """Histogramas sem PNG ou com PNG mais antigo que o .npz."""
+    pending = []
+    for histogram_file in histogram_files:
+        png_file = png_path(histogram_file)
+        if not os.path.exists(png_file) or os.path.getmtime(png_file) < os.path.getmtime(histogram_file):
+            pending.append(histogram_file)
+    return pending
+
+
+def render_histograms(histogram_files, workers=1):
+    """Desenha os PNGs pendentes em um pool de processos; retorna os arquivos que falharam."""
+    pending = pending_histograms(histogram_files)
+    if not pending:
+        return []
+    failed = []
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(pending)))) as executor:
+        futures = {executor.submit(render_histogram, histogram_file, png_path(histogram_file)): histogram_file
+                   for histogram_file in pending}
+        for future, histogram_file in futures.items():
+            try:
+                logging.info(f"Histograma de cobertura desenhado em {future.result()}")
+            except Exception as e:
+                logging.error(f"Erro ao desenhar o histograma {histogram_file}: {e}")
+                failed.append(histogram_file)
+    return failed
+
+
+def find_histograms(output_dir):
+    """Todos os histogramas gravados em output/reports/<amostra>/."""
+    return sorted(glob.glob(os.path.join(output_dir, "reports", "*", "coverage_*_histogram.npz")))
+
+
+# Execução direta: desenha os gráficos pendentes de um diretório de saída
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Desenha os histogramas de cobertura pendentes (PNG)")
+    parser.add_argument("output_dir", help="Diretório de saída do pipeline (ex.: data/output)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Processos desenhando em paralelo (padrão: núcleos disponíveis)")
+    args = parser.parse_args()
+
+    histograms = find_histograms(args.output_dir)
+    pending = pending_histograms(histograms)
+    failed = render_histograms(pending, args.workers)
+    print(f"{len(pending) - len(failed)} de {len(histograms)} histogramas desenhados "
+          f"({len(histograms) - len(pending)} já estavam atualizados)")
+    if failed:
+        print(f"Falharam: {', '.join(failed)}")
+        exit(1)
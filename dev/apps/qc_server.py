@@ -0,0 +1,279 @@
+# dev/qc_server.py
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bioinf_pipeline_qc import default_threads, project_dir, setup_logging
+
+# Modo servidor: um processo de longa duração em localhost (HTTP + JSON) que mantém
+# aquecidos os imports, o índice de alvos, os metadados da referência e um pool de
+# processos. Cada amostra enviada vira um job processado com process_one_sample;
+# a latência de uma amostra passa a ser a do trabalho do samtools, sem a partida
+# do pipeline. Rotas:
+#   GET  /status          estado do servidor (configuração, jobs por estado)
+#   POST /samples         {"cram_file": "...", "bed": opcional} -> {"job_id": ...}
+#   GET  /jobs            todos os jobs
+#   GET  /jobs/<id>       estado e resultados (métricas, sexo, contaminação, arquivos)
+
+DEFAULT_PORT = 8765
+
+
+@functools.lru_cache(maxsize=8)
+def warm_context(bed_file, intermediate_dir, ref_fasta=None, panel_vcf=None):
+    """Índice de alvos e sítios do painel de um BED, carregados uma vez por processo."""
+    from target_index import load_target_index
+    target_index = load_target_index(bed_file, intermediate_dir, ref_fasta)
+    panel_sites = None
+    if panel_vcf:
+        from contamination import load_panel_sites
+        panel_sites = load_panel_sites(panel_vcf, intermediate_dir, target_index, bed_file)
+    return target_index, panel_sites
+
+
+def warm_worker(log_file, context):
+    """Inicializador do pool: log, imports do processamento e contexto padrão já carregados."""
+    setup_logging(log_file)
+    import sample_processing  # noqa: F401 (aquece os imports do processamento)
+    warm_context(*context)
+
+
+def run_sample(cram_file, context, config, sample_options):
+    """Processa uma amostra no processo do pool, com o contexto aquecido do BED."""
+    from sample_processing import process_one_sample
+    target_index, panel_sites = warm_context(*context)
+    return process_one_sample(cram_file, context[0], config["output_dir"], config["intermediate_dir"],
+                              config["samtools_path"], config["bcftools_path"], config["ref_fasta"],
+                              show_progress=False, target_index=target_index, panel_sites=panel_sites,
+                              **sample_options)
+
+
+def render_png(histogram_file):
+    from plots import png_path, render_histogram
+    return render_histogram(histogram_file, png_path(histogram_file))
+
+
+def read_report(path):
+    """Relatório de texto 'Chave: valor' como dicionário (None se ainda não existe)."""
+    if not os.path.exists(path):
+        return None
+    report = {}
+    with open(path) as handle:
+        for line in handle:
+            key, separator, value = line.partition(":")
+            if separator and value.strip():
+                report[key.strip()] = value.strip()
+    return report
+
+
+def collect_results(output_dir, intermediate_dir, sample_name):
+    """Resultados de uma amostra processada: métricas de cobertura, sexo, contaminação e arquivos."""
+    report_dir = os.path.join(output_dir, "reports", sample_name)
+    coverage_cache = os.path.join(intermediate_dir, "coverage_cache", f"{sample_name}.npz")
+    coverage = None
+    if os.path.exists(coverage_cache):
+        import numpy as np
+        with np.load(coverage_cache) as data:
+            coverage = json.loads(str(data["summary"]))
+    return {
+        "coverage": coverage,
+        "sex": read_report(os.path.join(report_dir, f"sex_inference_{sample_name}.txt")),
+        "contamination": read_report(os.path.join(report_dir, f"contamination_{sample_name}.txt")),
+        "files": sorted(os.path.join(report_dir, name) for name in os.listdir(report_dir)
+                        if os.path.isfile(os.path.join(report_dir, name))) if os.path.isdir(report_dir) else [],
+    }
+
+
+class QCServer:
+    """Estado do servidor: configuração, contexto aquecido, pool de processos e jobs."""
+
+    def __init__(self, config, sample_options, jobs=1):
+        self.config = config
+        self.sample_options = sample_options
+        self.jobs = {}
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.default_context = (config["bed"], config["intermediate_dir"], config["ref_fasta"], config["panel_vcf"])
+
+        log_file = os.path.join(config["output_dir"], "logs", "pipeline.log")
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        os.makedirs(config["intermediate_dir"], exist_ok=True)
+        setup_logging(log_file)
+        # Constrói (ou lê do cache em disco) o índice de alvos antes de abrir o pool
+        warm_context(*self.default_context)
+        self.executor = ProcessPoolExecutor(max_workers=jobs, initializer=warm_worker,
+                                            initargs=(log_file, self.default_context))
+        for _ in range(jobs):
+            self.executor.submit(time.sleep, 0)
+        self.workers = jobs
+
+    def submit(self, request):
+        """Cria o job de uma amostra; retorna (código HTTP, resposta)."""
+        cram_file = request.get("cram_file")
+        if not cram_file or not os.path.exists(cram_file):
+            return 400, {"error": f"Arquivo CRAM não encontrado: {cram_file}"}
+        bed_file = request.get("bed") or self.config["bed"]
+        if not os.path.exists(bed_file):
+            return 400, {"error": f"Arquivo BED não encontrado: {bed_file}"}
+        sample_name = os.path.splitext(os.path.basename(cram_file))[0]
+        with self.lock:
+            active = [job for job in self.jobs.values()
+                      if job["sample"] == sample_name and job["status"] in ("queued", "running")]
+            if active:
+                return 409, {"error": f"Amostra {sample_name} já está em processamento",
+                             "job_id": active[0]["job_id"]}
+            job_id = uuid.uuid4().hex[:12]
+            job = {"job_id": job_id, "sample": sample_name, "cram_file": cram_file, "bed": bed_file,
+                   "status": "queued", "submitted_at": time.time(), "finished_at": None,
+                   "seconds": None, "error": None, "results": None}
+            self.jobs[job_id] = job
+        context = (bed_file,) + self.default_context[1:]
+        future = self.executor.submit(run_sample, cram_file, context, self.config, self.sample_options)
+        with self.lock:
+            self.futures[job_id] = future
+        future.add_done_callback(functools.partial(self._finished, job_id))
+        logging.info(f"Servidor: amostra {sample_name} recebida (job {job_id})")
+        return 202, {"job_id": job_id, "status": job["status"]}
+
+    def _finished(self, job_id, future):
+        job = self.jobs[job_id]
+        error = future.exception()
+        results = None
+        if error is None:
+            histogram_file = future.result()
+            if not self.config["no_plots"] and histogram_file:
+                self.executor.submit(render_png, histogram_file)
+            results = collect_results(self.config["output_dir"], self.config["intermediate_dir"], job["sample"])
+        else:
+            logging.error(f"Servidor: erro ao processar a amostra {job['sample']}: {error}")
+        with self.lock:
+            self.futures.pop(job_id, None)
+            job.update(status="failed" if error else "done", error=str(error) if error else None,
+                       results=results, finished_at=time.time(),
+                       seconds=round(time.time() - job["submitted_at"], 3))
+
+    def _refresh(self):
+        """Jobs na fila que o pool já começou a executar passam para 'running' (chamar com a trava)."""
+        for job_id, future in self.futures.items():
+            if self.jobs[job_id]["status"] == "queued" and future.running():
+                self.jobs[job_id]["status"] = "running"
+
+    def job(self, job_id):
+        with self.lock:
+            self._refresh()
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def status(self):
+        with self.lock:
+            self._refresh()
+            counts = {}
+            for job in self.jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return {"uptime_seconds": round(time.time() - self.started_at, 1), "workers": self.workers,
+                "jobs": counts, "bed": self.config["bed"], "ref_fasta": self.config["ref_fasta"],
+                "output_dir": self.config["output_dir"], "warm_contexts": warm_context.cache_info().currsize}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def make_handler(server_state):
+    """Classe de handler HTTP ligada ao estado do servidor."""
+
+    class QCRequestHandler(BaseHTTPRequestHandler):
+        def send_json(self, code, payload):
+            body = json.dumps(payload, indent=2, default=str).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/status":
+                self.send_json(200, server_state.status())
+            elif self.path == "/jobs":
+                with server_state.lock:
+                    server_state._refresh()
+                    jobs = [{key: job[key] for key in ("job_id", "sample", "status", "seconds")}
+                            for job in server_state.jobs.values()]
+                self.send_json(200, {"jobs": jobs})
+            elif self.path.startswith("/jobs/"):
+                job = server_state.job(self.path[len("/jobs/"):])
+                self.send_json(200 if job else 404, job or {"error": "Job não encontrado"})
+            else:
+                self.send_json(404, {"error": f"Rota desconhecida: {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/samples":
+                self.send_json(404, {"error": f"Rota desconhecida: {self.path}"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError as e:
+                self.send_json(400, {"error": f"JSON inválido: {e}"})
+                return
+            code, payload = server_state.submit(request)
+            self.send_json(code, payload)
+
+        def log_message(self, format, *args):
+            logging.info(f"Servidor HTTP: {self.address_string()} {format % args}")
+
+    return QCRequestHandler
+
+
+# Execução direta: sobe o servidor
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Servidor de controle de qualidade (HTTP local, respostas em JSON)")
+    parser.add_argument("--host", default="127.0.0.1", help="Endereço (padrão: 127.0.0.1, só a máquina local)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Porta (padrão: {DEFAULT_PORT})")
+    parser.add_argument("--bed", default=f'{project_dir}data{os.sep}input{os.sep}bed_files{os.sep}{os.getenv("BED_FILE_NAME")}',
+                        help="BED padrão das amostras (cada envio pode informar outro)")
+    parser.add_argument("--output_dir", default=f'{project_dir}data{os.sep}output', help="Diretório de saída principal")
+    parser.add_argument("--intermediate_dir", default=f'{project_dir}data{os.sep}intermediate',
+                        help="Diretório intermediário")
+    parser.add_argument("--samtools_path", default="samtools", help="Caminho para samtools")
+    parser.add_argument("--bcftools_path", default="bcftools", help="Caminho para bcftools")
+    parser.add_argument("--ref_fasta",
+                        default=f'{project_dir}data{os.sep}input{os.sep}ref_gen_files{os.sep}{os.getenv("REF_GEN_FILE_NAME")}',
+                        help="FASTA do genoma de referência")
+    parser.add_argument("--panel_vcf", default=None, help="Painel de SNPs para a contaminação (FREEMIX)")
+    parser.add_argument("--coverage_engine", choices=["samtools", "numpy"], default="samtools",
+                        help="Motor de cobertura (padrão: samtools)")
+    parser.add_argument("--jobs", type=int, default=1, help="Amostras processadas em paralelo (padrão: 1)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Threads do samtools por amostra (padrão: núcleos disponíveis / jobs)")
+    parser.add_argument("--no_plots", action="store_true", help="Não desenha os PNGs dos histogramas")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.bed):
+        parser.error(f"Arquivo BED não encontrado: {args.bed}")
+    if args.jobs < 1:
+        parser.error("--jobs deve ser maior ou igual a 1")
+
+    ref_fasta = args.ref_fasta if os.path.exists(args.ref_fasta) else None
+    config = {"bed": args.bed, "output_dir": args.output_dir, "intermediate_dir": args.intermediate_dir,
+              "samtools_path": args.samtools_path, "bcftools_path": args.bcftools_path,
+              "ref_fasta": ref_fasta, "panel_vcf": args.panel_vcf, "no_plots": args.no_plots}
+    sample_options = {"threads": args.threads or default_threads(args.jobs), "coverage_engine": args.coverage_engine}
+
+    state = QCServer(config, sample_options, args.jobs)
+    httpd = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    print(f"Servidor de QC em http://{args.host}:{args.port} ({args.jobs} processo(s)); Ctrl+C para parar")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("Encerrando o servidor...")
+    finally:
+        httpd.server_close()
+        state.shutdown()
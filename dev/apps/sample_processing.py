@@ -1,14 +1,24 @@
 import logging
 import subprocess
 import os
+from contextlib import nullcontext
 from tqdm import tqdm
-import matplotlib.pyplot as plt
+import numpy as np
 
-from convert_files import convert_cram_to_bam
-from indexing_files import index_bam_with_progress
-from coverage import calculate_coverage
+from convert_files import convert_cram_to_bam, estimate_bam_size_bytes
+from indexing_files import index_bam_with_progress, find_crai_file
+from coverage import calculate_coverage, save_coverage_results, load_coverage_results, COVERAGE_SUMMARY_VERSION
 from sex_inference import infer_sex
-from panel_map_create import prepare_verifybamid_panel
+from depth_stream import DepthHistogram, QuantizedCoverage, stream_depth
+from stage_cache import StageManifest, alignment_fingerprints, fingerprint
+from target_index import file_sha256
+from metrics import StageMetrics
+from cohort_matrix import CohortMatrix, cohort_directory
+from plots import coverage_histogram, save_histogram
+from coverage_output import write_region_coverage
+from contamination import estimate_contamination
+from binned_depth import calculate_depth_bins, DEFAULT_BIN_SIZE
+from admission import admitted
 
 # diretório do arquivo atual
 diretorio_arquivo = os.path.dirname(os.path.abspath(__file__))
@@ -17,31 +27,23 @@ project_dir = os.path.normpath(f"{diretorio_arquivo}{os.sep}..{os.sep}..{os.sep}
 # assim posso salvar os arquivos com seguraça em data
 
 
-def process_one_sample(cram_file, bed_file, output_dir, intermediate_dir,
-                       samtools_path="samtools", bcftools_path="bcftools", ref_fasta=None):
-
-    """Processa um único arquivo CRAM."""
-    sample_name = os.path.splitext(os.path.basename(cram_file))[0]
-    sample_output_dir = os.path.join(output_dir, "reports", sample_name)
-    os.makedirs(sample_output_dir, exist_ok=True)
-
-    # Configura o logging para a amostra específica
-    sample_log_file = os.path.join(sample_output_dir, "logs", f"logs_{sample_name}.log")
-    os.makedirs(os.path.dirname(sample_log_file), exist_ok=True)
-    sample_logger = logging.getLogger(sample_name)
-    if not sample_logger.handlers:
-        handler = logging.FileHandler(sample_log_file)
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-        sample_logger.addHandler(handler)
-        sample_logger.setLevel(logging.INFO)
-    
-    print(f'Processando amostra: {sample_name}')
-
-    sample_logger.info(f"Iniciando processamento da amostra: {sample_name}")
+def prepare_bam(cram_file, sample_name, intermediate_dir, sample_logger,
+                samtools_path="samtools", ref_fasta=None, threads=1, show_progress=True,
+                compression_level=None, force=False, metrics_file=None, admission=None):
+    """Converte o CRAM em BAM indexado em intermediate/bam_files (se ainda não existir).
 
+    Com `force`, um BAM existente (desatualizado segundo o cache de etapas) é refeito.
+    Conversão e indexação são medidas (metrics.StageMetrics) em `metrics_file` e,
+    com `admission` (admission.AdmissionController), esperam vaga e folga no nó.
+    """
     bam_file = os.path.join(intermediate_dir, "bam_files", f"{sample_name}.bam")
     os.makedirs(os.path.dirname(bam_file), exist_ok=True)
+
+    if force:
+        for stale in (bam_file, f"{bam_file}.bai"):
+            if os.path.exists(stale):
+                sample_logger.info(f"Removendo arquivo desatualizado: {stale}")
+                os.remove(stale)
     
     try:
         if os.path.exists(bam_file):
@@ -52,14 +54,19 @@ def process_one_sample(cram_file, bed_file, output_dir, intermediate_dir,
         
             # print(f'Convertendo CRAM para BAM: {cram_file} -> {bam_file}')
             # with tqdm(total=1, desc=f"Convertendo {sample_name}", unit="amostra") as pbar:
-            convert_cram_to_bam(cram_file, bam_file, samtools_path, ref_fasta)
+            with admitted(admission, "conversion", sample_name, sample_logger), \
+                    StageMetrics(metrics_file, sample_name, "conversion",
+                                 input_bytes=os.path.getsize(cram_file), threads=threads):
+                convert_cram_to_bam(cram_file, bam_file, samtools_path, ref_fasta,
+                                    threads=threads, show_progress=show_progress,
+                                    compression_level=compression_level)
                 # pbar.update(1)
 
     except Exception as e:
         sample_logger.error(f"Erro ao converter CRAM para BAM para a amostra {sample_name}: {e}")
         raise
 
-    # Indexa o arquivo BAM
+    # Indexa o arquivo BAM (só necessário para BAMs antigos, a conversão já grava o .bai)
     try:
         # Verifica se o arquivo BAM já está indexado
         bam_index_file = f"{bam_file}.bai"
@@ -72,78 +79,395 @@ def process_one_sample(cram_file, bed_file, output_dir, intermediate_dir,
             # Indexa o arquivo BAM
             print(f'Indexando arquivo BAM: {bam_file}')
             # subprocess.run([samtools_path, "index", bam_file], check=True)
-            index_bam_with_progress(bam_file, samtools_path)
+            with admitted(admission, "index", sample_name, sample_logger), \
+                    StageMetrics(metrics_file, sample_name, "index",
+                                 input_bytes=os.path.getsize(bam_file), threads=threads):
+                index_bam_with_progress(bam_file, samtools_path,
+                                        threads=threads, show_progress=show_progress)
 
             sample_logger.info(f"Arquivo BAM indexado: {bam_file}.bai")
     except subprocess.CalledProcessError as e:
         sample_logger.error(f"Erro ao indexar o arquivo BAM: {e}")
         raise
 
-    # Calcula a cobertura usando o arquivo BAM gerado
-    print(f'Calculando cobertura para a amostra: {sample_name}')
-    try:
-        coverage_results = calculate_coverage(bam_file, bed_file, samtools_path)
-        coverage_file_txt = os.path.join(sample_output_dir, f"coverage_{sample_name}_results.txt")
-        coverage_file_png = os.path.join(sample_output_dir, f"coverage_{sample_name}_results.png")
-
-        # Salva os resultados em um arquivo de texto
-        with open(coverage_file_txt, "w") as f:
-            f.write(f"Profundidade Média: {coverage_results['mean_depth']:.2f}x\n")
-            f.write(f"% Coberto >= 10x: {coverage_results['percent_covered_10x']:.2f}%\n")
-            f.write(f"% Coberto >= 30x: {coverage_results['percent_covered_30x']:.2f}%\n")
-            f.write("\nCobertura por Região:\n")
-            f.write("Cromossomo\tInício\tFim\tProfundidade\n")
-            for region in coverage_results['region_coverage']:
-                f.write(f"{region['chrom']}\t{region['start']}\t{region['end']}\t{region['depth']}x\n")
-        sample_logger.info(f"Cobertura calculada e salva em {coverage_file_txt}")
-
-        # Gera o histograma e salva em um arquivo PNG
-        depths = [region['depth'] for region in coverage_results['region_coverage']]
-        plt.hist(depths, bins=50)
-        plt.title('Distribuição da Profundidade de Cobertura')
-        plt.xlabel('Profundidade de Cobertura')
-        plt.ylabel('Frequência')
-        plt.savefig(coverage_file_png)
-        plt.close()
-        sample_logger.info(f"Histograma de cobertura gerado e salvo em {coverage_file_png}")
+    return bam_file
 
-    except Exception as e:
-        sample_logger.error(f"Erro ao calcular a cobertura para a amostra {sample_name}: {e}")
-        raise
-    
 
-    # Estima o sexo genético
-    print(f'Inferindo sexo genético para a amostra: {sample_name}')
-    try:
-        sex_inference_results = infer_sex(bam_file, bed_file, samtools_path, bcftools_path)
-        sex_inference_file = os.path.join(sample_output_dir, f"sex_inference_{sample_name}.txt")
-        with open(sex_inference_file, "w") as f:
-            f.write(f"Cromossomo X Cobertura: {sex_inference_results['x_coverage']:.2f}x\n")
-            f.write(f"Cromossomo Y Cobertura: {sex_inference_results['y_coverage']:.2f}x\n")
-            f.write(f"Sexo Predito: {sex_inference_results['predicted_sex']}\n")
-        sample_logger.info(f"Sexo genético inferido e salvo em {sex_inference_file}")
+def write_coverage_report(coverage_file_txt, coverage_results, regions_file=None):
+    """Grava o relatório de cobertura (métricas gerais + cobertura por região) em texto.
 
-    except Exception as e:
-        sample_logger.error(f"Erro ao inferir o sexo genético para a amostra {sample_name}: {e}")
-        raise
+    Com `regions_file` (coverage_output.write_region_coverage), a cobertura por região
+    fica só no TSV compactado e indexado e o texto traz apenas as métricas gerais.
+    """
+    with open(coverage_file_txt, "w") as f:
+        f.write(f"Profundidade Média: {coverage_results['mean_depth']:.2f}x\n")
+        f.write(f"% Coberto >= 10x: {coverage_results['percent_covered_10x']:.2f}%\n")
+        f.write(f"% Coberto >= 30x: {coverage_results['percent_covered_30x']:.2f}%\n")
+        if 'percent_bases_covered_10x' in coverage_results:
+            f.write(f"% Bases >= 10x: {coverage_results['percent_bases_covered_10x']:.2f}%\n")
+            f.write(f"% Bases >= 30x: {coverage_results['percent_bases_covered_30x']:.2f}%\n")
+        if regions_file:
+            f.write(f"\nCobertura por Região: {os.path.basename(regions_file)} (TSV BGZF com índice tabix)\n")
+            return
+        f.write("\nCobertura por Região:\n")
+        f.write("Cromossomo\tInício\tFim\tProfundidade\n")
+        for chrom, start, end, depth in coverage_results['region_coverage'].iter_rows():
+            f.write(f"{chrom}\t{start}\t{end}\t{depth}x\n")
+
+
+def process_one_sample(cram_file, bed_file, output_dir, intermediate_dir,
+                       samtools_path="samtools", bcftools_path="bcftools", ref_fasta=None,
+                       threads=1, show_progress=True, no_bam=False, crai_dir=None,
+                       compression_level=None, coverage_engine="samtools", normalize_sex=False,
+                       per_base=False, target_index=None, use_cache=True, coverage_shards=1,
+                       shard_mode="balanced", sex_mode="coverage", sex_thresholds=None, panel_sites=None,
+                       storage=None, columnar=False, depth_bins=False, bin_size=DEFAULT_BIN_SIZE,
+                       quantize=None, admission=None):
+
+    """Processa um único arquivo CRAM.
+
+    `threads` é o número de threads do samtools (-@) usado pela amostra e
+    `show_progress` controla as barras de progresso internas (desligadas
+    quando várias amostras rodam em paralelo). Com `no_bam`, cobertura e sexo
+    são calculados direto do CRAM usando o .crai de `crai_dir`;
+    `compression_level` é o nível de compressão do BAM intermediário e
+    `coverage_engine` escolhe entre samtools bedcov e o motor NumPy em processo.
+    `normalize_sex` normaliza X e Y pela cobertura média dos autossomos e
+    `sex_mode="index"` infere o sexo pelas contagens de reads do índice
+    (sex_inference.infer_sex_from_index, limiares em `sex_thresholds`) e só
+    usa a cobertura nos casos inconclusivos. `per_base` grava a distribuição
+    exata da profundidade por base (samtools depth) e `quantize` (limiares, ex.:
+    (1, 10, 30)) grava os alvos em trechos por classe de profundidade
+    (quantized_<amostra>.bed); as duas saem da mesma passagem do samtools depth.
+    `target_index` é o índice de alvos pré-processado (target_index.load_target_index);
+    quando informado, todas as etapas usam o BED normalizado dele no lugar de `bed_file`.
+    Com `use_cache`, cada etapa (conversão, índice, cobertura, histograma, profundidade
+    por base, matriz de coorte e sexo) é pulada quando o manifesto da amostra em intermediate/manifests
+    indica que já foi feita com as mesmas entradas. `coverage_shards` > 1 divide
+    os alvos em partes calculadas em paralelo (ver coverage.shard_targets).
+    Com `panel_sites` (contamination.load_panel_sites), a contaminação (FREEMIX)
+    é estimada nos SNPs do painel dentro dos alvos, com `threads` contigs em paralelo.
+    Com `storage` (intermediate_storage.IntermediateStorage), o BAM intermediário
+    entra no orçamento de disco: a conversão espera por espaço e o BAM fica preso
+    só até a última etapa que o lê.
+    A cobertura por região é gravada em coverage_<amostra>_regions.tsv.gz (BGZF + .tbi)
+    e, com `columnar`, também em coverage_<amostra>_regions.npz.
+    Com `admission` (admission.AdmissionController), cada etapa que lê os alinhamentos
+    espera uma vaga do seu grupo (cpu ou io) e folga de CPU, memória e disco no nó.
+    Com `depth_bins`, grava o resumo da profundidade de todo o genoma em janelas de
+    `bin_size` bases (depth_bins_<amostra>.npz, consultado por binned_depth.py sem o BAM).
+    Retorna o arquivo .npz do histograma de cobertura (o PNG é desenhado à parte).
+    """
+    sample_name = os.path.splitext(os.path.basename(cram_file))[0]
+    sample_output_dir = os.path.join(output_dir, "reports", sample_name)
+    os.makedirs(sample_output_dir, exist_ok=True)
+
+    # Configura o logging para a amostra específica
+    sample_log_file = os.path.join(sample_output_dir, "logs", f"logs_{sample_name}.log")
+    os.makedirs(os.path.dirname(sample_log_file), exist_ok=True)
+    sample_logger = logging.getLogger(sample_name)
+    if not sample_logger.handlers:
+        handler = logging.FileHandler(sample_log_file)
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        handler.setFormatter(formatter)
+        sample_logger.addHandler(handler)
+        sample_logger.setLevel(logging.INFO)
     
-    # Cria o mapa de genomas para o VerifyBamID # futura implementação
-    # try:
-    #     # if os.path.exists(bam_file):
-    #     #     sample_logger.info(f"Arquivo BAM já existe: {bam_file}")
-    #     #     print(f"Arquivo BAM já existe: {bam_file}")
+    print(f'Processando amostra: {sample_name}')
 
-    #     # else:
-        
-    #         # print(f'Convertendo CRAM para BAM: {cram_file} -> {bam_file}')
-    #         # with tqdm(total=1, desc=f"Convertendo {sample_name}", unit="amostra") as pbar:
-    #     prepare_verifybamid_panel(chromossome_dir=f'{project_dir}data{os.sep}input{os.sep}vcfs_separated_files', intermediate_dir = f'{project_dir}data{os.sep}intermediate{os}verify_bam_id_map' ,output_name='merged_panel.vcf.gz')
-    #             # pbar.update(1)
+    if target_index is not None:
+        bed_file = target_index.bed_path
+
+    sample_logger.info(f"Iniciando processamento da amostra: {sample_name}")
+    metrics_file = os.path.join(output_dir, "logs", "metrics.jsonl")
+
+    # Impressões digitais das etapas: uma etapa é pulada quando suas entradas não mudaram
+    manifest = None
+    bed_id = target_index.bed_hash if target_index is not None else file_sha256(bed_file)
+    if use_cache:
+        manifest = StageManifest(os.path.join(intermediate_dir, "manifests", f"{sample_name}.json"))
+        alignment_fp, conversion_fp = alignment_fingerprints(manifest.input_fingerprint(cram_file)['sha256'],
+                                                             ref_fasta, samtools_path, no_bam, compression_level)
+        coverage_fp = fingerprint(alignment=alignment_fp, bed=bed_id, engine=coverage_engine,
+                                  summary=COVERAGE_SUMMARY_VERSION)
+        stage_fps = {
+            'conversion': conversion_fp,
+            'index': fingerprint(conversion=conversion_fp, stage='index'),
+            'coverage': coverage_fp,
+            'histogram': fingerprint(coverage=coverage_fp, stage='histogram'),
+            'regions': fingerprint(coverage=coverage_fp, columnar=columnar, stage='regions'),
+            'cohort': fingerprint(coverage=coverage_fp, stage='cohort'),
+            'per_base': fingerprint(alignment=alignment_fp, bed=bed_id, stage='per_base'),
+            'quantize': fingerprint(alignment=alignment_fp, bed=bed_id, thresholds=quantize, stage='quantize'),
+            'bins': fingerprint(alignment=alignment_fp, bin_size=bin_size, stage='bins'),
+            'contamination': fingerprint(alignment=alignment_fp,
+                                         panel=panel_sites.key if panel_sites is not None else None),
+            'sex': fingerprint(coverage=coverage_fp, normalize=normalize_sex, mode=sex_mode,
+                               thresholds=sex_thresholds if sex_mode == "index" else None),
+        }
+
+    def stage_is_current(stage):
+        if manifest is not None and manifest.is_current(stage, stage_fps[stage]):
+            sample_logger.info(f"Etapa '{stage}' sem alterações, resultado reaproveitado")
+            return True
+        return False
 
-    # except Exception as e:
-    #     sample_logger.error(f"Erro ao gerar o mapa de genomas : {e}")
-    #     raise
+    def record_stage(stage, outputs):
+        if manifest is not None:
+            manifest.record(stage, stage_fps[stage], outputs)
+
+    coverage_file_txt = os.path.join(sample_output_dir, f"coverage_{sample_name}_results.txt")
+    regions_file = os.path.join(sample_output_dir, f"coverage_{sample_name}_regions.tsv.gz")
+    regions_columnar_file = os.path.join(sample_output_dir, f"coverage_{sample_name}_regions.npz")
+    coverage_file_histogram = os.path.join(sample_output_dir, f"coverage_{sample_name}_histogram.npz")
+    coverage_cache_file = os.path.join(intermediate_dir, "coverage_cache", f"{sample_name}.npz")
+    depth_file_txt = os.path.join(sample_output_dir, f"depth_distribution_{sample_name}.txt")
+    sex_inference_file = os.path.join(sample_output_dir, f"sex_inference_{sample_name}.txt")
+    contamination_file = os.path.join(sample_output_dir, f"contamination_{sample_name}.txt")
+    quantized_file = os.path.join(sample_output_dir, f"quantized_{sample_name}.bed")
+    depth_bins_file = os.path.join(sample_output_dir, f"depth_bins_{sample_name}.npz")
+
+    coverage_current = stage_is_current('coverage')
+    per_base_current = not per_base or stage_is_current('per_base')
+    quantize_current = not quantize or stage_is_current('quantize')
+    bins_current = not depth_bins or stage_is_current('bins')
+    contamination_current = panel_sites is None or stage_is_current('contamination')
+    sex_current = stage_is_current('sex')
+
+    def admit(stage):
+        # Vaga do grupo da etapa (cpu/io) com folga no nó; a espera fica fora das métricas da etapa
+        return admitted(admission, stage, sample_name, sample_logger, no_bam, coverage_engine)
+
+    def alignment_done(stage):
+        # Etapa terminou de ler o BAM: sem etapas pendentes ele pode ser removido pelo orçamento
+        if storage is not None and alignment_file is not None and not no_bam:
+            storage.stage_done(sample_name, stage)
+
+    # O BAM/CRAM só é necessário se alguma etapa que lê os alinhamentos precisar rodar
+    alignment_file = index_file = None
+    if not (coverage_current and per_base_current and quantize_current and bins_current
+            and contamination_current):
+        if no_bam:
+            # Lê o CRAM diretamente (com o .crai e a referência), sem gerar o BAM intermediário
+            alignment_file = cram_file
+            index_file = find_crai_file(cram_file, crai_dir)
+            sample_logger.info(f"Modo sem BAM: usando {cram_file} com índice {index_file}")
+        else:
+            conversion_current = stage_is_current('conversion') and stage_is_current('index')
+            if storage is not None:
+                readers = [stage for stage, pending in (('coverage', not coverage_current),
+                                                        ('per_base', not per_base_current),
+                                                        ('quantize', not quantize_current),
+                                                        ('bins', not bins_current),
+                                                        ('contamination', not contamination_current),
+                                                        ('sex', sex_mode == "index" and not sex_current))
+                           if pending]
+                with StageMetrics(metrics_file, sample_name, "storage_wait"):
+                    waited = storage.acquire(sample_name, readers, estimate_bam_size_bytes(cram_file))
+                if waited:
+                    sample_logger.info(f"Conversão aguardou {waited:.0f}s por espaço no orçamento de BAMs")
+            alignment_file = prepare_bam(cram_file, sample_name, intermediate_dir, sample_logger,
+                                         samtools_path, ref_fasta, threads, show_progress,
+                                         compression_level,
+                                         force=manifest is not None and not conversion_current,
+                                         metrics_file=metrics_file, admission=admission)
+            if not conversion_current:
+                record_stage('conversion', [alignment_file])
+                record_stage('index', [f"{alignment_file}.bai"])
+            if storage is not None:
+                storage.commit(sample_name)
+
+    # Calcula a cobertura usando o arquivo BAM gerado (ou o CRAM no modo sem BAM)
+    if coverage_current:
+        coverage_results = load_coverage_results(coverage_cache_file)
+    else:
+        print(f'Calculando cobertura para a amostra: {sample_name}')
+        try:
+            with admit("coverage"), StageMetrics(metrics_file, sample_name, "coverage",
+                                                 engine=coverage_engine, shards=coverage_shards):
+                coverage_results = calculate_coverage(alignment_file, bed_file, samtools_path,
+                                                      ref_fasta if no_bam else None, index_file,
+                                                      engine=coverage_engine, target_index=target_index,
+                                                      shards=coverage_shards, shard_mode=shard_mode)
+
+            # Salva os resultados em um arquivo de texto
+            write_coverage_report(coverage_file_txt, coverage_results, regions_file)
+            save_coverage_results(coverage_cache_file, coverage_results)
+            record_stage('coverage', [coverage_file_txt, coverage_cache_file])
+            alignment_done('coverage')
+            sample_logger.info(f"Cobertura calculada e salva em {coverage_file_txt}")
+
+        except Exception as e:
+            sample_logger.error(f"Erro ao calcular a cobertura para a amostra {sample_name}: {e}")
+            raise
+
+    # Cobertura por região em TSV BGZF indexado (consulta por região com tabix ou coverage_output.py)
+    if not stage_is_current('regions'):
+        try:
+            with StageMetrics(metrics_file, sample_name, "regions", columnar=columnar):
+                region_outputs = write_region_coverage(regions_file, coverage_results['region_coverage'],
+                                                       regions_columnar_file if columnar else None)
+            record_stage('regions', region_outputs)
+            sample_logger.info(f"Cobertura por região salva em {regions_file}")
+        except Exception as e:
+            sample_logger.error(f"Erro ao gravar a cobertura por região para a amostra {sample_name}: {e}")
+            raise
+
+    # Acrescenta a profundidade por região da amostra à matriz da coorte (output/cohort/<hash do BED>)
+    if not stage_is_current('cohort'):
+        try:
+            cohort = CohortMatrix(cohort_directory(output_dir, bed_id[:16]))
+            chunk_file = cohort.add_sample(sample_name, coverage_results['region_coverage'])
+            record_stage('cohort', [chunk_file])
+            sample_logger.info(f"Profundidade por região adicionada à matriz de coorte {cohort.directory}")
+        except Exception as e:
+            sample_logger.error(f"Erro ao atualizar a matriz de coorte para a amostra {sample_name}: {e}")
+            raise
+
+    # Grava o histograma da cobertura (o PNG é desenhado depois, em lote, por plots.render_histograms)
+    if not stage_is_current('histogram'):
+        try:
+            with StageMetrics(metrics_file, sample_name, "histogram"):
+                counts, edges = coverage_histogram(coverage_results['region_coverage'].depths)
+                save_histogram(coverage_file_histogram, counts, edges,
+                               'Distribuição da Profundidade de Cobertura',
+                               'Profundidade de Cobertura', 'Frequência')
+            record_stage('histogram', [coverage_file_histogram])
+            sample_logger.info(f"Histograma de cobertura salvo em {coverage_file_histogram}")
+        except Exception as e:
+            sample_logger.error(f"Erro ao gerar o histograma de cobertura para a amostra {sample_name}: {e}")
+            raise
+
+    # Distribuição da profundidade por base e classes de profundidade (opcionais, uma única
+    # passagem do samtools depth alimentando os dois consumidores)
+    if not (per_base_current and quantize_current):
+        print(f'Calculando profundidade por base para a amostra: {sample_name}')
+        try:
+            histogram = None if per_base_current else DepthHistogram()
+            quantizer = None if quantize_current else QuantizedCoverage(quantized_file, quantize)
+            consumers = [consumer for consumer in (histogram, quantizer) if consumer is not None]
+            with admit("per_base"), StageMetrics(metrics_file, sample_name, "per_base",
+                                                 histogram=histogram is not None,
+                                                 quantize=list(quantize) if quantizer is not None else None):
+                # O BED das classes só aparece se a passagem terminar sem erro
+                with quantizer if quantizer is not None else nullcontext():
+                    stream_depth(alignment_file, bed_file, consumers, samtools_path,
+                                 ref_fasta if no_bam else None, index_file)
+            if histogram is not None:
+                depth_summary = histogram.summary()
+                with open(depth_file_txt, "w") as f:
+                    f.write(f"Bases nos alvos: {depth_summary['total_bases']}\n")
+                    f.write(f"Profundidade Média por Base: {depth_summary['mean_depth']:.2f}x\n")
+                    f.write(f"Profundidade Mediana: {depth_summary['median_depth']}x\n")
+                    for q, value in depth_summary['percentiles'].items():
+                        f.write(f"Percentil {q}: {value}x\n")
+                    for threshold, percent in depth_summary['percent_bases_at_least'].items():
+                        f.write(f"% Bases >= {threshold}x: {percent:.2f}%\n")
+                    f.write(f"\nHistograma (profundidades acima de {depth_summary['max_depth']}x agrupadas):\n")
+                    f.write("Profundidade\tBases\n")
+                    for depth in np.flatnonzero(histogram.counts):
+                        f.write(f"{depth}\t{histogram.counts[depth]}\n")
+                record_stage('per_base', [depth_file_txt])
+                alignment_done('per_base')
+                sample_logger.info(f"Distribuição da profundidade por base salva em {depth_file_txt}")
+            if quantizer is not None:
+                quantized_summary = quantizer.summary()
+                record_stage('quantize', [quantized_file])
+                alignment_done('quantize')
+                classes = ", ".join(f"{label}: {percent:.2f}%"
+                                    for label, percent in quantized_summary['percent'].items())
+                sample_logger.info(f"Classes de profundidade ({quantized_summary['runs']} trechos; {classes}) "
+                                   f"salvas em {quantized_file}")
+        except Exception as e:
+            sample_logger.error(f"Erro ao calcular a profundidade por base para a amostra {sample_name}: {e}")
+            raise
+
+    # Resumo da profundidade em janelas de todo o genoma (opcional, uma passagem pelos alinhamentos)
+    if not bins_current:
+        print(f'Calculando profundidade em janelas para a amostra: {sample_name}')
+        try:
+            with admit("bins"), StageMetrics(metrics_file, sample_name, "bins", bin_size=bin_size, threads=threads):
+                calculate_depth_bins(alignment_file, samtools_path, ref_fasta if no_bam else None, index_file,
+                                     bin_size, threads=threads).save(depth_bins_file)
+            record_stage('bins', [depth_bins_file])
+            alignment_done('bins')
+            sample_logger.info(f"Profundidade em janelas de {bin_size} pb salva em {depth_bins_file}")
+        except Exception as e:
+            sample_logger.error(f"Erro ao calcular a profundidade em janelas para a amostra {sample_name}: {e}")
+            raise
+
+    # Estima o sexo genético
+    if not sex_current:
+        print(f'Inferindo sexo genético para a amostra: {sample_name}')
+        try:
+            # O modo por índice precisa do BAM/CRAM indexado, mesmo com a cobertura vinda do cache
+            sex_alignment, sex_index = alignment_file, index_file
+            if sex_mode == "index" and sex_alignment is None:
+                if no_bam:
+                    sex_alignment, sex_index = cram_file, find_crai_file(cram_file, crai_dir)
+                elif os.path.exists(os.path.join(intermediate_dir, "bam_files", f"{sample_name}.bam")):
+                    sex_alignment = os.path.join(intermediate_dir, "bam_files", f"{sample_name}.bam")
+            with StageMetrics(metrics_file, sample_name, "sex", normalize=normalize_sex, mode=sex_mode):
+                # Reaproveita a cobertura por região já calculada (sem novas passagens pelo BAM)
+                sex_inference_results = infer_sex(sex_alignment, bed_file, samtools_path, bcftools_path,
+                                                  ref_fasta if no_bam else None, sex_index,
+                                                  region_coverage=coverage_results['region_coverage'],
+                                                  normalize=normalize_sex, target_index=target_index,
+                                                  mode=sex_mode if sex_alignment else "coverage",
+                                                  index_thresholds=sex_thresholds)
+            with open(sex_inference_file, "w") as f:
+                if sex_inference_results['method'] == "index":
+                    f.write("Método: contagens de reads do índice\n")
+                    f.write(f"Reads X: {sex_inference_results['x_reads']}\n")
+                    f.write(f"Reads Y: {sex_inference_results['y_reads']}\n")
+                    f.write(f"Reads Autossomos: {sex_inference_results['autosomal_reads']}\n")
+                else:
+                    f.write(f"Cromossomo X Cobertura: {sex_inference_results['x_coverage']:.2f}x\n")
+                    f.write(f"Cromossomo Y Cobertura: {sex_inference_results['y_coverage']:.2f}x\n")
+                    if normalize_sex:
+                        f.write(f"Autossomos Cobertura: {sex_inference_results['autosomal_coverage']:.2f}x\n")
+                if 'x_ratio' in sex_inference_results:
+                    f.write(f"Razão X/Autossomos: {sex_inference_results['x_ratio']:.3f}\n")
+                    f.write(f"Razão Y/Autossomos: {sex_inference_results['y_ratio']:.3f}\n")
+                f.write(f"Sexo Predito: {sex_inference_results['predicted_sex']}\n")
+            record_stage('sex', [sex_inference_file])
+            alignment_done('sex')
+            sample_logger.info(f"Sexo genético inferido e salvo em {sex_inference_file}")
+
+        except Exception as e:
+            sample_logger.error(f"Erro ao inferir o sexo genético para a amostra {sample_name}: {e}")
+            raise
+    
+    # Estima a contaminação (FREEMIX) nos SNPs do painel dentro dos alvos
+    if not contamination_current:
+        print(f'Estimando contaminação para a amostra: {sample_name}')
+        try:
+            with admit("contamination"), StageMetrics(metrics_file, sample_name, "contamination",
+                                                       sites=len(panel_sites), threads=threads):
+                contamination_results = estimate_contamination(alignment_file, panel_sites, samtools_path,
+                                                               ref_fasta if no_bam else None, index_file,
+                                                               threads=threads)
+            with open(contamination_file, "w") as f:
+                freemix = contamination_results['freemix']
+                f.write(f"FREEMIX: {'não estimado' if freemix is None else f'{freemix:.4f}'}\n")
+                f.write(f"SNPs do painel nos alvos: {contamination_results['sites']}\n")
+                f.write(f"SNPs com reads: {contamination_results['sites_covered']}\n")
+                f.write(f"Profundidade média nos SNPs: {contamination_results['mean_depth']:.2f}x\n")
+                f.write(f"Taxa de erro das bases: {contamination_results['error_rate']:.5f}\n")
+                if freemix is not None:
+                    f.write(f"Log-verossimilhança: {contamination_results['log_likelihood']:.2f}\n")
+                    f.write(f"Log-verossimilhança sem contaminação: "
+                            f"{contamination_results['log_likelihood_no_contamination']:.2f}\n")
+            record_stage('contamination', [contamination_file])
+            alignment_done('contamination')
+            sample_logger.info(f"Contaminação estimada e salva em {contamination_file}")
+        except Exception as e:
+            sample_logger.error(f"Erro ao estimar a contaminação para a amostra {sample_name}: {e}")
+            raise
 
+    if storage is not None:
+        storage.release(sample_name)
     print(f'Processamento da amostra {sample_name} concluído')
 
     sample_logger.info(f"Processamento da amostra {sample_name} concluído")
+    return coverage_file_histogram
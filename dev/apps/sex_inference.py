@@ -274,55 +274,157 @@ def infer_sex(bam_file, bed_file, samtools_path="samtools", bcftools_path="bcfto
         raise'''
 
 
-import subprocess
 import logging
 import re  # Importa o módulo de expressões regulares
 import os
-def calculate_chromosome_coverage(bam_file, chromosome, bed_file, samtools_path="samtools"):
-    """Calcula a cobertura média de um cromossomo específico usando um arquivo BED."""
+import tempfile
+
+from bam_reader import find_bam_index, read_bai_counts, read_bam_header
+from coverage import build_alignment_command, calculate_coverage, read_bed_targets, run_bedcov, RegionTable
+from tool_runner import run_tool_sync
+
+# Autossomos humanos (1-22), com ou sem o prefixo 'chr'
+AUTOSOME_REGEX = re.compile(r"^(chr)?([1-9]|1[0-9]|2[0-2])$", re.IGNORECASE)
+
+# Limiares do modo por índice (reads por base-alvo de X e Y / dos autossomos):
+# masculino com Y >= y_ratio_threshold e X < x_ratio_threshold; feminino com
+# Y < y_female_ratio e X >= x_ratio_threshold; o resto é inconclusivo.
+INDEX_X_RATIO_THRESHOLD = 0.75
+INDEX_Y_RATIO_THRESHOLD = 0.1
+INDEX_Y_FEMALE_RATIO = 0.05
+
+
+def chromosome_regex(chromosome):
+    """Expressão regular para o nome do cromossomo, aceitando "X", "chrX", "x", "chrx"."""
+    return re.compile(rf"^(chr)?{chromosome}$", re.IGNORECASE)
+
+
+def coverage_from_regions(region_coverage, chrom_regex):
+    """Cobertura média (profundidade somada / bases) das regiões cujo cromossomo casa com a regex."""
+    if not isinstance(region_coverage, RegionTable):
+        region_coverage = RegionTable.from_regions(list(region_coverage))
+    mask = region_coverage.chrom_mask(chrom_regex)
+    total_bases = int(region_coverage.lengths[mask].sum())
+    return float(region_coverage.depths[mask].sum() / total_bases) if total_bases else 0
+
+
+def read_index_counts(alignment_file, samtools_path="samtools", ref_fasta=None, index_file=None):
+    """Reads mapeados por contig, do índice: lista de (contig, tamanho, reads mapeados).
+
+    Para BAM as contagens saem do pseudo-bin do .bai, sem abrir os alinhamentos;
+    o .crai não guarda contagens, então para CRAM é usado o `samtools idxstats`.
+    """
+    if alignment_file.endswith(".cram"):
+        command = build_alignment_command(samtools_path, "idxstats", [], alignment_file, ref_fasta, index_file)
+        output = run_tool_sync(command, capture_stdout=True).stdout.decode()
+        counts = []
+        for line in output.splitlines():
+            parts = line.split("\t")
+            if len(parts) >= 3 and parts[0] != "*":
+                counts.append((parts[0], int(parts[1]), int(parts[2])))
+        return counts
+    _, references = read_bam_header(alignment_file)
+    index_counts = read_bai_counts(index_file or find_bam_index(alignment_file))
+    return [(name, length, mapped) for (name, length), (mapped, _unmapped) in zip(references, index_counts)]
+
+
+def targeted_bases_by_contig(bed_file, target_index=None):
+    """Total de bases-alvo por contig (do índice de alvos em cache ou do BED)."""
+    if target_index is not None:
+        return target_index.targeted_bases_by_contig()
+    chroms, starts, ends = read_bed_targets(bed_file)
+    bases = {}
+    for chrom, length in zip(chroms, (ends - starts).tolist()):
+        bases[chrom] = bases.get(chrom, 0) + length
+    return bases
+
+
+def classify_sex_ratios(x_ratio, y_ratio, x_ratio_threshold=INDEX_X_RATIO_THRESHOLD,
+                        y_ratio_threshold=INDEX_Y_RATIO_THRESHOLD, y_female_ratio=INDEX_Y_FEMALE_RATIO):
+    """Classifica pelas razões X/autossomos e Y/autossomos; 'Inconclusivo' fora das faixas."""
+    if y_ratio >= y_ratio_threshold and x_ratio < x_ratio_threshold:
+        return "Masculino"
+    if y_ratio < y_female_ratio and x_ratio >= x_ratio_threshold:
+        return "Feminino"
+    return "Inconclusivo"
+
+
+def infer_sex_from_index(alignment_file, bed_file, samtools_path="samtools", ref_fasta=None, index_file=None,
+                         target_index=None, x_ratio_threshold=INDEX_X_RATIO_THRESHOLD,
+                         y_ratio_threshold=INDEX_Y_RATIO_THRESHOLD, y_female_ratio=INDEX_Y_FEMALE_RATIO):
+    """Infere o sexo só com as contagens de reads do índice (.bai, ou idxstats para CRAM).
+
+    Os reads mapeados de X, Y e dos autossomos são divididos pelas bases-alvo de
+    cada grupo (o BED), e as razões X/autossomos e Y/autossomos são classificadas
+    por classify_sex_ratios. Sem alvos em X ou Y o resultado é 'Inconclusivo'.
+    """
+    counts = read_index_counts(alignment_file, samtools_path, ref_fasta, index_file)
+    targeted = targeted_bases_by_contig(bed_file, target_index)
+
+    def group_density(chrom_regex):
+        reads = sum(mapped for name, _length, mapped in counts if chrom_regex.match(name))
+        bases = sum(length for name, length in targeted.items() if chrom_regex.match(name))
+        return reads, bases, reads / bases if bases else 0
+
+    x_reads, x_bases, x_density = group_density(chromosome_regex("X"))
+    y_reads, y_bases, y_density = group_density(chromosome_regex("Y"))
+    autosomal_reads, _autosomal_bases, autosomal_density = group_density(AUTOSOME_REGEX)
+
+    x_ratio = x_density / autosomal_density if autosomal_density else 0
+    y_ratio = y_density / autosomal_density if autosomal_density else 0
+    sex = "Inconclusivo"
+    if autosomal_density and x_bases and y_bases:
+        sex = classify_sex_ratios(x_ratio, y_ratio, x_ratio_threshold, y_ratio_threshold, y_female_ratio)
+    logging.info(f"Sexo pelo índice de {alignment_file}: X/autossomos {x_ratio:.3f}, "
+                 f"Y/autossomos {y_ratio:.3f} -> {sex}")
+    return {
+        "method": "index",
+        "x_reads": x_reads,
+        "y_reads": y_reads,
+        "autosomal_reads": autosomal_reads,
+        "x_ratio": x_ratio,
+        "y_ratio": y_ratio,
+        "predicted_sex": sex,
+    }
+
+
+def calculate_chromosome_coverage(bam_file, chromosome, bed_file, samtools_path="samtools",
+                                  ref_fasta=None, index_file=None, target_index=None):
+    """Calcula a cobertura média de um cromossomo específico usando um arquivo BED.
+
+    Com `target_index`, os alvos do cromossomo saem do índice em cache, sem reler o BED.
+    """
 
     # Define a expressão regular para encontrar o cromossomo, aceitando diferentes prefixos
-    chrom_regex = re.compile(rf"^chr?{chromosome}$", re.IGNORECASE)
+    chrom_regex = chromosome_regex(chromosome)
 
+    # Cria um arquivo BED temporário (nome único, seguro para amostras em paralelo)
+    # contendo apenas o cromossomo de interesse
+    fd, temp_bed_file = tempfile.mkstemp(prefix=f"{chromosome}_", suffix="_temp.bed")
     try:
-        # Cria um arquivo BED temporário contendo apenas o cromossomo de interesse
-        temp_bed_file = f"{chromosome}_temp.bed"
-        with open(temp_bed_file, "w") as f:
-            # Aqui, assumimos que você tem um arquivo BED global (bed_file)
-            # e itera sobre ele para extrair apenas as entradas do cromossomo alvo.
-            with open(bed_file, "r") as global_bed:
-                for line in global_bed:
-                    parts = line.strip().split('\t')
-                    if chrom_regex.match(parts[0]):  # Compara o nome do cromossomo do BED com regex
-                        f.write(line)  # Escreve a linha do BED temporário
-
-        process = subprocess.Popen([samtools_path, "bedcov", temp_bed_file, bam_file],
-                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        stdout, stderr = process.communicate()
-
-        if stderr:
-            logging.error(f"Erro ao calcular cobertura do cromossomo {chromosome} com bedcov: {stderr}")
-            raise Exception(stderr)
-
-        total_coverage = 0
-        total_bases = 0
-
-        for line in stdout.strip().split('\n'):
-            parts = line.split('\t')
-            if len(parts) >= 4:
-                region_coverage = int(parts[-1])  # A cobertura está na última coluna
-                region_start = int(parts[1])
-                region_end = int(parts[2])
-                total_coverage += region_coverage
-                total_bases += (region_end - region_start)
+        if target_index is not None:
+            os.close(fd)
+            target_index.write_bed(temp_bed_file, [target_index.find_contig(chrom_regex)])
+        else:
+            with os.fdopen(fd, "w") as f:
+                # Aqui, assumimos que você tem um arquivo BED global (bed_file)
+                # e itera sobre ele para extrair apenas as entradas do cromossomo alvo.
+                with open(bed_file, "r") as global_bed:
+                    for line in global_bed:
+                        parts = line.strip().split('\t')
+                        if chrom_regex.match(parts[0]):  # Compara o nome do cromossomo do BED com regex
+                            f.write(line)  # Escreve a linha do BED temporário
+
+        table = run_bedcov(bam_file, temp_bed_file, samtools_path, ref_fasta, index_file)
+        total_coverage = int(table.depths.sum())
+        total_bases = int(table.lengths.sum())
 
         average_depth = total_coverage / total_bases if total_bases else 0
         logging.info(f"Cobertura do cromossomo {chromosome}: {average_depth:.2f}x")
-        os.remove(temp_bed_file)  # Limpa o arquivo BED temporário
         return average_depth
 
     except FileNotFoundError:
-        logging.error(f"Ferramenta 'samtools' não encontrada. Verifique se está no PATH.")
+        # A mensagem já foi registrada pelo tool_runner
         raise
     except ValueError:
         logging.error(f"Erro ao analisar a profundidade para o cromossomo {chromosome}.")
@@ -330,27 +432,105 @@ def calculate_chromosome_coverage(bam_file, chromosome, bed_file, samtools_path=
     except Exception as e:
         logging.error(f"Erro ao executar o cálculo de cobertura do cromossomo {chromosome}: {e}")
         raise
+    finally:
+        os.remove(temp_bed_file)  # Limpa o arquivo BED temporário
 
 
-def infer_sex(bam_file, bed_file, samtools_path="samtools", bcftools_path="bcftools"):
-    """Infere o sexo genético com base na cobertura dos cromossomos X e Y."""
+def infer_sex(bam_file, bed_file, samtools_path="samtools", bcftools_path="bcftools",
+              ref_fasta=None, index_file=None, region_coverage=None, normalize=False,
+              x_ratio_threshold=0.75, y_ratio_threshold=0.1, target_index=None, mode="coverage",
+              index_thresholds=None):
+    """Infere o sexo genético com base na cobertura dos cromossomos X e Y.
+
+    Se `region_coverage` (a lista 'region_coverage' do calculate_coverage) for
+    informada, as coberturas de X e Y saem dela, sem nova passagem pelo BAM.
+    Com `normalize`, X e Y são divididos pela cobertura média dos autossomos e
+    a classificação usa os limiares de razão: Y/autossomos >= `y_ratio_threshold`
+    indica masculino; abaixo disso, X/autossomos >= `x_ratio_threshold` indica feminino.
+    `target_index` (TargetIndex em cache) evita reler o BED nas passagens do samtools.
+    Com `mode="index"`, tenta antes infer_sex_from_index (contagens do índice, com
+    os limiares de `index_thresholds`) e só usa a cobertura se o resultado for inconclusivo.
+    """
 
     try:
-        x_coverage = calculate_chromosome_coverage(bam_file, "X", bed_file, samtools_path)
-        y_coverage = calculate_chromosome_coverage(bam_file, "Y", bed_file, samtools_path)
+        if mode == "index":
+            index_results = infer_sex_from_index(bam_file, bed_file, samtools_path, ref_fasta, index_file,
+                                                 target_index, **(index_thresholds or {}))
+            if index_results["predicted_sex"] != "Inconclusivo":
+                return index_results
+            logging.info("Sexo inconclusivo pelo índice; usando a cobertura de X e Y")
+
+        if region_coverage is None and normalize:
+            # A normalização precisa dos autossomos: uma passagem pelo BED inteiro serve para X e Y também
+            region_coverage = calculate_coverage(bam_file, bed_file, samtools_path, ref_fasta,
+                                                 index_file, target_index=target_index)['region_coverage']
+
+        if region_coverage is not None:
+            x_coverage = coverage_from_regions(region_coverage, chromosome_regex("X"))
+            y_coverage = coverage_from_regions(region_coverage, chromosome_regex("Y"))
+            logging.info(f"Cobertura do cromossomo X: {x_coverage:.2f}x")
+            logging.info(f"Cobertura do cromossomo Y: {y_coverage:.2f}x")
+        else:
+            x_coverage = calculate_chromosome_coverage(bam_file, "X", bed_file, samtools_path,
+                                                       ref_fasta, index_file, target_index)
+            y_coverage = calculate_chromosome_coverage(bam_file, "Y", bed_file, samtools_path,
+                                                       ref_fasta, index_file, target_index)
+
+        results = {
+            "method": "coverage",
+            "x_coverage": x_coverage,
+            "y_coverage": y_coverage,
+        }
 
         sex = "Inconclusivo"
-        if x_coverage > 0 and y_coverage == 0:
+        if normalize:
+            autosomal_coverage = coverage_from_regions(region_coverage, AUTOSOME_REGEX)
+            x_ratio = x_coverage / autosomal_coverage if autosomal_coverage else 0
+            y_ratio = y_coverage / autosomal_coverage if autosomal_coverage else 0
+            if autosomal_coverage > 0:
+                if y_ratio >= y_ratio_threshold:
+                    sex = "Masculino"
+                elif x_ratio >= x_ratio_threshold:
+                    sex = "Feminino"
+            results.update({
+                "autosomal_coverage": autosomal_coverage,
+                "x_ratio": x_ratio,
+                "y_ratio": y_ratio,
+            })
+        elif x_coverage > 0 and y_coverage == 0:
             sex = "Feminino"
         elif x_coverage > 0 and y_coverage > 0:
             sex = "Masculino"
 
-        return {
-            "x_coverage": x_coverage,
-            "y_coverage": y_coverage,
-            "predicted_sex": sex
-        }
+        results["predicted_sex"] = sex
+        return results
 
     except Exception as e:
         logging.error(f"Erro ao inferir sexo genético: {e}")
         raise
+
+
+# Execução direta: sexo pelas contagens do índice (milissegundos para um BAM com .bai)
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inferência rápida de sexo pelas contagens de reads do índice")
+    parser.add_argument("alignment_file", help="BAM (com .bai) ou CRAM (com .crai)")
+    parser.add_argument("--bed", required=True, help="BED dos alvos (bases-alvo por contig)")
+    parser.add_argument("--samtools_path", default="samtools", help="Caminho para o samtools (usado só para CRAM)")
+    parser.add_argument("--ref_fasta", default=None, help="FASTA da referência (CRAM)")
+    parser.add_argument("--index_file", default=None, help="Índice, se não estiver ao lado do arquivo")
+    parser.add_argument("--x_ratio", type=float, default=INDEX_X_RATIO_THRESHOLD,
+                        help="Razão X/autossomos mínima para feminino e máxima para masculino")
+    parser.add_argument("--y_ratio", type=float, default=INDEX_Y_RATIO_THRESHOLD,
+                        help="Razão Y/autossomos mínima para masculino")
+    parser.add_argument("--y_female_ratio", type=float, default=INDEX_Y_FEMALE_RATIO,
+                        help="Razão Y/autossomos máxima para feminino")
+    args = parser.parse_args()
+
+    results = infer_sex_from_index(args.alignment_file, args.bed, args.samtools_path, args.ref_fasta,
+                                   args.index_file, x_ratio_threshold=args.x_ratio,
+                                   y_ratio_threshold=args.y_ratio, y_female_ratio=args.y_female_ratio)
+    print(f"Reads X: {results['x_reads']} | Y: {results['y_reads']} | Autossomos: {results['autosomal_reads']}")
+    print(f"Razão X/Autossomos: {results['x_ratio']:.3f} | Razão Y/Autossomos: {results['y_ratio']:.3f}")
+    print(f"Sexo Predito: {results['predicted_sex']}")
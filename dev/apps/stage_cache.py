@@ -0,0 +1,119 @@
+# dev/stage_cache.py
+import functools
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+
+from target_index import file_sha256
+from tool_runner import run_tool_sync
+
+# Cache de etapas por amostra: cada etapa grava no manifesto a "impressão digital"
+# das suas entradas (CRAM, BED, referência, versão do samtools e parâmetros) e os
+# arquivos que gerou. Numa nova execução a etapa é pulada se a impressão digital
+# for igual e os arquivos ainda existirem.
+
+MANIFEST_VERSION = 1
+
+
+@functools.lru_cache(maxsize=None)
+def samtools_version(samtools_path="samtools"):
+    """Primeira linha de `samtools --version` (memorizada por processo)."""
+    try:
+        result = run_tool_sync([samtools_path, "--version"], capture_stdout=True, timeout=60)
+        lines = result.stdout.decode(errors="replace").splitlines()
+        return lines[0].strip() if lines else "desconhecida"
+    except (OSError, subprocess.SubprocessError):
+        return "desconhecida"
+
+
+def reference_fingerprint(ref_fasta):
+    """Identificação barata da referência (tamanho e data de modificação do FASTA e do .fai)."""
+    if not ref_fasta:
+        return None
+    parts = {}
+    for path in (ref_fasta, f"{ref_fasta}.fai"):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts[os.path.basename(path)] = [stat.st_size, stat.st_mtime_ns]
+    return parts or ref_fasta
+
+
+def fingerprint(**parts):
+    """Hash estável (SHA-256) de um conjunto de entradas serializáveis em JSON."""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def alignment_fingerprints(cram_sha256, ref_fasta, samtools_path="samtools", no_bam=False, compression_level=None):
+    """Impressões digitais (conteúdo, conversão) dos alinhamentos de uma amostra.
+
+    A de conteúdo (hash do CRAM, referência, samtools e modo sem BAM) é a base das
+    etapas que leem os alinhamentos; a de conversão acrescenta o nível de compressão,
+    que muda só os bytes do BAM intermediário, não os resultados.
+    """
+    content = fingerprint(cram=cram_sha256, reference=reference_fingerprint(ref_fasta),
+                          samtools=samtools_version(samtools_path), no_bam=no_bam)
+    return content, fingerprint(alignment=content, compression_level=compression_level, stage='conversion')
+
+
+class StageManifest:
+    """Manifesto de etapas de uma amostra, gravado em JSON."""
+
+    def __init__(self, manifest_path):
+        self.path = manifest_path
+        self.data = {"version": MANIFEST_VERSION, "inputs": {}, "stages": {}}
+        if os.path.exists(manifest_path):
+            try:
+                with open(manifest_path) as handle:
+                    data = json.load(handle)
+                if data.get("version") == MANIFEST_VERSION:
+                    self.data = data
+            except (OSError, ValueError) as e:
+                logging.warning(f"Manifesto ilegível, ignorado: {manifest_path}: {e}")
+
+    def input_fingerprint(self, path):
+        """Tamanho, data de modificação e SHA-256 do arquivo.
+
+        O checksum só é recalculado quando tamanho ou data mudam desde a última execução.
+        """
+        stat = os.stat(path)
+        previous = self.data["inputs"].get(path)
+        if previous and previous["size"] == stat.st_size and previous["mtime_ns"] == stat.st_mtime_ns:
+            return previous
+        logging.info(f"Calculando checksum de {path}")
+        current = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_sha256(path)}
+        self.data["inputs"][path] = current
+        self.save()
+        return current
+
+    def is_current(self, stage, stage_fingerprint):
+        """True se a etapa já foi feita com as mesmas entradas e seus arquivos ainda existem."""
+        entry = self.data["stages"].get(stage)
+        return (entry is not None and entry["fingerprint"] == stage_fingerprint
+                and all(os.path.exists(path) for path in entry["outputs"]))
+
+    def record(self, stage, stage_fingerprint, outputs):
+        """Registra a conclusão da etapa."""
+        self.data["stages"][stage] = {
+            "fingerprint": stage_fingerprint,
+            "outputs": list(outputs),
+            "finished_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        self.save()
+
+    def invalidate(self, stage):
+        if self.data["stages"].pop(stage, None) is not None:
+            self.save()
+
+    def save(self):
+        """Grava o manifesto de forma atômica."""
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".json.tmp")
+        with os.fdopen(fd, "w") as handle:
+            json.dump(self.data, handle, indent=2)
+        os.replace(temp_path, self.path)
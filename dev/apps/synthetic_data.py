@@ -0,0 +1,273 @@
+# dev/synthetic_data.py
+import os
+import struct
+
+import numpy as np
+
+from bam_reader import BAI_PSEUDO_BIN, BAI_MIN_SHIFT, parse_alignment_batch, read_bam_header
+from bgzf import BgzfReader, BgzfWriter, make_virtual_offset, split_virtual_offset
+
+# Dados sintéticos para testes e benchmarks sem CRAMs reais nem o FASTA de 3 GB:
+# referência (.fa + .fai), BED de alvos e BAM ordenado + .bai com reads simulados.
+# Os reads não têm sequência/qualidade (SEQ '*'), apenas posição e CIGAR.
+
+DEFAULT_READ_LENGTH = 100
+
+# CIGARs usados na simulação: (operações, tamanho na referência)
+CIGAR_TEMPLATES = (
+    (((100, 0),), 100),                              # 100M
+    (((5, 4), (40, 0), (3, 2), (55, 0)), 98),        # 5S40M3D55M
+    (((30, 0), (200, 3), (70, 0)), 300),             # 30M200N70M
+)
+
+
+def reg2bin(beg, end):
+    """Bin do esquema de binning do BAM para o intervalo [beg, end) (vetorizado)."""
+    beg = np.asarray(beg, dtype=np.int64)
+    end = np.asarray(end, dtype=np.int64) - 1
+    result = np.zeros(beg.shape, dtype=np.int64)
+    done = np.zeros(beg.shape, dtype=bool)
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        same = ~done & ((beg >> shift) == (end >> shift))
+        result[same] = offset + (beg[same] >> shift)
+        done |= same
+    return result
+
+
+def default_contigs(autosomes=2, autosome_length=2_000_000, x_length=1_500_000, y_length=500_000):
+    """Lista de (contig, tamanho): chr1..chrN, chrX e chrY."""
+    contigs = [(f"chr{i}", autosome_length) for i in range(1, autosomes + 1)]
+    contigs.append(("chrX", x_length))
+    contigs.append(("chrY", y_length))
+    return contigs
+
+
+def write_reference(path, contigs, seed=0, line_width=60):
+    """Grava um FASTA aleatório e o respectivo .fai."""
+    rng = np.random.default_rng(seed)
+    alphabet = np.frombuffer(b"ACGT", dtype=np.uint8)
+    offset = 0
+    with open(path, "wb") as fasta, open(f"{path}.fai", "w") as fai:
+        for name, length in contigs:
+            header = f">{name}\n".encode()
+            fasta.write(header)
+            offset += len(header)
+            fai.write(f"{name}\t{length}\t{offset}\t{line_width}\t{line_width + 1}\n")
+            sequence = alphabet[rng.integers(0, 4, length)]
+            for start in range(0, length, line_width):
+                line = sequence[start:start + line_width].tobytes() + b"\n"
+                fasta.write(line)
+                offset += len(line)
+    return path
+
+
+def write_bed(path, contigs, targets_per_contig=500, min_length=50, max_length=400, seed=0):
+    """Grava um BED com alvos aleatórios (ordenados) em cada contig."""
+    rng = np.random.default_rng(seed)
+    with open(path, "w") as bed:
+        for name, length in contigs:
+            starts = np.sort(rng.integers(0, length - max_length, targets_per_contig))
+            ends = starts + rng.integers(min_length, max_length, targets_per_contig)
+            bed.writelines(f"{name}\t{start}\t{end}\n" for start, end in zip(starts.tolist(), ends.tolist()))
+    return path
+
+
+def simulate_reads(contigs, depth=10, sex="male", duplicate_rate=0.05, seed=0,
+                   read_length=DEFAULT_READ_LENGTH):
+    """Sorteia reads uniformes em cada contig; retorna arrays ordenados (ref_id, pos, template, flag).
+
+    Autossomos recebem `depth`; X recebe metade no sexo masculino; Y recebe
+    metade no masculino e nada no feminino.
+    """
+    rng = np.random.default_rng(seed)
+    ref_ids, positions = [], []
+    for ref_id, (name, length) in enumerate(contigs):
+        short = name.lower().removeprefix("chr")
+        factor = 1.0
+        if short == "x" and sex == "male":
+            factor = 0.5
+        elif short == "y":
+            factor = 0.5 if sex == "male" else 0.0
+        count = int(length * depth * factor / read_length)
+        positions.append(np.sort(rng.integers(0, max(1, length - 400), count)))
+        ref_ids.append(np.full(count, ref_id, dtype=np.int32))
+    ref_ids = np.concatenate(ref_ids)
+    positions = np.concatenate(positions).astype(np.int64)
+    templates = rng.choice(len(CIGAR_TEMPLATES), size=len(positions), p=(0.85, 0.1, 0.05))
+    flags = np.where(rng.random(len(positions)) < duplicate_rate, 0x400, 0).astype(np.uint16)
+    return ref_ids, positions, templates, flags
+
+
+def write_bam(path, contigs, ref_ids, positions, templates, flags, mapq=60):
+    """Grava um BAM ordenado por coordenada (reads já ordenados) e gera o .bai."""
+    text = b"@HD\tVN:1.6\tSO:coordinate\n" + b"".join(
+        f"@SQ\tSN:{name}\tLN:{length}\n".encode() for name, length in contigs)
+    header = bytearray(b"BAM\1" + struct.pack("<i", len(text)) + text + struct.pack("<i", len(contigs)))
+    for name, length in contigs:
+        encoded = name.encode() + b"\0"
+        header += struct.pack("<i", len(encoded)) + encoded + struct.pack("<i", length)
+
+    cigars = [b"".join(struct.pack("<I", size << 4 | op) for size, op in ops) for ops, _span in CIGAR_TEMPLATES]
+    spans = np.array([span for _ops, span in CIGAR_TEMPLATES], dtype=np.int64)
+    bins = reg2bin(positions, positions + spans[templates])
+    core = struct.Struct("<iiiBBHHHiiii")
+
+    with BgzfWriter(path) as writer:
+        writer.write(bytes(header))
+        writer.flush_block()
+        for i, (ref_id, pos, template, flag, bin_id) in enumerate(zip(
+                ref_ids.tolist(), positions.tolist(), templates.tolist(), flags.tolist(), bins.tolist())):
+            name = b"r%09d\0" % i
+            cigar = cigars[template]
+            block_size = core.size - 4 + len(name) + len(cigar)
+            writer.write(core.pack(block_size, ref_id, pos, len(name), mapq, bin_id, len(cigar) // 4,
+                                   flag, 0, -1, -1, 0) + name + cigar)
+    index_bam(path)
+    return path
+
+
+def _index_records(data, base, block_offsets, block_data_starts, columns):
+    """Decodifica os registros completos de `data` e guarda virtual offset, contig, início, fim, bin e flag."""
+    core, offsets, reference_end, consumed = parse_alignment_batch(data)
+    if len(core):
+        absolute = offsets + base
+        starts = np.asarray(block_data_starts, dtype=np.int64)
+        which = np.searchsorted(starts, absolute, side="right") - 1
+        columns["vo"].append((np.asarray(block_offsets, dtype=np.int64)[which] << 16) | (absolute - starts[which]))
+        positions = core["pos"].astype(np.int64)
+        columns["ref"].append(core["ref_id"].astype(np.int64))
+        columns["pos"].append(positions)
+        columns["end"].append(np.maximum(reference_end, positions + 1))
+        columns["bin"].append(core["bin"].astype(np.int64))
+        columns["flag"].append(core["flag"].astype(np.int64))
+    return data[consumed:], base + consumed
+
+
+def index_bam(bam_file, bai_file=None, batch_bytes=64 * 1024 * 1024):
+    """Gera o .bai de um BAM ordenado em Python/NumPy (equivalente ao samtools index)."""
+    _, references = read_bam_header(bam_file)
+    n_refs = len(references)
+    columns = {key: [] for key in ("vo", "ref", "pos", "end", "bin", "flag")}
+
+    with BgzfReader(bam_file) as reader:
+        # Pula o cabeçalho: os registros começam após o texto e a lista de contigs
+        reader.read(4)
+        reader.read(struct.unpack("<i", reader.read(4))[0])
+        reader.read(4)
+        for _ in range(n_refs):
+            reader.read(struct.unpack("<i", reader.read(4))[0] + 4)
+        first_block, first_within = split_virtual_offset(reader.tell())
+
+        # Guarda onde cada bloco começa (no arquivo e nos dados) para montar os virtual offsets
+        block_offsets, block_data_starts, parts = [], [], []
+        pending, pending_base = b"", 0
+        data_position = buffered = 0
+        end_of_data = reader.tell()
+        for block_offset, data in reader.iter_blocks():
+            if block_offset < first_block:
+                continue
+            skip = first_within if block_offset == first_block else 0
+            block_offsets.append(block_offset)
+            block_data_starts.append(data_position - skip)
+            parts.append(data[skip:])
+            data_position += len(data) - skip
+            buffered += len(data) - skip
+            end_of_data = make_virtual_offset(block_offset, len(data))
+            if buffered >= batch_bytes:
+                pending, pending_base = _index_records(pending + b"".join(parts), pending_base,
+                                                       block_offsets, block_data_starts, columns)
+                parts, buffered = [], 0
+        _index_records(pending + b"".join(parts), pending_base, block_offsets, block_data_starts, columns)
+
+    if columns["vo"]:
+        vo = np.concatenate(columns["vo"]).astype(np.uint64)
+        ref, pos, end, bins, flag = (np.concatenate(columns[key]) for key in ("ref", "pos", "end", "bin", "flag"))
+    else:
+        vo = np.empty(0, dtype=np.uint64)
+        ref = pos = end = bins = flag = np.empty(0, dtype=np.int64)
+    vo_end = np.append(vo[1:], np.uint64(end_of_data))
+
+    out = bytearray(b"BAI\1" + struct.pack("<i", n_refs))
+    for ref_id in range(n_refs):
+        on_ref = np.flatnonzero(ref == ref_id)
+        if not len(on_ref):
+            out += struct.pack("<ii", 0, 0)
+            continue
+        # Chunks: registros consecutivos no mesmo bin viram um único chunk
+        order = on_ref[np.lexsort((on_ref, bins[on_ref]))]
+        new_chunk = np.ones(len(order), dtype=bool)
+        new_chunk[1:] = (bins[order][1:] != bins[order][:-1]) | (order[1:] != order[:-1] + 1)
+        chunk_first = order[new_chunk]
+        chunk_last = order[np.append(np.flatnonzero(new_chunk)[1:] - 1, len(order) - 1)]
+        chunk_bins = bins[chunk_first]
+        unique_bins, bin_starts = np.unique(chunk_bins, return_index=True)
+        bin_ends = np.append(bin_starts[1:], len(chunk_bins))
+        out += struct.pack("<i", len(unique_bins) + 1)
+        for bin_id, first, last in zip(unique_bins.tolist(), bin_starts.tolist(), bin_ends.tolist()):
+            chunks = np.empty((last - first, 2), dtype="<u8")
+            chunks[:, 0] = vo[chunk_first[first:last]]
+            chunks[:, 1] = vo_end[chunk_last[first:last]]
+            out += struct.pack("<Ii", bin_id, last - first) + chunks.tobytes()
+        unmapped = int(((flag[on_ref] & 0x4) != 0).sum())
+        out += struct.pack("<Ii", BAI_PSEUDO_BIN, 2) + struct.pack(
+            "<QQQQ", int(vo[on_ref[0]]), int(vo_end[on_ref[-1]]), len(on_ref) - unmapped, unmapped)
+
+        # Índice linear: menor virtual offset de um read que toca cada janela de 16 kb
+        first_window = pos[on_ref] >> BAI_MIN_SHIFT
+        last_window = (end[on_ref] - 1) >> BAI_MIN_SHIFT
+        counts = last_window - first_window + 1
+        windows = np.repeat(first_window, counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+        n_windows = int(last_window.max()) + 1
+        linear = np.full(n_windows, np.iinfo(np.uint64).max, dtype=np.uint64)
+        np.minimum.at(linear, windows, np.repeat(vo[on_ref], counts))
+        # Janelas sem reads recebem o offset da próxima janela preenchida (como no htslib, valor seguro)
+        empty = linear == np.iinfo(np.uint64).max
+        if empty.any():
+            filled = np.flatnonzero(~empty)
+            nxt = np.searchsorted(filled, np.flatnonzero(empty))
+            linear[empty] = linear[filled[np.minimum(nxt, len(filled) - 1)]]
+        out += struct.pack("<i", n_windows) + linear.astype("<u8").tobytes()
+
+    with open(bai_file or f"{bam_file}.bai", "wb") as handle:
+        handle.write(bytes(out))
+    return bai_file or f"{bam_file}.bai"
+
+
+def make_dataset(output_dir, contigs=None, depth=10, targets_per_contig=500, sex="male", seed=0,
+                 sample_name="sintetica"):
+    """Gera referência, BED e BAM+.bai sintéticos em `output_dir`; retorna um dicionário de caminhos."""
+    os.makedirs(output_dir, exist_ok=True)
+    contigs = contigs or default_contigs()
+    reference = write_reference(os.path.join(output_dir, "referencia.fa"), contigs, seed)
+    bed = write_bed(os.path.join(output_dir, "alvos.bed"), contigs, targets_per_contig, seed=seed)
+    reads = simulate_reads(contigs, depth, sex, seed=seed)
+    bam = write_bam(os.path.join(output_dir, f"{sample_name}.bam"), contigs, *reads)
+    return {
+        "reference": reference,
+        "bed": bed,
+        "bam": bam,
+        "bai": f"{bam}.bai",
+        "contigs": contigs,
+        "reads": int(len(reads[0])),
+    }
+
+
+# Execução direta: gera um conjunto de dados sintético
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Gera referência, BED e BAM sintéticos para testes")
+    parser.add_argument("--output_dir", required=True, help="Diretório de saída")
+    parser.add_argument("--autosomes", type=int, default=2, help="Número de autossomos (padrão: 2)")
+    parser.add_argument("--contig_length", type=int, default=2_000_000, help="Tamanho de cada autossomo")
+    parser.add_argument("--depth", type=float, default=10, help="Profundidade média nos autossomos")
+    parser.add_argument("--targets", type=int, default=500, help="Alvos do BED por contig")
+    parser.add_argument("--sex", choices=["male", "female"], default="male", help="Sexo simulado")
+    parser.add_argument("--seed", type=int, default=0, help="Semente do gerador aleatório")
+    args = parser.parse_args()
+
+    dataset = make_dataset(args.output_dir,
+                           default_contigs(args.autosomes, args.contig_length,
+                                           args.contig_length * 3 // 4, args.contig_length // 4),
+                           args.depth, args.targets, args.sex, args.seed)
+    print(f"{dataset['reads']} reads gerados em {dataset['bam']}")
@@ -0,0 +1,235 @@
+# dev/target_index.py
+import hashlib
+import logging
+import os
+import re
+import tempfile
+
+import numpy as np
+
+from bam_reader import read_bam_header
+
+# Índice de alvos pré-processado: o BED é validado, ordenado, tem alvos sobrepostos
+# unidos e nomes de contig normalizados uma única vez por conteúdo. O resultado fica
+# em intermediate/target_index/<hash>.npz (+ um .bed normalizado para o samtools).
+
+TARGET_INDEX_VERSION = 1
+
+
+class TargetIndex:
+    """Alvos em forma compacta: nomes de contig, offsets por contig e arrays de início/fim.
+
+    Os alvos do contig i ficam em starts[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, contig_names, offsets, starts, ends, bed_hash=None, bed_path=None):
+        self.contig_names = list(contig_names)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.bed_hash = bed_hash
+        self.bed_path = bed_path
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def lengths(self):
+        return self.ends - self.starts
+
+    def contig_slice(self, contig):
+        """Fatia dos arrays correspondente ao contig (vazia se o contig não tiver alvos)."""
+        if contig not in self.contig_names:
+            return slice(0, 0)
+        i = self.contig_names.index(contig)
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def find_contig(self, chrom_regex):
+        """Nome do contig que casa com a expressão regular (ou None)."""
+        for name in self.contig_names:
+            if chrom_regex.match(name):
+                return name
+        return None
+
+    def targeted_bases_by_contig(self):
+        """Dicionário {contig: total de bases-alvo}."""
+        per_contig = np.add.reduceat(self.lengths, self.offsets[:-1]) if len(self) else []
+        return {name: int(per_contig[i]) if self.offsets[i + 1] > self.offsets[i] else 0
+                for i, name in enumerate(self.contig_names)}
+
+    def iter_rows(self, contigs=None):
+        """Gera tuplas (contig, início, fim), opcionalmente só dos contigs informados."""
+        for i, name in enumerate(self.contig_names):
+            if contigs is not None and name not in contigs:
+                continue
+            block = slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+            for start, end in zip(self.starts[block].tolist(), self.ends[block].tolist()):
+                yield name, start, end
+
+    def write_bed(self, path, contigs=None):
+        """Grava os alvos (ou só os dos contigs informados) em formato BED."""
+        with open(path, "w") as bed:
+            bed.writelines(f"{name}\t{start}\t{end}\n" for name, start, end in self.iter_rows(contigs))
+        return path
+
+    def save(self, path):
+        """Grava o índice em .npz (escrita atômica, segura com amostras em paralelo)."""
+        directory = os.path.dirname(path)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".npz.tmp")
+        with os.fdopen(fd, "wb") as handle:
+            np.savez(handle, version=TARGET_INDEX_VERSION, contig_names=np.asarray(self.contig_names, dtype=str),
+                     offsets=self.offsets, starts=self.starts, ends=self.ends,
+                     bed_hash=np.asarray(self.bed_hash or ""))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path, bed_path=None):
+        with np.load(path) as data:
+            if int(data["version"]) != TARGET_INDEX_VERSION:
+                raise ValueError(f"Versão de índice de alvos incompatível: {path}")
+            return cls(data["contig_names"].tolist(), data["offsets"], data["starts"], data["ends"],
+                       str(data["bed_hash"]) or None, bed_path)
+
+
+def file_sha256(path, block_size=4 * 1024 * 1024):
+    """Hash SHA-256 do conteúdo de um arquivo."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_reference_contigs(ref_fasta=None, bam_file=None):
+    """Lista de (contig, tamanho) do .fai da referência ou do cabeçalho de um BAM (None se indisponível)."""
+    if ref_fasta and os.path.exists(f"{ref_fasta}.fai"):
+        with open(f"{ref_fasta}.fai") as fai:
+            return [(parts[0], int(parts[1])) for parts in (line.split("\t") for line in fai) if len(parts) >= 2]
+    if bam_file and os.path.exists(bam_file):
+        return read_bam_header(bam_file)[1]
+    return None
+
+
+def normalize_contig_name(name, known_contigs):
+    """Ajusta o nome do contig do BED ao da referência (chr1 <-> 1, chrM <-> MT); None se não existir."""
+    if known_contigs is None or name in known_contigs:
+        return name
+    if name.lower().startswith("chr"):
+        candidates = [name[3:], "MT" if name[3:].upper() == "M" else None]
+    else:
+        candidates = [f"chr{name}", "chrM" if name.upper() == "MT" else None]
+    for candidate in candidates:
+        if candidate and candidate in known_contigs:
+            return candidate
+    return None
+
+
+def natural_contig_key(name):
+    """Ordem natural de contigs: 1..22, X, Y, M e depois os demais em ordem alfabética."""
+    short = re.sub(r"^chr", "", name, flags=re.IGNORECASE)
+    if short.isdigit():
+        return (0, int(short), "")
+    order = {"X": 23, "Y": 24, "M": 25, "MT": 25}
+    if short.upper() in order:
+        return (0, order[short.upper()], "")
+    return (1, 0, name)
+
+
+def build_target_index(bed_file, reference_contigs=None):
+    """Lê, valida, normaliza, ordena e une os alvos do BED."""
+    known = dict(reference_contigs) if reference_contigs else None
+    contig_order = {name: i for i, (name, _length) in enumerate(reference_contigs or [])}
+
+    per_contig = {}
+    skipped_contigs = set()
+    invalid_lines = 0
+    with open(bed_file) as bed:
+        for line_number, line in enumerate(bed, 1):
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            parts = line.rstrip("\n").split("\t")
+            try:
+                start, end = int(parts[1]), int(parts[2])
+            except (IndexError, ValueError):
+                invalid_lines += 1
+                logging.warning(f"Linha {line_number} inválida no BED {bed_file}: {line.rstrip()}")
+                continue
+            if start < 0 or end <= start:
+                invalid_lines += 1
+                logging.warning(f"Intervalo inválido na linha {line_number} do BED {bed_file}: {line.rstrip()}")
+                continue
+            contig = normalize_contig_name(parts[0], known)
+            if contig is None:
+                skipped_contigs.add(parts[0])
+                continue
+            if known and end > known[contig]:
+                logging.warning(f"Alvo além do fim de {contig} na linha {line_number}; cortado em {known[contig]}")
+                end = known[contig]
+            per_contig.setdefault(contig, ([], []))
+            per_contig[contig][0].append(start)
+            per_contig[contig][1].append(end)
+
+    if skipped_contigs:
+        logging.warning(f"Contigs do BED ausentes na referência (alvos ignorados): {', '.join(sorted(skipped_contigs))}")
+    if invalid_lines:
+        logging.warning(f"{invalid_lines} linhas inválidas ignoradas no BED {bed_file}")
+
+    if contig_order:
+        contigs = sorted(per_contig, key=lambda name: contig_order[name])
+    else:
+        contigs = sorted(per_contig, key=natural_contig_key)
+
+    offsets = [0]
+    all_starts, all_ends = [], []
+    for contig in contigs:
+        starts = np.asarray(per_contig[contig][0], dtype=np.int64)
+        ends = np.asarray(per_contig[contig][1], dtype=np.int64)
+        order = np.lexsort((ends, starts))
+        starts, ends = starts[order], ends[order]
+        # Une alvos sobrepostos ou adjacentes: começa um novo bloco quando o início passa do maior fim anterior
+        running_end = np.maximum.accumulate(ends)
+        new_block = np.concatenate(([True], starts[1:] > running_end[:-1]))
+        block_ids = np.cumsum(new_block) - 1
+        all_starts.append(starts[new_block])
+        all_ends.append(np.maximum.reduceat(ends, np.flatnonzero(new_block)) if len(ends) else ends)
+        offsets.append(offsets[-1] + int(block_ids[-1] + 1 if len(block_ids) else 0))
+
+    return TargetIndex(contigs, offsets,
+                       np.concatenate(all_starts) if all_starts else [],
+                       np.concatenate(all_ends) if all_ends else [])
+
+
+def load_target_index(bed_file, intermediate_dir, ref_fasta=None, bam_file=None):
+    """Carrega o índice de alvos do cache ou o constrói (uma vez por conteúdo de BED + referência).
+
+    Retorna o TargetIndex com `bed_path` apontando para o BED normalizado, que
+    pode ser passado direto ao samtools.
+    """
+    reference_contigs = read_reference_contigs(ref_fasta, bam_file)
+    digest = hashlib.sha256()
+    digest.update(file_sha256(bed_file).encode())
+    digest.update(f"v{TARGET_INDEX_VERSION}".encode())
+    for name, length in reference_contigs or []:
+        digest.update(f"\n{name}\t{length}".encode())
+    key = digest.hexdigest()[:16]
+
+    cache_dir = os.path.join(intermediate_dir, "target_index")
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, f"{key}.npz")
+    bed_path = os.path.join(cache_dir, f"{key}.bed")
+
+    if os.path.exists(index_path) and os.path.exists(bed_path):
+        logging.info(f"Índice de alvos carregado do cache: {index_path}")
+        return TargetIndex.load(index_path, bed_path)
+
+    logging.info(f"Pré-processando BED {bed_file} -> {index_path}")
+    target_index = build_target_index(bed_file, reference_contigs)
+    target_index.bed_hash = key
+    fd, temp_bed = tempfile.mkstemp(dir=cache_dir, suffix=".bed.tmp")
+    os.close(fd)
+    target_index.write_bed(temp_bed)
+    os.replace(temp_bed, bed_path)
+    target_index.save(index_path)
+    target_index.bed_path = bed_path
+    logging.info(f"Índice de alvos com {len(target_index)} regiões em {len(target_index.contig_names)} contigs")
+    return target_index
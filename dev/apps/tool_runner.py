@@ -0,0 +1,207 @@
+# dev/tool_runner.py
+import asyncio
+import logging
+import os
+import subprocess
+import threading
+from contextlib import asynccontextmanager
+
+# Camada única para executar ferramentas externas (samtools, bcftools, tabix...) com asyncio:
+# limite de execuções simultâneas, stdout lido em fluxo por "consumidores", stderr
+# capturado (só o código de saída indica falha), tempo limite e cancelamento
+# (o processo é encerrado). run_tool_sync/run_async permitem o uso em código síncrono.
+# O limite vale para o processo inteiro: cada chamada síncrona roda em um event loop
+# novo e várias threads (shards de cobertura, contaminação) chamam ao mesmo tempo.
+
+MAX_CONCURRENT_TOOLS = int(os.getenv("MAX_CONCURRENT_TOOLS", os.cpu_count() or 1))
+DEFAULT_CHUNK_BYTES = 1024 * 1024
+STDERR_LIMIT = 64 * 1024  # guarda só o fim do stderr (mensagens de erro ficam no final)
+SLOT_POLL_SECONDS = 0.05
+
+_tool_slots = threading.BoundedSemaphore(MAX_CONCURRENT_TOOLS)
+
+
+class ToolError(subprocess.CalledProcessError):
+    """Ferramenta terminou com código de saída diferente de zero."""
+
+    def __str__(self):
+        return f"{' '.join(map(str, self.cmd))} terminou com código {self.returncode}: {self.stderr}"
+
+
+class ToolResult:
+    """Resultado de uma execução: código de saída, stderr e stdout (se capturado)."""
+
+    def __init__(self, command, returncode, stderr, stdout=None):
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr
+        self.stdout = stdout
+
+
+@asynccontextmanager
+async def tool_slot():
+    """Vaga no limite de MAX_CONCURRENT_TOOLS ferramentas rodando no processo (todos os
+    event loops e threads). A espera não bloqueia o loop e pode ser cancelada."""
+    while not _tool_slots.acquire(blocking=False):
+        await asyncio.sleep(SLOT_POLL_SECONDS)
+    try:
+        yield
+    finally:
+        _tool_slots.release()
+
+
+async def _pump_stdout(stream, consumer, chunk_bytes, lines):
+    if lines:
+        # Lotes de linhas completas (texto), como o BedcovStreamParser.feed espera
+        pending = b""
+        while True:
+            chunk = await stream.read(chunk_bytes)
+            data = pending + chunk
+            if chunk:
+                cut = data.rfind(b"\n") + 1
+                data, pending = data[:cut], data[cut:]
+            if data:
+                consumer(data.decode().splitlines(keepends=True))
+            if not chunk:
+                break
+    else:
+        while True:
+            chunk = await stream.read(chunk_bytes)
+            if not chunk:
+                break
+            consumer(chunk)
+
+
+async def _read_stderr(stream):
+    tail = b""
+    while True:
+        chunk = await stream.read(DEFAULT_CHUNK_BYTES)
+        if not chunk:
+            return tail.decode(errors="replace").strip()
+        tail = (tail + chunk)[-STDERR_LIMIT:]
+
+
+async def _feed_stdin(stream, stdin_path, chunk_bytes, on_input):
+    """Envia o arquivo pelo stdin; para sem erro se a ferramenta fechar a entrada antes do fim."""
+    try:
+        with open(stdin_path, "rb") as source:
+            while True:
+                chunk = source.read(chunk_bytes)
+                if not chunk:
+                    break
+                stream.write(chunk)
+                await stream.drain()
+                if on_input is not None:
+                    on_input(len(chunk))
+    except (BrokenPipeError, ConnectionResetError):
+        # A ferramenta encerrou antes do fim da entrada; o código de saída indica o erro
+        return
+    stream.close()
+
+
+async def _monitor(process, callback, interval):
+    while process.returncode is None:
+        callback(process.pid)
+        await asyncio.sleep(interval)
+
+
+async def run_tool(command, stdout_consumer=None, lines=False, capture_stdout=False, stdin_path=None,
+                   on_input=None, monitor=None, monitor_interval=0.5, timeout=None,
+                   chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """Executa `command` (lista de argumentos, sem shell) e retorna um ToolResult.
+
+    - `stdout_consumer(chunk)` recebe o stdout em blocos de bytes, ou em listas de
+      linhas de texto completas com `lines=True`; `capture_stdout` guarda o stdout inteiro.
+    - `stdin_path` é enviado pelo stdin; `on_input(n)` é chamado a cada bloco enviado.
+    - `monitor(pid)` é chamado a cada `monitor_interval` segundos enquanto o processo roda.
+    - Com `timeout` (segundos) o processo é encerrado e subprocess.TimeoutExpired é lançado.
+    Falha (ToolError) só com código de saída diferente de zero; stderr vira aviso no log.
+    """
+    command = [str(part) for part in command]
+    async with tool_slot():
+        logging.info(f"Executando: {' '.join(command)}")
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=asyncio.subprocess.PIPE if stdin_path else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE if stdout_consumer or capture_stdout else asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+                limit=chunk_bytes)
+        except FileNotFoundError:
+            logging.error(f"Ferramenta '{command[0]}' não encontrada. Verifique se está no PATH.")
+            raise
+
+        captured = []
+        consumer = captured.append if capture_stdout else stdout_consumer
+        stderr_task = asyncio.ensure_future(_read_stderr(process.stderr))
+        tasks = [stderr_task]
+        if consumer is not None:
+            tasks.append(asyncio.ensure_future(_pump_stdout(process.stdout, consumer, chunk_bytes, lines)))
+        if stdin_path:
+            tasks.append(asyncio.ensure_future(_feed_stdin(process.stdin, stdin_path, chunk_bytes, on_input)))
+        monitor_task = (asyncio.ensure_future(_monitor(process, monitor, monitor_interval))
+                        if monitor is not None else None)
+
+        try:
+            await asyncio.wait_for(asyncio.gather(*tasks, process.wait()), timeout)
+        except BaseException as e:
+            # Tempo esgotado, cancelamento ou erro no consumidor: encerra a ferramenta
+            for task in tasks:
+                task.cancel()
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            if isinstance(e, asyncio.TimeoutError):
+                logging.error(f"Tempo limite de {timeout}s excedido: {' '.join(command)}")
+                raise subprocess.TimeoutExpired(command, timeout) from None
+            raise
+        finally:
+            if monitor_task is not None:
+                monitor_task.cancel()
+
+    stderr = stderr_task.result()
+    if process.returncode != 0:
+        logging.error(f"Erro ao executar {' '.join(command)}: {stderr}")
+        raise ToolError(process.returncode, command, stderr=stderr)
+    if stderr:
+        logging.warning(f"{os.path.basename(command[0])}: {stderr}")
+
+    stdout = None
+    if capture_stdout:
+        stdout = [line for batch in captured for line in batch] if lines else b"".join(captured)
+    return ToolResult(command, process.returncode, stderr, stdout)
+
+
+def run_async(coroutine):
+    """Executa uma corrotina a partir de código síncrono (em outra thread se já houver um loop rodando)."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    outcome = {}
+
+    def runner():
+        try:
+            outcome["result"] = asyncio.run(coroutine)
+        except BaseException as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=runner)
+    thread.start()
+    thread.join()
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+
+def run_tool_sync(command, **kwargs):
+    """Versão síncrona de run_tool."""
+    return run_async(run_tool(command, **kwargs))
+
+
+def run_tools_sync(commands, **kwargs):
+    """Executa vários comandos ao mesmo tempo (respeitando o limite) e retorna os ToolResult na ordem dada."""
+    async def run_all():
+        return await asyncio.gather(*(run_tool(command, **kwargs) for command in commands))
+    return run_async(run_all())
@@ -0,0 +1,318 @@
+# dev/work_queue.py
+import hashlib
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Fila de trabalho sobre um sistema de arquivos compartilhado (NFS), para vários
+# nós drenarem o mesmo lote sem processar uma amostra duas vezes. Cada item tem,
+# no diretório da fila, até três arquivos:
+#   <item>.lock   — concessão (lease) criada com O_CREAT|O_EXCL (só um nó vence);
+#                   o dono renova a data de modificação periodicamente (heartbeat)
+#   <item>.done   — item concluído (nunca mais é reivindicado)
+#   <item>.failed — item com erro (apague o arquivo para tentar de novo)
+# Uma concessão não renovada por lease_seconds é de um nó que caiu: outro nó a
+# substitui pela sua (os.replace, atômico) e confirma o dono relendo o arquivo.
+# Os relógios dos nós devem estar sincronizados (NTP) com folga bem menor que
+# lease_seconds.
+
+LEASE_SECONDS = 300
+POLL_SECONDS = 10
+
+
+def worker_token():
+    """Identificação única deste trabalhador (máquina, processo e sufixo aleatório)."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def batch_directory(intermediate_dir, cram_dir, bed_file):
+    """Diretório da fila de um lote: intermediate/queue/<hash dos caminhos do CRAM e do BED>.
+    Os nós precisam montar o disco compartilhado no mesmo caminho (ou usar um diretório explícito)."""
+    key = hashlib.sha256(f"{os.path.realpath(cram_dir)}\t{os.path.realpath(bed_file)}".encode()).hexdigest()[:16]
+    return os.path.join(intermediate_dir, "queue", key)
+
+
+class WorkQueue:
+    """Fila de itens (nomes de amostra) em um diretório compartilhado."""
+
+    def __init__(self, directory, lease_seconds=LEASE_SECONDS, token=None):
+        self.directory = directory
+        self.lease_seconds = lease_seconds
+        # Espera entre tomar uma concessão vencida e confirmar o dono
+        self.confirm_seconds = min(1.0, lease_seconds / 10)
+        self.token = token or worker_token()
+        self.held = set()
+        self.finished = set()
+        self._held_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, item, kind):
+        return os.path.join(self.directory, f"{item}.{kind}")
+
+    def _read_owner(self, path):
+        try:
+            with open(path) as handle:
+                return json.load(handle).get("owner")
+        except (OSError, ValueError):
+            return None
+
+    def _write_marker(self, item, kind, info):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=f".{kind}.tmp")
+        with os.fdopen(fd, "w") as handle:
+            json.dump(dict(info, owner=self.token, at=time.strftime("%Y-%m-%d %H:%M:%S")), handle)
+        os.replace(temp_path, self.path(item, kind))
+
+    def is_finished(self, item):
+        """True se o item já foi concluído ou falhou (em qualquer nó)."""
+        if item in self.finished:
+            return True
+        if os.path.exists(self.path(item, "done")) or os.path.exists(self.path(item, "failed")):
+            self.finished.add(item)
+            return True
+        return False
+
+    def lease_age(self, item):
+        """Segundos desde a última renovação da concessão, ou None se o item está livre."""
+        try:
+            return time.time() - os.stat(self.path(item, "lock")).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _lease_record(self):
+        return {"owner": self.token, "host": socket.gethostname(), "pid": os.getpid(),
+                "claimed_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+    def _steal_if_stale(self, item):
+        """Toma a concessão vencida de um nó que caiu. True se este trabalhador passou a ser o dono.
+
+        A concessão nova é gravada ao lado e trocada pela vencida com os.replace (atômico),
+        sem o arquivo deixar de existir. Dois nós podem trocar quase ao mesmo tempo: o último
+        vence, e cada um relê a concessão depois de um intervalo curto para confirmar o dono.
+        """
+        lock_path = self.path(item, "lock")
+        age = self.lease_age(item)
+        if age is None or age < self.lease_seconds:
+            return False
+        stale_owner = self._read_owner(lock_path)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".lock.tmp")
+        with os.fdopen(fd, "w") as handle:
+            json.dump(self._lease_record(), handle)
+        try:
+            # Outro nó pode ter tomado ou renovado a concessão depois do stat
+            age = self.lease_age(item)
+            if age is None or age < self.lease_seconds or self._read_owner(lock_path) != stale_owner:
+                return False
+            os.replace(temp_path, lock_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        time.sleep(self.confirm_seconds)
+        if self._read_owner(lock_path) != self.token:
+            logging.warning(f"Concessão vencida de {item} tomada por outro nó")
+            return False
+        logging.warning(f"Concessão vencida de {item} (dono {stale_owner}, {age:.0f}s sem renovação) tomada")
+        return True
+
+    def claim(self, item):
+        """Tenta reivindicar o item; True se este trabalhador passou a ser o dono."""
+        if self.is_finished(item):
+            return False
+        if self.lease_age(item) is not None:
+            if not self._steal_if_stale(item):
+                return False
+        else:
+            try:
+                fd = os.open(self.path(item, "lock"), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                return False
+            with os.fdopen(fd, "w") as handle:
+                json.dump(self._lease_record(), handle)
+        # Outro nó pode ter concluído o item e liberado a concessão antes da reivindicação
+        if self.is_finished(item):
+            self.release(item)
+            return False
+        with self._held_lock:
+            self.held.add(item)
+        return True
+
+    def claim_next(self, items):
+        """Reivindica o primeiro item livre da lista; None se nenhum estiver disponível agora."""
+        for item in items:
+            if self.claim(item):
+                return item
+        return None
+
+    def unfinished(self, items):
+        """Itens ainda não concluídos nem com falha (livres ou com concessão de algum nó)."""
+        return [item for item in items if not self.is_finished(item)]
+
+    def renew(self, item):
+        """Renova a concessão do item; False se ela foi perdida (roubada após vencer)."""
+        lock_path = self.path(item, "lock")
+        if self._read_owner(lock_path) != self.token:
+            logging.error(f"Concessão de {item} perdida: outro nó pode estar processando o item")
+            return False
+        os.utime(lock_path)
+        return True
+
+    def renew_all(self):
+        with self._held_lock:
+            items = list(self.held)
+        for item in items:
+            self.renew(item)
+
+    def release(self, item):
+        """Libera a concessão (se ainda for deste trabalhador)."""
+        with self._held_lock:
+            self.held.discard(item)
+        lock_path = self.path(item, "lock")
+        if self._read_owner(lock_path) == self.token:
+            os.remove(lock_path)
+
+    def mark_done(self, item, **info):
+        """Grava o marcador de conclusão e libera a concessão."""
+        self._write_marker(item, "done", info)
+        self.finished.add(item)
+        self.release(item)
+
+    def mark_failed(self, item, error):
+        """Grava o marcador de falha (com a mensagem de erro) e libera a concessão."""
+        self._write_marker(item, "failed", {"error": str(error)})
+        self.finished.add(item)
+        self.release(item)
+
+    @contextmanager
+    def heartbeat(self, interval=None):
+        """Renova as concessões em uma thread enquanto o bloco executa."""
+        interval = interval or max(1.0, self.lease_seconds / 5)
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                try:
+                    self.renew_all()
+                except OSError as e:
+                    logging.error(f"Erro ao renovar concessões da fila {self.directory}: {e}")
+
+        thread = threading.Thread(target=beat, name="work-queue-heartbeat", daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+            # Saída normal ou por exceção: concessões pendentes voltam para a fila
+            with self._held_lock:
+                items = list(self.held)
+            for item in items:
+                self.release(item)
+
+    def status(self, items=None):
+        """Contagem de itens concluídos, com falha, em processamento (concessão válida ou vencida)."""
+        names = set()
+        for entry in os.listdir(self.directory):
+            name, _, kind = entry.rpartition(".")
+            if kind in ("lock", "done", "failed"):
+                names.add(name)
+        counts = {"done": 0, "failed": 0, "running": 0, "stale": 0, "pending": 0}
+        for item in sorted(names | set(items or [])):
+            if os.path.exists(self.path(item, "done")):
+                counts["done"] += 1
+            elif os.path.exists(self.path(item, "failed")):
+                counts["failed"] += 1
+            else:
+                age = self.lease_age(item)
+                if age is None:
+                    counts["pending"] += 1
+                else:
+                    counts["running" if age < self.lease_seconds else "stale"] += 1
+        return counts
+
+
+def _simulated_worker(directory, items, lease_seconds, work_seconds, journal, crash_after):
+    """Trabalhador de teste: processa itens e registra cada conclusão no diário.
+    Com crash_after, morre (os._exit) no meio do item seguinte sem liberar a concessão."""
+    queue = WorkQueue(directory, lease_seconds)
+    processed = 0
+    with queue.heartbeat(interval=lease_seconds / 5):
+        while True:
+            item = queue.claim_next(items)
+            if item is None:
+                if not queue.unfinished(items):
+                    break
+                time.sleep(lease_seconds / 5)
+                continue
+            time.sleep(work_seconds)
+            if crash_after is not None and processed == crash_after:
+                os._exit(1)
+            with open(journal, "a") as handle:
+                handle.write(f"{item}\t{queue.token}\n")
+            queue.mark_done(item)
+            processed += 1
+
+
+def simulate(directory, workers=4, items=40, lease_seconds=2.0, work_seconds=0.05, crash_workers=1):
+    """Simulação local: `workers` processos drenam a mesma fila; `crash_workers` deles
+    morrem no meio de um item. Retorna (itens concluídos, itens repetidos, tempo)."""
+    import multiprocessing
+
+    names = [f"amostra_{i:04d}" for i in range(items)]
+    journal = os.path.join(directory, "journal.tsv")
+    os.makedirs(directory, exist_ok=True)
+    start = time.perf_counter()
+    processes = [
+        multiprocessing.Process(target=_simulated_worker,
+                                args=(directory, names, lease_seconds, work_seconds, journal,
+                                      2 if worker < crash_workers else None))
+        for worker in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+
+    with open(journal) as handle:
+        completed = [line.split("\t")[0] for line in handle]
+    duplicates = sorted({name for name in completed if completed.count(name) > 1})
+    return len(set(completed)), duplicates, elapsed
+
+
+# Execução direta: estado de uma fila ou simulação com vários processos
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fila de trabalho em disco compartilhado")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    status_parser = subparsers.add_parser("status", help="Mostra o estado dos itens de uma fila")
+    status_parser.add_argument("queue_dir", help="Diretório da fila (intermediate/queue/<lote>)")
+    status_parser.add_argument("--lease_seconds", type=float, default=LEASE_SECONDS,
+                               help="Duração da concessão usada pelos nós (padrão: 300)")
+    simulate_parser = subparsers.add_parser("simulate", help="Simula vários nós drenando uma fila local")
+    simulate_parser.add_argument("queue_dir", help="Diretório (vazio) para a fila simulada")
+    simulate_parser.add_argument("--workers", type=int, default=4, help="Processos trabalhadores (padrão: 4)")
+    simulate_parser.add_argument("--items", type=int, default=40, help="Itens na fila (padrão: 40)")
+    simulate_parser.add_argument("--crash_workers", type=int, default=1,
+                                 help="Trabalhadores que morrem no meio de um item (padrão: 1)")
+    simulate_parser.add_argument("--lease_seconds", type=float, default=2.0,
+                                 help="Duração da concessão na simulação (padrão: 2)")
+    args = parser.parse_args()
+
+    if args.command == "status":
+        counts = WorkQueue(args.queue_dir, args.lease_seconds).status()
+        print(" | ".join(f"{kind}: {count}" for kind, count in counts.items()))
+    else:
+        completed, duplicates, elapsed = simulate(args.queue_dir, args.workers, args.items,
+                                                  args.lease_seconds, crash_workers=args.crash_workers)
+        print(f"{completed} de {args.items} itens concluídos em {elapsed:.1f}s "
+              f"com {args.workers} trabalhadores ({args.crash_workers} com queda)")
+        if duplicates or completed != args.items:
+            print(f"❌ Itens repetidos: {', '.join(duplicates) or 'nenhum'}; faltando: {args.items - completed}")
+            exit(1)
+        print("✅ Nenhum item processado duas vezes")
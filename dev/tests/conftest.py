@@ -0,0 +1,6 @@
+# dev/tests/conftest.py
+import os
+import sys
+
+# Os módulos do pipeline se importam pelo nome (como ao rodar os scripts de dev/apps)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "apps"))
@@ -0,0 +1,48 @@
+# dev/tests/test_admission.py
+import time
+
+import pytest
+
+import admission
+from admission import CPU, IO, AdmissionController
+
+
+def make_controller(tmp_path, monkeypatch, **options):
+    samples = []
+    monkeypatch.setattr(admission.LoadSampler, "sample", lambda self: samples.append(1) or {
+        "cpu_percent": 10.0, "disk_busy_percent": 10.0, "disk_bytes_per_second": 0.0,
+        "available_memory": 64 * 1024 ** 3})
+    return AdmissionController(2, 2, directory=str(tmp_path), **options), samples
+
+
+def test_load_sampled_once_per_poll_cycle(tmp_path, monkeypatch):
+    controller, samples = make_controller(tmp_path, monkeypatch, poll_seconds=0.2)
+    assert controller.headroom(CPU)[0] and controller.headroom(IO)[0] and controller.headroom(CPU)[0]
+    assert len(samples) == 1
+    time.sleep(0.25)
+    controller.headroom(IO)
+    assert len(samples) == 2
+
+
+def test_settle_interval_between_admissions(tmp_path, monkeypatch):
+    controller, _samples = make_controller(tmp_path, monkeypatch, settle_seconds=0.5, poll_seconds=0.05)
+    with controller.slot(CPU) as first:
+        with controller.slot(CPU) as second:
+            assert (first, second) == (0, 1)
+        start = time.monotonic()
+        with controller.slot(CPU) as third:
+            assert third == 1
+        assert time.monotonic() - start >= 0.3
+
+
+def test_failed_stage_does_not_hold_the_settle_interval(tmp_path, monkeypatch):
+    controller, _samples = make_controller(tmp_path, monkeypatch, settle_seconds=30, poll_seconds=0.05)
+    with controller.slot(CPU):
+        with pytest.raises(RuntimeError):
+            with controller.slot(CPU) as index:
+                assert index == 1
+                raise RuntimeError("etapa falhou")
+        start = time.monotonic()
+        with controller.slot(CPU) as index:
+            assert index == 1
+        assert time.monotonic() - start < 5
@@ -0,0 +1,94 @@
+# dev/tests/test_bam_reader.py
+import struct
+
+import numpy as np
+import pytest
+
+from bam_reader import BAI_PSEUDO_BIN, parse_alignment_batch, read_bai, read_bai_counts
+from coverage import calculate_coverage_numpy
+from synthetic_data import CIGAR_TEMPLATES, simulate_reads, write_bam, write_bed
+
+CONTIGS = [("chr1", 150_000), ("chr2", 100_000)]
+# Operações do CIGAR por código: M=0, I=1, D=2, N=3, S=4
+CIGARS = [[(100, 0)], [(5, 4), (40, 0), (3, 2), (55, 0)], [(30, 0), (200, 3), (70, 0)], [(20, 0), (2, 1), (78, 0)],
+          []]
+
+
+def bam_record(ref_id, pos, cigar, name=b"read", l_seq=0):
+    """Registro BAM (com block_size) com sequência e qualidades de `l_seq` bases."""
+    cigar_bytes = b"".join(struct.pack("<I", size << 4 | op) for size, op in cigar)
+    body = (struct.pack("<iiBBHHHiiii", ref_id, pos, len(name) + 1, 60, 0, len(cigar), 0, l_seq, -1, -1, 0)
+            + name + b"\0" + cigar_bytes + bytes((l_seq + 1) // 2) + bytes([30]) * l_seq)
+    return struct.pack("<i", len(body)) + body
+
+
+def test_parse_alignment_batch_walks_every_record():
+    rng = np.random.default_rng(1)
+    records, expected_ends = [], []
+    for i in range(300):
+        cigar = CIGARS[i % len(CIGARS)]
+        # ref_id com o byte alto preenchido não passa no filtro vetorizado: o resto é lido um a um
+        ref_id = 0x01000000 if i == 200 else 0
+        pos = 1000 + i
+        records.append(bam_record(ref_id, pos, cigar, b"r%d" % i, int(rng.integers(0, 151))))
+        expected_ends.append(pos + sum(size for size, op in cigar if op in (0, 2, 3)))
+    data = b"".join(records)
+    offsets = np.cumsum([0] + [len(record) for record in records])
+
+    core, parsed_offsets, reference_end, consumed = parse_alignment_batch(data + records[0][:50])
+    assert parsed_offsets.tolist() == offsets[:-1].tolist()
+    assert consumed == len(data)
+    assert reference_end.tolist() == expected_ends
+    assert core["ref_id"][200] == 0x01000000
+
+
+def test_parse_alignment_batch_without_complete_record():
+    core, offsets, reference_end, consumed = parse_alignment_batch(bam_record(0, 10, CIGARS[0])[:-1])
+    assert len(core) == len(offsets) == len(reference_end) == consumed == 0
+
+
+def test_read_bai_known_index(tmp_path):
+    bai_file = tmp_path / "known.bai"
+    chunk = struct.pack("<QQ", 100 << 16, 900 << 16)
+    pseudo = struct.pack("<QQQQ", 100 << 16, 900 << 16, 7, 2)
+    data = (b"BAI\1" + struct.pack("<i", 2)
+            + struct.pack("<i", 2) + struct.pack("<Ii", 4681, 1) + chunk + struct.pack("<Ii", BAI_PSEUDO_BIN, 2)
+            + pseudo + struct.pack("<i", 2) + struct.pack("<QQ", 100 << 16, 500 << 16)
+            + struct.pack("<ii", 0, 0))
+    bai_file.write_bytes(data)
+
+    first, second = read_bai(str(bai_file))
+    assert list(first["bins"]) == [4681]
+    assert first["bins"][4681].tolist() == [[100 << 16, 900 << 16]]
+    assert first["linear"].tolist() == [100 << 16, 500 << 16]
+    assert (first["mapped"], first["unmapped"]) == (7, 2)
+    assert not second["bins"] and not len(second["linear"]) and (second["mapped"], second["unmapped"]) == (0, 0)
+    assert read_bai_counts(str(bai_file)) == [(7, 2), (0, 0)]
+
+
+def test_coverage_numpy_matches_brute_force_depth(tmp_path):
+    reads = simulate_reads(CONTIGS, depth=15, seed=4)
+    bam = write_bam(str(tmp_path / "amostra.bam"), CONTIGS, *reads)
+    bed = write_bed(str(tmp_path / "alvos.bed"), CONTIGS, targets_per_contig=80, seed=4)
+
+    # Profundidade por base contando o trecho inteiro de cada read (D e N incluídos, como o bedcov)
+    depth = [np.zeros(length + 1, dtype=np.int64) for _name, length in CONTIGS]
+    for ref_id, position, template, flag in zip(*(column.tolist() for column in reads)):
+        if not flag & 0x400:
+            depth[ref_id][position] += 1
+            depth[ref_id][position + CIGAR_TEMPLATES[template][1]] -= 1
+    depth = [np.cumsum(change[:-1]) for change in depth]
+    names = [name for name, _length in CONTIGS]
+    sums, bases_10x, total = [], 0, 0
+    with open(bed) as handle:
+        for line in handle:
+            chrom, start, end = line.split()
+            values = depth[names.index(chrom)][int(start):int(end)]
+            sums.append(int(values.sum()))
+            bases_10x += int((values >= 10).sum())
+            total += len(values)
+
+    result = calculate_coverage_numpy(bam, bed)
+    assert result['region_coverage'].depths.tolist() == sums
+    assert result['mean_depth'] == pytest.approx(sum(sums) / total)
+    assert result['percent_bases_covered_10x'] == pytest.approx(bases_10x / total * 100)
@@ -0,0 +1,112 @@
+# dev/tests/test_binned_depth.py
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from binned_depth import DepthBins, DepthBinsQuery, calculate_depth_bins
+from synthetic_data import simulate_reads, write_bam
+
+CONTIGS = [("chr1", 300_000), ("chr2", 120_000)]
+BIN_SIZE = 100
+THRESHOLDS = (10, 20, 30)
+FAKE_SAMTOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "apps", "fake_samtools.py")
+# Trechos alinhados de cada CIGAR_TEMPLATES, relativos ao início do read (sem S, D e N)
+ALIGNED_BLOCKS = (((0, 100),), ((0, 40), (43, 98)), ((0, 30), (230, 300)))
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    """BAM sintético e a profundidade por base esperada (só M, sem duplicatas)."""
+    directory = tmp_path_factory.mktemp("bins")
+    reads = simulate_reads(CONTIGS, depth=25, seed=3)
+    bam = write_bam(str(directory / "amostra.bam"), CONTIGS, *reads)
+    expected = [np.zeros(length + 1, dtype=np.int64) for _name, length in CONTIGS]
+    for ref_id, position, template, flag in zip(*(column.tolist() for column in reads)):
+        if flag & 0x400:
+            continue
+        for start, end in ALIGNED_BLOCKS[template]:
+            expected[ref_id][position + start] += 1
+            expected[ref_id][position + end] -= 1
+    expected = [np.cumsum(change[:-1]) for change in expected]
+    return directory, bam, expected
+
+
+def expected_bins(depth, bin_size=BIN_SIZE):
+    n_bins = -(-len(depth) // bin_size)
+    blocks = np.zeros(n_bins * bin_size, dtype=np.int64)
+    blocks[:len(depth)] = depth
+    blocks = blocks.reshape(n_bins, bin_size)
+    return blocks.sum(axis=1), np.array([(blocks >= threshold).sum(axis=1) for threshold in THRESHOLDS])
+
+
+def assert_bins_match(depth_bins, expected, bin_size=BIN_SIZE):
+    for (name, _length), depth in zip(CONTIGS, expected):
+        code = depth_bins.chrom_names.index(name)
+        sums, at_least = expected_bins(depth, bin_size)
+        assert np.array_equal(depth_bins.sums[code][:len(sums)], sums)
+        assert not depth_bins.sums[code][len(sums):].any()
+        assert np.array_equal(depth_bins.at_least[code][:, :len(sums)], at_least)
+
+
+def test_bam_path_skips_deletions_and_introns(dataset):
+    _directory, bam, expected = dataset
+    assert_bins_match(calculate_depth_bins(bam, bin_size=BIN_SIZE, thresholds=THRESHOLDS, threads=2), expected)
+
+
+def test_depth_stream_path_matches_bam_path(dataset):
+    directory, bam, expected = dataset
+    # No fake_samtools o "CRAM" é uma cópia do BAM lida pelo `samtools depth`
+    cram = str(directory / "amostra.cram")
+    shutil.copyfile(bam, cram)
+    shutil.copyfile(f"{bam}.bai", f"{cram}.crai")
+    depth_bins = calculate_depth_bins(cram, samtools_path=FAKE_SAMTOOLS, index_file=f"{cram}.crai",
+                                      bin_size=BIN_SIZE, thresholds=THRESHOLDS)
+    assert_bins_match(depth_bins, expected)
+
+
+def test_large_bins_count_past_255_bases(dataset, tmp_path):
+    _directory, bam, expected = dataset
+    depth_bins = calculate_depth_bins(bam, bin_size=1000, thresholds=THRESHOLDS)
+    assert_bins_match(depth_bins, expected, bin_size=1000)
+    assert depth_bins.at_least[0].max() > 255
+    query = DepthBinsQuery(depth_bins.save(str(tmp_path / "bins.npz")))
+    result = query.query(["chr1"], [10_000], [20_000])
+    assert result["percent_at_least_10x"][0] == pytest.approx((expected[0][10_000:20_000] >= 10).mean() * 100)
+
+
+def test_feed_accumulates_batches():
+    depth_bins = DepthBins(BIN_SIZE, THRESHOLDS)
+    positions = np.arange(50, 350)
+    depths = np.full(len(positions), 12)
+    # Dois lotes que cortam uma janela ao meio
+    for batch in (slice(0, 120), slice(120, None)):
+        depth_bins.feed(["chr1"], np.zeros(len(positions[batch]), dtype=np.int32), positions[batch], depths[batch])
+    assert depth_bins.sums[0][:4].tolist() == [600, 1200, 1200, 600]
+    assert depth_bins.at_least[0][:, :4].tolist() == [[50, 100, 100, 50], [0] * 4, [0] * 4]
+
+
+def test_query_on_bin_boundaries_is_exact(dataset, tmp_path):
+    _directory, bam, expected = dataset
+    path = calculate_depth_bins(bam, bin_size=BIN_SIZE, thresholds=THRESHOLDS).save(str(tmp_path / "bins.npz"))
+    query = DepthBinsQuery(path)
+    rng = np.random.default_rng(0)
+    chroms = ["chr1", "2", "chr1"] + ["chr1"] * 200
+    starts = np.concatenate(([0, 0, 299_900], rng.integers(0, 2900, 200) * BIN_SIZE))
+    ends = np.concatenate(([300_000, 120_000, 300_000], starts[3:] + rng.integers(1, 100, 200) * BIN_SIZE))
+    result = query.query(chroms, starts, ends)
+    for i, (chrom, start, end) in enumerate(zip(chroms, starts.tolist(), ends.tolist())):
+        depth = expected[0 if chrom == "chr1" else 1][start:end]
+        assert result["mean_depth"][i] == pytest.approx(depth.mean())
+        for threshold in THRESHOLDS:
+            assert result[f"percent_at_least_{threshold}x"][i] == pytest.approx((depth >= threshold).mean() * 100)
+
+
+def test_query_prorates_partial_bins(dataset, tmp_path):
+    _directory, bam, expected = dataset
+    path = calculate_depth_bins(bam, bin_size=BIN_SIZE, thresholds=THRESHOLDS).save(str(tmp_path / "bins.npz"))
+    result = DepthBinsQuery(path).query(["chr1", "chr9"], [1_025, 0], [1_275, 100])
+    bins = expected[0][1_000:1_300].reshape(3, BIN_SIZE).sum(axis=1)
+    assert result["mean_depth"][0] == pytest.approx((0.75 * bins[0] + bins[1] + 0.75 * bins[2]) / 250)
+    assert result["mean_depth"][1] == 0
@@ -0,0 +1,57 @@
+# dev/tests/test_cohort_matrix.py
+import numpy as np
+import pytest
+
+import cohort_matrix
+from cohort_matrix import CohortMatrix, cohort_directory
+from coverage import RegionTable
+
+STARTS = np.array([0, 100, 300, 1000])
+ENDS = np.array([100, 200, 350, 1100])
+
+
+def region_table(mean_depths):
+    """RegionTable com a profundidade somada (como o bedcov) que dá as médias pedidas."""
+    depths = (np.asarray(mean_depths) * (ENDS - STARTS)).astype(np.int64)
+    return RegionTable(["chr1", "chr2"], [0, 0, 0, 1], STARTS, ENDS, depths)
+
+
+def test_round_trip_across_chunk_boundary(tmp_path, monkeypatch):
+    # Blocos de 3 amostras: 7 amostras ocupam 3 blocos, o último incompleto
+    monkeypatch.setattr(cohort_matrix, "SAMPLES_PER_CHUNK", 3)
+    cohort = CohortMatrix(cohort_directory(str(tmp_path), "abc123"))
+    expected = {f"amostra{i}": [i, 2 * i, 10 + i, 40 - i] for i in range(7)}
+    paths = {name: cohort.add_sample(name, region_table(depths)) for name, depths in expected.items()}
+
+    assert len(set(paths.values())) == 3
+    assert paths["amostra2"] != paths["amostra3"]
+    assert cohort.samples() == list(expected)
+    for name, depths in expected.items():
+        assert cohort.sample_depths(name).tolist() == pytest.approx(depths)
+    chunks = list(cohort.iter_chunks())
+    assert [names for names, _block in chunks] == [["amostra0", "amostra1", "amostra2"],
+                                                   ["amostra3", "amostra4", "amostra5"], ["amostra6"]]
+    assert all(block.shape == (4, len(names)) for names, block in chunks)
+
+    # Substituir uma amostra do meio reescreve só a sua coluna
+    cohort.add_sample("amostra4", region_table([50, 50, 50, 50]))
+    assert cohort.samples() == list(expected)
+    assert cohort.sample_depths("amostra4").tolist() == [50, 50, 50, 50]
+    assert cohort.sample_depths("amostra5").tolist() == pytest.approx(expected["amostra5"])
+
+    matrix = np.array([cohort.sample_depths(name) for name in expected]).T
+    fraction, mean_depth = cohort.low_coverage_fraction(5, row_block=3)
+    assert fraction.tolist() == pytest.approx((matrix < 5).mean(axis=1).tolist())
+    assert mean_depth.tolist() == pytest.approx(matrix.mean(axis=1).tolist())
+    chrom_names, chrom_codes, starts, ends = cohort.regions()
+    assert [chrom_names[code] for code in chrom_codes] == ["chr1", "chr1", "chr1", "chr2"]
+    assert starts.tolist() == STARTS.tolist() and ends.tolist() == ENDS.tolist()
+
+
+def test_rejects_sample_with_other_regions(tmp_path):
+    cohort = CohortMatrix(str(tmp_path / "coorte"))
+    cohort.add_sample("amostra0", region_table([1, 2, 3, 4]))
+    other = RegionTable(["chr1"], [0, 0], np.array([0, 100]), np.array([100, 200]), np.array([10, 20]))
+    with pytest.raises(ValueError):
+        cohort.add_sample("amostra1", other)
+    assert cohort.samples() == ["amostra0"]
@@ -0,0 +1,62 @@
+# dev/tests/test_contamination.py
+import numpy as np
+import pytest
+
+import contamination
+from contamination import BASE_CODES, PanelSites, count_alleles_mpileup, fit_contamination, parse_pileup_bases
+
+
+def simulate_counts(alpha, n_sites=3000, mean_depth=40, error_rate=0.01, seed=0):
+    """Contagens ref/alt de uma amostra com fração `alpha` de um contaminante (genótipos em HWE)."""
+    rng = np.random.default_rng(seed)
+    allele_freqs = rng.uniform(0.05, 0.95, n_sites)
+    sample = rng.binomial(2, allele_freqs) / 2
+    contaminant = rng.binomial(2, allele_freqs) / 2
+    alt_fraction = (1 - alpha) * sample + alpha * contaminant
+    # Erros de sequenciamento viram uma das outras 3 bases (as que não são ref nem alt não contam)
+    alt_probability = alt_fraction * (1 - error_rate) + (1 - alt_fraction) * error_rate / 3
+    ref_probability = (1 - alt_fraction) * (1 - error_rate) + alt_fraction * error_rate / 3
+    depths = rng.poisson(mean_depth, n_sites)
+    alt_counts = rng.binomial(depths, alt_probability)
+    ref_counts = rng.binomial(depths - alt_counts, ref_probability / (1 - alt_probability))
+    return ref_counts, alt_counts, allele_freqs
+
+
+@pytest.mark.parametrize("alpha", [0.0, 0.02, 0.1])
+def test_fit_recovers_simulated_alpha(alpha):
+    ref_counts, alt_counts, allele_freqs = simulate_counts(alpha)
+    freemix, log_likelihood, log_likelihood_zero = fit_contamination(ref_counts, alt_counts, allele_freqs, 0.01)
+    assert freemix == pytest.approx(alpha, abs=0.005)
+    assert log_likelihood >= log_likelihood_zero
+
+
+def test_parse_pileup_bases_maps_reference_matches():
+    # '^' + qualidade de mapeamento, '$' fim de read, '+2AG'/'-1t' indels, '*' deleção
+    assert parse_pileup_bases("^!.,$A+2AGc-1t*g", "T") == ["T", "T", "A", "C", "*", "G"]
+
+
+def test_count_alleles_mpileup_counts_dot_comma_as_reference(monkeypatch):
+    panel_sites = PanelSites(["chr1", "chr2"], [0, 2, 3], [99, 199, 49],
+                             [BASE_CODES["A"], BASE_CODES["C"], BASE_CODES["G"]],
+                             [BASE_CODES["G"], BASE_CODES["T"], BASE_CODES["A"]], [0.3, 0.5, 0.2])
+    pileup = [
+        "chr1\t100\tA\t6\t..,,Gg\tIIIIII\n",
+        "chr1\t200\tC\t4\t.,$T^~t\tIIII\n",
+        "chr2\t50\tG\t3\t.+1C,a\tIII\n",
+        "chr3\t10\tA\t2\t..\tII\n",
+    ]
+    commands = []
+
+    async def fake_run_tool(command, stdout_consumer=None, lines=False):
+        # Cada mpileup recebe todas as linhas: as de outros contigs são ignoradas
+        commands.append(command)
+        stdout_consumer(pileup)
+
+    monkeypatch.setattr(contamination, "run_tool", fake_run_tool)
+    ref_counts, alt_counts, error_rate = count_alleles_mpileup("sample.cram", panel_sites, ref_fasta="ref.fa")
+
+    assert all("--reference" in command for command in commands)
+    assert sorted(command[command.index("-r") + 1] for command in commands) == ["chr1", "chr2"]
+    assert ref_counts.tolist() == [4, 2, 2]
+    assert alt_counts.tolist() == [2, 2, 1]
+    assert error_rate == pytest.approx(10 ** -4.0)
@@ -0,0 +1,39 @@
+# dev/tests/test_coverage.py
+import os
+
+import numpy as np
+import pytest
+
+from coverage import RegionTable, calculate_coverage, summarize_region_coverage
+from synthetic_data import make_dataset
+
+CONTIGS = [("chr1", 200_000), ("chr2", 150_000), ("chrX", 150_000), ("chrY", 80_000)]
+FAKE_SAMTOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "apps", "fake_samtools.py")
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    # Autossomos a ~20x e X/Y a ~10x: há regiões dos dois lados do limiar de 10x
+    return make_dataset(str(tmp_path_factory.mktemp("coverage")), CONTIGS, depth=20, targets_per_contig=150,
+                        seed=5)
+
+
+def test_thresholds_use_mean_depth_of_each_region():
+    # Regiões de 100 pb com médias 5x, 12x e 40x (profundidade somada, como no bedcov)
+    table = RegionTable(["chr1"], [0, 0, 0], np.array([0, 200, 400]), np.array([100, 300, 500]),
+                        np.array([500, 1200, 4000]))
+    summary = summarize_region_coverage(table)
+    assert summary['mean_depth'] == pytest.approx(19.0)
+    assert summary['percent_covered_10x'] == pytest.approx(200 / 3)
+    assert summary['percent_covered_30x'] == pytest.approx(100 / 3)
+
+
+def test_samtools_and_numpy_engines_agree(dataset):
+    bedcov = calculate_coverage(dataset["bam"], dataset["bed"], samtools_path=FAKE_SAMTOOLS)
+    numpy_engine = calculate_coverage(dataset["bam"], dataset["bed"], engine="numpy")
+    for key in ('mean_depth', 'percent_covered_10x', 'percent_covered_30x'):
+        assert bedcov[key] == pytest.approx(numpy_engine[key])
+    assert np.array_equal(bedcov['region_coverage'].depths, numpy_engine['region_coverage'].depths)
+    # Com ~20x nos autossomos, nem todas as bases passam de 10x e quase nenhuma de 30x
+    assert 0 < bedcov['percent_covered_10x'] < 100
+    assert bedcov['percent_covered_30x'] < 5
@@ -0,0 +1,70 @@
+# dev/tests/test_coverage_output.py
+import gzip
+
+import numpy as np
+import pytest
+
+from coverage import RegionTable
+from coverage_output import parse_region, query_region_coverage, read_tabix_index, write_region_coverage
+
+
+def random_table(seed=0, regions_per_contig=4000):
+    """Regiões sobrepostas, de tamanhos variados (até 300 kb) e fora de ordem, em três contigs."""
+    rng = np.random.default_rng(seed)
+    chrom_names = ["chr1", "chr2", "chrX"]
+    codes = np.repeat(np.arange(len(chrom_names)), regions_per_contig)
+    starts = rng.integers(0, 5_000_000, len(codes))
+    lengths = np.where(rng.random(len(codes)) < 0.05, rng.integers(1, 300_000, len(codes)),
+                       rng.integers(1, 500, len(codes)))
+    depths = rng.integers(0, 100_000, len(codes))
+    order = rng.permutation(len(codes))
+    return RegionTable(chrom_names, codes[order], starts[order], starts[order] + lengths[order], depths[order])
+
+
+def brute_force(table, chrom, start, end):
+    code = table.chrom_names.index(chrom)
+    rows = np.flatnonzero((table.chrom_codes == code) & (table.starts < end) & (table.ends > start))
+    return sorted((chrom, int(table.starts[row]), int(table.ends[row]), int(table.depths[row])) for row in rows)
+
+
+@pytest.fixture(scope="module")
+def written(tmp_path_factory):
+    table = random_table()
+    tsv_path = str(tmp_path_factory.mktemp("coverage") / "coverage_amostra_regions.tsv.gz")
+    write_region_coverage(tsv_path, table)
+    return table, tsv_path
+
+
+def test_queries_match_brute_force(written):
+    table, tsv_path = written
+    rng = np.random.default_rng(1)
+    for _ in range(300):
+        chrom = ["chr1", "chr2", "chrX"][rng.integers(3)]
+        start = int(rng.integers(0, 5_200_000))
+        end = start + int(rng.choice([1, 100, 20_000, 1_000_000]))
+        found = sorted((c, s, e, d) for c, s, e, d, _mean in query_region_coverage(tsv_path, chrom, start, end))
+        assert found == brute_force(table, chrom, start, end)
+
+
+def test_whole_contig_and_missing_contig(written):
+    table, tsv_path = written
+    assert len(query_region_coverage(tsv_path, "chr2")) == int(np.count_nonzero(table.chrom_codes == 1))
+    assert query_region_coverage(tsv_path, "chr7") == []
+
+
+def test_file_is_plain_gzip_sorted_tsv_and_index_lists_contigs(written):
+    table, tsv_path = written
+    with gzip.open(tsv_path, "rt") as handle:
+        lines = handle.read().splitlines()
+    assert lines[0].startswith("#chrom")
+    assert len(lines) == len(table) + 1
+    keys = [(["chr1", "chr2", "chrX"].index(line.split("\t")[0]), int(line.split("\t")[1])) for line in lines[1:]]
+    assert keys == sorted(keys)
+    chrom_names, references = read_tabix_index(f"{tsv_path}.tbi")
+    assert chrom_names == ["chr1", "chr2", "chrX"]
+    assert all(len(reference["bins"]) for reference in references)
+
+
+def test_parse_region():
+    assert parse_region("chr1:1,001-2,000") == ("chr1", 1000, 2000)
+    assert parse_region("chrX") == ("chrX", 0, None)
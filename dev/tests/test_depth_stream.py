@@ -0,0 +1,55 @@
+# dev/tests/test_depth_stream.py
+import numpy as np
+import pytest
+
+from depth_stream import QuantizedCoverage
+
+THRESHOLDS = (1, 10, 30)
+LABELS = ["0", "1-9", "10-29", "30+"]
+
+
+def expected_runs(chroms, positions, depths):
+    """Trechos esperados, base a base: mesma classe, mesmo cromossomo e posições seguidas."""
+    runs = []
+    for chrom, position, depth in zip(chroms, positions.tolist(), depths.tolist()):
+        label = LABELS[int(np.searchsorted(THRESHOLDS, depth, side="right"))]
+        if runs and runs[-1][0] == chrom and runs[-1][2] == position and runs[-1][3] == label:
+            runs[-1][2] = position + 1
+        else:
+            runs.append([chrom, position, position + 1, label])
+    return [tuple(run) for run in runs]
+
+
+@pytest.mark.parametrize("batch", [7, 64, 1000])
+def test_runs_merge_across_batches(tmp_path, batch):
+    rng = np.random.default_rng(2)
+    # Dois alvos em chr1 (com um salto entre eles) e um em chr2; profundidade em patamares
+    positions = np.concatenate([np.arange(100, 300), np.arange(500, 560), np.arange(0, 150)])
+    codes = np.repeat([0, 0, 1], [200, 60, 150]).astype(np.int32)
+    depths = np.repeat(rng.choice([0, 3, 12, 45], 41), 10)[:len(positions)]
+    depths[:40] = 12  # o primeiro patamar atravessa vários lotes pequenos
+    chrom_names = ["chr1", "chr2"]
+
+    bed_path = tmp_path / "quantized.bed"
+    with QuantizedCoverage(str(bed_path), THRESHOLDS) as quantizer:
+        for first in range(0, len(positions), batch):
+            rows = slice(first, first + batch)
+            quantizer.feed(chrom_names, codes[rows], positions[rows], depths[rows])
+
+    expected = expected_runs([chrom_names[code] for code in codes], positions, depths)
+    lines = [line.split("\t") for line in bed_path.read_text().splitlines()]
+    assert [(chrom, int(start), int(end), label) for chrom, start, end, label in lines] == expected
+    summary = quantizer.summary()
+    assert summary["runs"] == len(expected)
+    assert summary["total_bases"] == len(positions)
+    assert summary["bases"] == {label: int((np.searchsorted(THRESHOLDS, depths, side="right") == i).sum())
+                                for i, label in enumerate(LABELS)}
+
+
+def test_failed_pass_leaves_no_bed(tmp_path):
+    bed_path = tmp_path / "quantized.bed"
+    with pytest.raises(RuntimeError):
+        with QuantizedCoverage(str(bed_path), THRESHOLDS) as quantizer:
+            quantizer.feed(["chr1"], np.zeros(3, dtype=np.int32), np.arange(3), np.array([5, 5, 40]))
+            raise RuntimeError("samtools depth falhou")
+    assert list(tmp_path.iterdir()) == []
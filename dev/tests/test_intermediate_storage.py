@@ -0,0 +1,39 @@
+# dev/tests/test_intermediate_storage.py
+import time
+
+from intermediate_storage import IntermediateStorage
+
+
+def write_bam(storage, sample_name, size):
+    for path, data in zip(storage.bam_files(sample_name), (b"\0" * size, b"\0")):
+        with open(path, "wb") as handle:
+            handle.write(data)
+    storage.commit(sample_name)
+
+
+def test_pin_from_crashed_remote_node_expires(tmp_path):
+    remote = IntermediateStorage(str(tmp_path), 1000, owner="outro-no:4242", pin_ttl=60)
+    local = IntermediateStorage(str(tmp_path), 1000, poll_seconds=0.01, pin_ttl=60)
+    remote.acquire("amostra_a", ["coverage"], 900)
+    write_bam(remote, "amostra_a", 900)
+
+    # Reserva renovada: o BAM do outro nó continua preso
+    assert local.usage()[1] == 901
+    # Sem renovação por mais de pin_ttl (nó caiu): o BAM pode ser removido
+    with local.locked() as ledger:
+        ledger["entries"]["amostra_a"]["pin"]["renewed_at"] = time.time() - 120
+    assert local.usage()[1] == 0
+    assert local.acquire("amostra_b", ["coverage"], 900) == 0
+    assert not (tmp_path / "amostra_a.bam").exists()
+
+
+def test_heartbeat_renews_own_pins(tmp_path):
+    storage = IntermediateStorage(str(tmp_path), 1000, owner="outro-no:4242", pin_ttl=60)
+    storage.acquire("amostra_a", ["coverage"], 100)
+    with storage.locked() as ledger:
+        ledger["entries"]["amostra_a"]["pin"]["renewed_at"] = 0
+    with storage.heartbeat(interval=0.01):
+        time.sleep(0.1)
+    with storage.locked() as ledger:
+        assert time.time() - ledger["entries"]["amostra_a"]["pin"]["renewed_at"] < 5
+    assert storage.usage()[1] == 100
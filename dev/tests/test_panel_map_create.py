@@ -0,0 +1,50 @@
+# dev/tests/test_panel_map_create.py
+import gzip
+import struct
+
+import numpy as np
+
+from bgzf import BgzfWriter
+from coverage_output import write_tabix_index
+from panel_map_create import vcf_contigs
+
+VCF_RECORDS = "".join(f"{chrom}\t{position}\t.\tA\tG\t.\tPASS\tAF=0.3\n"
+                      for chrom, position in [("1", 100), ("1", 200), ("2", 50), ("X", 10), ("X", 20)])
+
+
+def test_vcf_contigs_reads_every_record(tmp_path):
+    vcf_file = tmp_path / "panel.vcf.gz"
+    with gzip.open(vcf_file, "wt") as handle:
+        handle.write("##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n" + VCF_RECORDS)
+    assert vcf_contigs(str(vcf_file)) == ["1", "2", "X"]
+
+
+def test_vcf_contigs_uses_tabix_index(tmp_path):
+    vcf_file = tmp_path / "panel.vcf.gz"
+    vcf_file.write_bytes(b"")  # com o índice o VCF não é lido
+    empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 2), dtype=np.uint64),
+             np.zeros(0, dtype=np.uint64))
+    write_tabix_index(f"{vcf_file}.tbi", ["1", "2", "X"], [empty] * 3)
+    assert vcf_contigs(str(vcf_file)) == ["1", "2", "X"]
+
+
+def test_vcf_contigs_uses_csi_names(tmp_path):
+    vcf_file = tmp_path / "panel.vcf.gz"
+    vcf_file.write_bytes(b"")
+    names = b"1\0002\000X\0"
+    aux = struct.pack("<7i", 2, 1, 2, 0, ord("#"), 0, len(names)) + names
+    with BgzfWriter(f"{vcf_file}.csi") as writer:
+        writer.write(b"CSI\1" + struct.pack("<3i", 14, 5, len(aux)) + aux + struct.pack("<i", 3))
+    assert vcf_contigs(str(vcf_file)) == ["1", "2", "X"]
+
+
+def test_vcf_contigs_stops_at_first_record_with_contig_header(tmp_path):
+    vcf_file = tmp_path / "panel.vcf.gz"
+    header = "".join(f"##contig=<ID={chrom},length=1000>\n" for chrom in ("1", "2", "X"))
+    with gzip.open(vcf_file, "wt") as handle:
+        handle.write("##fileformat=VCFv4.2\n" + header + "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+                     + "2\t50\t.\tA\tG\t.\tPASS\tAF=0.3\n")
+    # Um trecho corrompido depois do primeiro registro: o arquivo não é lido até o fim
+    with open(vcf_file, "ab") as handle:
+        handle.write(b"\x1f\x8b\x08\x00corrompido")
+    assert vcf_contigs(str(vcf_file)) == ["2", "X"]
@@ -0,0 +1,76 @@
+# dev/tests/test_qc_server.py
+import json
+import os
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from qc_server import QCServer, make_handler
+from synthetic_data import make_dataset
+
+CONTIGS = [("chr1", 200_000), ("chr2", 150_000), ("chrX", 150_000), ("chrY", 60_000)]
+FAKE_SAMTOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "apps", "fake_samtools.py")
+
+
+@pytest.fixture
+def server(tmp_path):
+    dataset = make_dataset(str(tmp_path / "dados"), CONTIGS, depth=12, targets_per_contig=40, seed=6)
+    # No fake_samtools o "CRAM" é uma cópia do BAM
+    cram = str(tmp_path / "dados" / "amostra.cram")
+    shutil.copyfile(dataset["bam"], cram)
+    config = {"bed": dataset["bed"], "output_dir": str(tmp_path / "output"),
+              "intermediate_dir": str(tmp_path / "intermediate"), "samtools_path": FAKE_SAMTOOLS,
+              "bcftools_path": "bcftools", "ref_fasta": None, "panel_vcf": None, "no_plots": True}
+    state = QCServer(config, {"threads": 1})
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(state))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{httpd.server_address[1]}", cram
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        state.shutdown()
+
+
+def request(url, payload=None):
+    data = json.dumps(payload).encode() if payload is not None else None
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=30) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_submit_until_done(server):
+    base_url, cram = server
+    code, submitted = request(f"{base_url}/samples", {"cram_file": cram})
+    assert code == 202
+
+    deadline = time.time() + 120
+    while True:
+        code, job = request(f"{base_url}/jobs/{submitted['job_id']}")
+        assert code == 200
+        if job["status"] in ("done", "failed") or time.time() > deadline:
+            break
+        time.sleep(0.2)
+
+    assert job["status"] == "done", job["error"]
+    results = job["results"]
+    assert results["coverage"]["mean_depth"] > 5
+    assert results["sex"]["Sexo Predito"]
+    assert any(path.endswith("coverage_amostra_results.txt") for path in results["files"])
+    code, status = request(f"{base_url}/status")
+    assert status["jobs"] == {"done": 1}
+
+
+def test_rejects_missing_cram(server):
+    base_url, _cram = server
+    code, payload = request(f"{base_url}/samples", {"cram_file": "/nao/existe.cram"})
+    assert code == 400 and "error" in payload
+    assert request(f"{base_url}/jobs/desconhecido")[0] == 404
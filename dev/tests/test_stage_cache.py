@@ -0,0 +1,66 @@
+# dev/tests/test_stage_cache.py
+import json
+import os
+
+import stage_cache
+from stage_cache import MANIFEST_VERSION, StageManifest, alignment_fingerprints, fingerprint
+
+
+def test_stage_hit_until_fingerprint_or_outputs_change(tmp_path):
+    output = tmp_path / "coverage.txt"
+    output.write_text("ok\n")
+    manifest_path = str(tmp_path / "manifests" / "amostra.json")
+    StageManifest(manifest_path).record("coverage", fingerprint(bed="a"), [str(output)])
+
+    manifest = StageManifest(manifest_path)
+    assert manifest.is_current("coverage", fingerprint(bed="a"))
+    assert not manifest.is_current("coverage", fingerprint(bed="b"))
+    assert not manifest.is_current("histogram", fingerprint(bed="a"))
+    output.unlink()
+    assert not manifest.is_current("coverage", fingerprint(bed="a"))
+
+
+def test_invalidate_and_version_mismatch(tmp_path):
+    output = tmp_path / "sex.txt"
+    output.write_text("ok\n")
+    manifest_path = str(tmp_path / "amostra.json")
+    manifest = StageManifest(manifest_path)
+    manifest.record("sex", "fp", [str(output)])
+    manifest.invalidate("sex")
+    assert not StageManifest(manifest_path).is_current("sex", "fp")
+
+    manifest.record("sex", "fp", [str(output)])
+    with open(manifest_path) as handle:
+        data = json.load(handle)
+    data["version"] = MANIFEST_VERSION + 1
+    with open(manifest_path, "w") as handle:
+        json.dump(data, handle)
+    assert not StageManifest(manifest_path).is_current("sex", "fp")
+
+
+def test_input_checksum_reused_until_file_changes(tmp_path, monkeypatch):
+    cram = tmp_path / "amostra.cram"
+    cram.write_bytes(b"CRAM" * 10)
+    manifest_path = str(tmp_path / "amostra.json")
+    first = StageManifest(manifest_path).input_fingerprint(str(cram))
+
+    hashed = []
+    monkeypatch.setattr(stage_cache, "file_sha256", lambda path: hashed.append(path) or "novo")
+    assert StageManifest(manifest_path).input_fingerprint(str(cram)) == first
+    assert not hashed
+    cram.write_bytes(b"CRAM" * 11)
+    assert StageManifest(manifest_path).input_fingerprint(str(cram))["sha256"] == "novo"
+    assert hashed == [str(cram)]
+
+
+def test_compression_level_only_changes_conversion(tmp_path, monkeypatch):
+    monkeypatch.setattr(stage_cache, "samtools_version", lambda path: "samtools 1.21")
+    reference = tmp_path / "ref.fa"
+    reference.write_text(">chr1\nACGT\n")
+    content_6, conversion_6 = alignment_fingerprints("abc", str(reference), compression_level=6)
+    content_1, conversion_1 = alignment_fingerprints("abc", str(reference), compression_level=1)
+    assert content_6 == content_1
+    assert conversion_6 != conversion_1
+    assert alignment_fingerprints("abd", str(reference), compression_level=6)[0] != content_6
+    os.utime(reference, ns=(0, 0))
+    assert alignment_fingerprints("abc", str(reference), compression_level=6)[0] != content_6
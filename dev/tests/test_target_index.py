@@ -0,0 +1,69 @@
+# dev/tests/test_target_index.py
+from target_index import build_target_index, load_target_index, normalize_contig_name
+
+
+def write_lines(path, lines):
+    path.write_text("".join(f"{line}\n" for line in lines))
+    return str(path)
+
+
+def test_overlapping_and_adjacent_targets_are_merged(tmp_path):
+    bed = write_lines(tmp_path / "alvos.bed", [
+        "chr1\t500\t600",
+        "chr1\t100\t200",
+        "chr1\t150\t250",  # sobrepõe o anterior
+        "chr1\t250\t300",  # encosta no fim do bloco (adjacente)
+        "chr1\t301\t400",  # 1 pb de intervalo: bloco separado
+        "chr1\t320\t330",  # contido no anterior
+        "chr1\t590\t610",
+    ])
+    index = build_target_index(bed)
+    assert list(index.iter_rows()) == [("chr1", 100, 300), ("chr1", 301, 400), ("chr1", 500, 610)]
+
+
+def test_invalid_lines_are_skipped(tmp_path):
+    bed = write_lines(tmp_path / "alvos.bed", [
+        "track name=alvos",
+        "# comentário",
+        "chr1\t10\t20",
+        "chr1\tdez\t20",
+        "chr1\t30\t30",
+        "chr1\t-5\t10",
+        "chr1",
+    ])
+    assert list(build_target_index(bed).iter_rows()) == [("chr1", 10, 20)]
+
+
+def test_contig_names_follow_the_fai(tmp_path):
+    reference = tmp_path / "ref.fa"
+    reference.write_text(">1\nACGT\n")
+    write_lines(tmp_path / "ref.fa.fai", ["1\t1000\t3\t4\t5", "chr2\t2000\t1010\t4\t5", "MT\t500\t3030\t4\t5"])
+    bed = write_lines(tmp_path / "alvos.bed", [
+        "MT\t10\t20",
+        "2\t100\t200",
+        "chr1\t950\t1200",  # cortado no fim do contig
+        "chrM\t15\t40",  # mesmo contig que MT: unido
+        "chr3\t0\t100",  # fora da referência
+    ])
+    index = load_target_index(bed, str(tmp_path / "intermediate"), str(reference))
+    assert index.contig_names == ["1", "chr2", "MT"]
+    assert list(index.iter_rows()) == [("1", 950, 1000), ("chr2", 100, 200), ("MT", 10, 40)]
+    with open(index.bed_path) as handle:
+        assert handle.read() == "1\t950\t1000\nchr2\t100\t200\nMT\t10\t40\n"
+
+    # Segunda carga vem do cache, com o mesmo conteúdo
+    cached = load_target_index(bed, str(tmp_path / "intermediate"), str(reference))
+    assert cached.bed_path == index.bed_path
+    assert list(cached.iter_rows()) == list(index.iter_rows())
+
+
+def test_normalize_contig_name():
+    known = {"1", "X", "MT", "chrUn_gl000220"}
+    assert normalize_contig_name("chr1", known) == "1"
+    assert normalize_contig_name("chrX", known) == "X"
+    assert normalize_contig_name("chrM", known) == "MT"
+    assert normalize_contig_name("chrUn_gl000220", known) == "chrUn_gl000220"
+    assert normalize_contig_name("chr2", known) is None
+    assert normalize_contig_name("chr2", None) == "chr2"
+    assert normalize_contig_name("M", {"chrM"}) == "chrM"
+    assert normalize_contig_name("MT", {"chrM"}) == "chrM"
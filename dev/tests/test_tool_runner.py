@@ -0,0 +1,44 @@
+# dev/tests/test_tool_runner.py
+import sys
+import threading
+
+import tool_runner
+
+# Cada execução cria um arquivo, espera e conta quantos existem ao mesmo tempo
+CONCURRENCY_SCRIPT = """
+import os, sys, time
+path = os.path.join(sys.argv[1], str(os.getpid()))
+open(path, "w").close()
+time.sleep(0.2)
+print(len(os.listdir(sys.argv[1])))
+os.remove(path)
+"""
+
+
+def test_limit_applies_across_threads_and_calls(tmp_path, monkeypatch):
+    monkeypatch.setattr(tool_runner, "_tool_slots", threading.BoundedSemaphore(2))
+    command = [sys.executable, "-c", CONCURRENCY_SCRIPT, str(tmp_path)]
+    seen = []
+
+    def call():
+        seen.append(int(tool_runner.run_tool_sync(command, capture_stdout=True).stdout))
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    threads.append(threading.Thread(target=lambda: seen.extend(
+        int(result.stdout) for result in tool_runner.run_tools_sync([command] * 3, capture_stdout=True))))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(seen) == 6
+    assert max(seen) <= 2
+
+
+def test_failure_releases_slot(monkeypatch):
+    monkeypatch.setattr(tool_runner, "_tool_slots", threading.BoundedSemaphore(1))
+    for _ in range(2):
+        try:
+            tool_runner.run_tool_sync([sys.executable, "-c", "raise SystemExit(3)"])
+        except tool_runner.ToolError as e:
+            assert e.returncode == 3
+    assert tool_runner.run_tool_sync([sys.executable, "-c", "print('ok')"], capture_stdout=True).stdout == b"ok\n"
@@ -0,0 +1,53 @@
+# dev/tests/test_work_queue.py
+import json
+import os
+import threading
+import time
+
+from work_queue import WorkQueue, simulate
+
+
+def make_stale(queue, item, owner="node-morto:1:abc"):
+    lock_path = queue.path(item, "lock")
+    with open(lock_path, "w") as handle:
+        json.dump({"owner": owner}, handle)
+    old = time.time() - 10 * queue.lease_seconds
+    os.utime(lock_path, (old, old))
+
+
+def test_workers_drain_queue_despite_crashes(tmp_path):
+    completed, duplicates, _elapsed = simulate(str(tmp_path), workers=4, items=30, lease_seconds=1.0,
+                                               crash_workers=2)
+    assert completed == 30
+    assert duplicates == []
+
+
+def test_fresh_lease_is_not_stolen(tmp_path):
+    owner = WorkQueue(str(tmp_path), lease_seconds=30)
+    other = WorkQueue(str(tmp_path), lease_seconds=30)
+    assert owner.claim("amostra")
+    assert not other.claim("amostra")
+    owner.mark_done("amostra")
+    assert not other.claim("amostra")
+
+
+def test_stale_lease_has_a_single_new_owner(tmp_path):
+    queues = [WorkQueue(str(tmp_path), lease_seconds=1.0) for _ in range(8)]
+    for round_number in range(5):
+        item = f"amostra_{round_number}"
+        make_stale(queues[0], item)
+        barrier = threading.Barrier(len(queues))
+        winners = []
+
+        def contend(queue):
+            barrier.wait()
+            if queue.claim(item):
+                winners.append(queue.token)
+
+        threads = [threading.Thread(target=contend, args=(queue,)) for queue in queues]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(winners) == 1
+        assert queues[0]._read_owner(queues[0].path(item, "lock")) == winners[0]